@@ -11,6 +11,25 @@ interface Message {
   timestamp: Date;
 }
 
+interface StreamEvent {
+  event: string;
+  data: any;
+}
+
+// Parses one server-sent event block ("event: ..." and "data: ..." lines)
+const parseStreamEvent = (block: string): StreamEvent => {
+  let event = 'message';
+  let data = '';
+  for (const line of block.split('\n')) {
+    if (line.startsWith('event:')) {
+      event = line.slice('event:'.length).trim();
+    } else if (line.startsWith('data:')) {
+      data += line.slice('data:'.length).trim();
+    }
+  }
+  return { event, data: data ? JSON.parse(data) : {} };
+};
+
 interface TokenFormProps {
   onTokenSubmit: (token: string) => void;
 }
@@ -151,6 +170,11 @@ const ChatInterface: React.FC = () => {
     };
     
     setMessages(prevMessages => [...prevMessages, newMessage]);
+    return newMessage.id;
+  };
+  
+  const updateMessage = (id: string, text: string) => {
+    setMessages(prevMessages => prevMessages.map(message => (message.id === id ? { ...message, text } : message)));
   };
   
   const handleTokenSubmit = (newToken: string) => {
@@ -166,15 +190,20 @@ const ChatInterface: React.FC = () => {
     addMessage(text, 'user');
     setIsLoading(true);
     
+    let answerId: string | null = null;
+    let answer = '';
+    
     try {
-      // Send request to server with token
-      const response = await axios.post('/api/query', 
-        { query: text },
-        { 
-          headers: { 'X-API-Token': token },
-          validateStatus: (status) => status < 500 // Don't throw on 401
-        }
-      );
+      // Stream the answer as server-sent events; JSON is also accepted so an invalid token gets a 401, not a redirect
+      const response = await fetch('/api/query/stream', {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+          'Accept': 'text/event-stream, application/json',
+          'X-API-Token': token
+        },
+        body: JSON.stringify({ query: text })
+      });
       
       // Handle 401 Unauthorized (invalid token)
       if (response.status === 401) {
@@ -182,9 +211,41 @@ const ChatInterface: React.FC = () => {
         addMessage('您的访问令牌已过期或无效。请获取新令牌。', 'ai');
         return;
       }
+      if (!response.ok || !response.body) {
+        throw new Error(`Unexpected response status ${response.status}`);
+      }
       
-      // Add AI response
-      addMessage(response.data.answer, 'ai');
+      // Append answer text to the AI message as it arrives
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+          const { event, data } = parseStreamEvent(buffer.slice(0, boundary));
+          buffer = buffer.slice(boundary + 2);
+          if (event === 'delta') {
+            answer += data.text;
+            if (answerId === null) {
+              answerId = addMessage(answer, 'ai');
+              setIsLoading(false);
+            } else {
+              updateMessage(answerId, answer);
+            }
+          } else if (event === 'error') {
+            throw new Error(data.detail);
+          } else if (event === 'done') {
+            console.debug(`Time to first token: ${data.time_to_first_token_ms} ms`);
+          }
+        }
+      }
+      
+      if (answerId === null) {
+        addMessage('(收到空响应)', 'ai');
+      }
     } catch (error) {
       console.error('Error querying the Wine AI:', error);
       addMessage('很抱歉，在处理您的问题时遇到了错误。请重试。', 'ai');
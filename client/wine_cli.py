@@ -1,10 +1,12 @@
 import requests
 import sys
+import argparse
 import json
 import os.path
 import getpass
 
 QUERY_URL = "http://localhost:8080/api/query"
+STREAM_URL = "http://localhost:8080/api/query/stream"
 STATUS_URL = "http://localhost:8080/api/status"
 TOKEN_REQUEST_URL = "http://localhost:8080/api/request-token"
 TOKEN_FILE = os.path.expanduser("~/.wine_ai_token")
@@ -83,7 +85,34 @@ def request_new_token():
             if input("是否重试? (y/n): ").lower() != 'y':
                 return None
 
-def run_chat_client():
+def print_streamed_answer(response):
+    """Prints the answer from a server-sent event stream as it arrives."""
+    response.encoding = "utf-8"
+    event = None
+    started = False
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data = json.loads(line[len("data:"):].strip())
+            if event == "delta":
+                if not started:
+                    print("葡萄酒助手: ", end="", flush=True)
+                    started = True
+                print(data.get("text", ""), end="", flush=True)
+            elif event == "error":
+                if started:
+                    print()
+                print(f"服务器错误: {data.get('detail', '未知错误')}")
+                return
+            elif event == "done":
+                break
+    if started:
+        print()
+    else:
+        print("葡萄酒助手: (收到空响应)")
+
+def run_chat_client(bypass_cache=False, stream=True):
     print("--- 葡萄酒知识库聊天客户端 ---")
 
     # Check server status at startup
@@ -129,10 +158,13 @@ def run_chat_client():
             # Prepare JSON payload
             payload = {"query": query}
             headers = {"X-API-Token": token}
+            if bypass_cache:
+                headers["X-Bypass-Cache"] = "1"
 
-            # Send request to server
+            # Send request to server (streamed answers arrive as server-sent events)
+            url = STREAM_URL if stream else QUERY_URL
             try:
-                response = requests.post(QUERY_URL, json=payload, headers=headers, timeout=60)
+                response = requests.post(url, json=payload, headers=headers, timeout=60, stream=stream)
                 
                 if response.status_code == 401:
                     print("访问令牌已过期或无效。请获取新令牌。")
@@ -141,10 +173,15 @@ def run_chat_client():
                         print("错误: 无法获取有效的访问令牌。")
                         break
                     # Retry with new token
-                    response = requests.post(QUERY_URL, json=payload, headers={"X-API-Token": token}, timeout=60)
+                    headers["X-API-Token"] = token
+                    response = requests.post(url, json=payload, headers=headers, timeout=60, stream=stream)
                 
                 response.raise_for_status()
 
+                if stream:
+                    print_streamed_answer(response)
+                    continue
+
                 # Process successful response
                 try:
                     data = response.json()
@@ -180,4 +217,16 @@ def run_chat_client():
             break
 
 if __name__ == "__main__":
-    run_chat_client() 
\ No newline at end of file
+    cli_parser = argparse.ArgumentParser(description="Wine-AI chat client.")
+    cli_parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always request a fresh answer instead of a cached one."
+    )
+    cli_parser.add_argument(
+        "--no-stream",
+        action="store_true",
+        help="Wait for the complete answer instead of printing it as it is generated."
+    )
+    cli_args = cli_parser.parse_args()
+    run_chat_client(bypass_cache=cli_args.no_cache, stream=not cli_args.no_stream) 
\ No newline at end of file
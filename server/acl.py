@@ -1,15 +1,18 @@
 import os
-import json
+import heapq
 import string
 import random
 import time
 from datetime import datetime, timedelta
-import smtplib
+import asyncio
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from typing import Dict, Optional, List, Tuple
 import logger
 from dotenv import load_dotenv
+from token_store import TokenStore
+from token_backends import JsonTokenBackend, SqliteTokenBackend
+from email_queue import EmailQueue
 
 # Load environment variables
 load_dotenv()
@@ -18,8 +21,11 @@ load_dotenv()
 TOKEN_LENGTH = 6
 TOKEN_EXPIRY_HOURS = int(os.getenv('TOKEN_EXPIRY_HOURS', '24'))  # Default to 24 hours if not set
 TOKEN_FILE = "server/tokens.json"
-EXPIRED_TOKEN_FILE = "server/expired_tokens.json"
+EXPIRED_TOKEN_FILE = "server/expired_tokens.json"  # Former single-file archive; migrated to segments on first use
+EXPIRED_TOKEN_DIR = os.getenv("EXPIRED_TOKEN_DIR", "server/expired_tokens")  # Expired-token archive segments (json backend)
+TOKEN_ARCHIVE_SEGMENT_HOURS = int(os.getenv("TOKEN_ARCHIVE_SEGMENT_HOURS", "24"))  # Time span of one archive segment
 TOKEN_CHARS = string.ascii_uppercase + string.digits  # A-Z and 0-9
+TOKEN_WRITE_DELAY = float(os.getenv("TOKEN_WRITE_DELAY", "1.0"))  # Seconds token changes are batched before being written to storage
 
 # Email configuration from environment variables
 EMAIL_HOST = os.getenv("EMAIL_HOST", "smtp.gmail.com")
@@ -28,64 +34,60 @@ EMAIL_USER = os.getenv("EMAIL_USER", "")
 EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD", "")
 EMAIL_FROM = os.getenv("EMAIL_FROM", EMAIL_USER)
 EMAIL_USE_TLS = os.getenv("EMAIL_USE_TLS", "True").lower() == "true"
-EMAIL_ENABLED = all([EMAIL_HOST, EMAIL_PORT, EMAIL_USER, EMAIL_PASSWORD])
+# "true" also sends without credentials, e.g. through a local relay or a test server such as aiosmtpd
+EMAIL_ENABLED = os.getenv("EMAIL_ENABLED", str(all([EMAIL_HOST, EMAIL_PORT, EMAIL_USER, EMAIL_PASSWORD]))).lower() == "true"
 
-# Initialize token storage
-def init_token_storage() -> None:
-    """Initialize token storage file if it doesn't exist"""
-    if not os.path.exists(TOKEN_FILE):
-        with open(TOKEN_FILE, "w") as f:
-            json.dump({"tokens": []}, f)
-        logger.info(f"Token storage initialized at {TOKEN_FILE}")
-    
-    if not os.path.exists(EXPIRED_TOKEN_FILE):
-        with open(EXPIRED_TOKEN_FILE, "w") as f:
-            json.dump({"expired_tokens": []}, f)
-        logger.info(f"Expired token storage initialized at {EXPIRED_TOKEN_FILE}")
+# Token emails are sent in the background; started by the server at startup
+email_queue = EmailQueue(EMAIL_HOST, EMAIL_PORT, EMAIL_USER, EMAIL_PASSWORD, EMAIL_USE_TLS, EMAIL_FROM)
 
-# Load tokens from storage
-def load_tokens() -> List[Dict]:
-    """Load tokens from storage file"""
-    try:
-        if os.path.exists(TOKEN_FILE):
-            with open(TOKEN_FILE, "r") as f:
-                data = json.load(f)
-                return data.get("tokens", [])
-        return []
-    except Exception as e:
-        logger.error(f"Error loading tokens: {e}")
-        return []
+# Token persistence: "json" (TOKEN_FILE + segments in EXPIRED_TOKEN_DIR) or "sqlite" (TOKEN_DB_FILE, migrated from the JSON files on first use)
+TOKEN_BACKEND = os.getenv("TOKEN_BACKEND", "json").lower()
+TOKEN_DB_FILE = os.getenv("TOKEN_DB_FILE", "server/tokens.db")
 
-# Load expired tokens
-def load_expired_tokens() -> List[Dict]:
-    """Load expired tokens from storage file"""
-    try:
-        if os.path.exists(EXPIRED_TOKEN_FILE):
-            with open(EXPIRED_TOKEN_FILE, "r") as f:
-                data = json.load(f)
-                return data.get("expired_tokens", [])
-        return []
-    except Exception as e:
-        logger.error(f"Error loading expired tokens: {e}")
-        return []
+# Active tokens, indexed in memory; loaded from the backend by init_token_storage
+token_store = None
+token_backend = None
 
-# Save tokens to storage
-def save_tokens(tokens: List[Dict]) -> None:
-    """Save tokens to storage file"""
-    try:
-        with open(TOKEN_FILE, "w") as f:
-            json.dump({"tokens": tokens}, f)
-    except Exception as e:
-        logger.error(f"Error saving tokens: {e}")
+def _create_backend():
+    """The storage backend selected by TOKEN_BACKEND"""
+    if TOKEN_BACKEND == "sqlite":
+        return SqliteTokenBackend(TOKEN_DB_FILE, TOKEN_FILE, EXPIRED_TOKEN_FILE, EXPIRED_TOKEN_DIR)
+    if TOKEN_BACKEND != "json":
+        logger.warning(f"Unknown TOKEN_BACKEND '{TOKEN_BACKEND}', using json")
+    return JsonTokenBackend(TOKEN_FILE, EXPIRED_TOKEN_DIR, TOKEN_ARCHIVE_SEGMENT_HOURS, EXPIRED_TOKEN_FILE)
 
-# Save expired tokens to storage
-def save_expired_tokens(tokens: List[Dict]) -> None:
-    """Save expired tokens to storage file"""
-    try:
-        with open(EXPIRED_TOKEN_FILE, "w") as f:
-            json.dump({"expired_tokens": tokens}, f)
-    except Exception as e:
-        logger.error(f"Error saving expired tokens: {e}")
+def _get_backend():
+    global token_backend
+    if token_backend is None:
+        token_backend = _create_backend()
+        token_backend.init()
+    return token_backend
+
+def _get_store() -> TokenStore:
+    """The in-memory token store, loaded from the backend on first use"""
+    global token_store
+    if token_store is None:
+        backend = _get_backend()
+        token_store = TokenStore(backend.write_active, TOKEN_WRITE_DELAY)
+        token_store.load(backend.load_active())
+    return token_store
+
+# Initialize token storage
+def init_token_storage() -> None:
+    """Open (creating if needed) the token storage and load the active tokens into memory"""
+    global token_store, token_backend
+    if token_store is not None:
+        token_store.flush()
+    if token_backend is not None:
+        token_backend.close()
+    token_store = None
+    token_backend = None
+    logger.info(f"Loaded {len(_get_store())} active tokens into memory ({token_backend.name} backend)")
+
+def flush_tokens() -> None:
+    """Write pending token changes to the backend now (e.g. at shutdown)"""
+    if token_store is not None:
+        token_store.flush()
 
 # Generate a new token
 def generate_token() -> str:
@@ -94,49 +96,37 @@ def generate_token() -> str:
 
 # Create a new token for a user
 def create_token(email: str) -> str:
-    """Create a new token for the given email"""
-    # Load existing tokens
-    tokens = load_tokens()
-    
-    # Remove any existing tokens for this email
-    tokens = [t for t in tokens if t.get("email") != email]
+    """Create a new token for the given email, replacing any existing tokens for it"""
+    store = _get_store()
     
-    # Generate a new token
+    # Generate a new token, unique among the active ones
     token = generate_token()
+    while token in store:
+        token = generate_token()
     expiry = int(time.time() + TOKEN_EXPIRY_HOURS * 3600)
     
-    # Add the new token
-    tokens.append({
+    # Add the new token; it is written to storage in the background
+    store.add({
         "email": email,
         "token": token,
         "expiry": expiry,
         "created": int(time.time())
     })
     
-    # Save tokens
-    save_tokens(tokens)
-    
     return token
 
 # Validate a token
 def validate_token(token: str) -> bool:
-    """Check if a token is valid"""
+    """Check if a token is valid (one dict lookup, no file access)"""
     if not token:
         return False
         
     # Normalize token (uppercase)
     token = token.upper()
     
-    # Load tokens
-    tokens = load_tokens()
-    
     # Check if token exists and is not expired
-    current_time = int(time.time())
-    for t in tokens:
-        if t.get("token") == token and t.get("expiry", 0) > current_time:
-            return True
-    
-    return False
+    record = _get_store().get(token)
+    return record is not None and record.get("expiry", 0) > int(time.time())
 
 # Get email for a token
 def get_email_for_token(token: str) -> Optional[str]:
@@ -148,58 +138,60 @@ def get_email_for_token(token: str) -> Optional[str]:
     token = token.upper()
     
     # Check active tokens
-    tokens = load_tokens()
-    for t in tokens:
-        if t.get("token") == token:
-            return t.get("email")
+    record = _get_store().get(token)
+    if record is not None:
+        return record.get("email")
     
     # If not found in active tokens, check expired tokens
-    expired_tokens = load_expired_tokens()
-    for t in expired_tokens:
-        if t.get("token") == token:
-            return t.get("email")
-    
-    return None
+    record = _get_backend().find_expired(token)
+    return record.get("email") if record else None
 
 # Clean up expired tokens
-def cleanup_tokens() -> None:
-    """Move expired tokens to expired_tokens file instead of deleting them"""
-    tokens = load_tokens()
-    expired_tokens = load_expired_tokens()
-    current_time = int(time.time())
-    
-    # Find expired tokens
-    active_tokens = []
-    newly_expired = []
+def cleanup_tokens(current_time: Optional[int] = None) -> int:
+    """
+    Move expired tokens to the expired-token archive instead of deleting them
+    Returns the number of tokens moved (all archived in one write)
+    """
+    if current_time is None:
+        current_time = int(time.time())
     
-    for t in tokens:
-        if t.get("expiry", 0) > current_time:
-            active_tokens.append(t)
-        else:
-            # Add expiry timestamp for reference
-            t["expired_at"] = current_time
-            newly_expired.append(t)
+    # Find expired tokens (the store's expiry heap yields them without a scan)
+    store = _get_store()
+    newly_expired = store.pop_expired(current_time)
     
     # If we found expired tokens
     if len(newly_expired) > 0:
-        logger.info(f"Moving {len(newly_expired)} expired tokens to expired_tokens file")
+        logger.info(f"Moving {len(newly_expired)} expired tokens to the expired-token archive")
         
-        # Add to expired tokens list
-        expired_tokens.extend(newly_expired)
+        # Add expiry timestamp for reference
+        for t in newly_expired:
+            t["expired_at"] = current_time
         
-        # Save both files
-        save_tokens(active_tokens)
-        save_expired_tokens(expired_tokens)
+        # Save their removal from the active tokens first, so a crash in between
+        # loses them from the archive rather than leaving them active and archived
+        store.flush()
+        _get_backend().archive_expired(newly_expired)
+    
+    return len(newly_expired)
+
+def next_token_expiry() -> Optional[int]:
+    """Expiry time of the active token that expires first, or None if there are none"""
+    return _get_store().next_expiry()
+
+def count_expired_tokens(current_time: Optional[int] = None) -> int:
+    """Number of expired tokens not yet moved to the archive"""
+    return _get_store().count_expired(int(time.time()) if current_time is None else current_time)
 
 # Email a token to a user
 def send_token_email(email: str, token: str) -> Tuple[bool, str]:
     """
-    Send the token to the user's email
+    Queue the token email for the user; it is sent in the background
+    (delivery status: email_queue.deliveries)
     
     Returns:
         Tuple[bool, str]: (success, mode)
         - success: Whether the operation was successful
-        - mode: 'email' if sent by email, 'display' if should be displayed to user
+        - mode: 'email' if queued for sending, 'display' if should be displayed to user
     """
     # Log for debugging regardless of email sending success
     logger.info(f"Sending token '{token}' to {email}")
@@ -210,14 +202,26 @@ def send_token_email(email: str, token: str) -> Tuple[bool, str]:
         return (True, "display")
     
     try:
-        # Create message
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = "葡萄酒智能助手 - 您的访问令牌"
-        msg['From'] = EMAIL_FROM
-        msg['To'] = email
-        
-        # Create plain text version
-        text = f"""
+        delivery_id = email_queue.submit(email, build_token_email(email, token))
+        logger.info(f"Queued token email {delivery_id} to {email}")
+        return (True, "email")
+    except asyncio.QueueFull:
+        logger.error(f"Email queue full; token for {email} will be displayed to user.")
+        return (False, "display")
+    except Exception as e:
+        logger.error(f"Failed to queue email to {email}: {e}")
+        return (False, "display")
+
+def build_token_email(email: str, token: str) -> str:
+    """The token email for the given address, as a string with headers"""
+    # Create message
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = "葡萄酒智能助手 - 您的访问令牌"
+    msg['From'] = EMAIL_FROM
+    msg['To'] = email
+    
+    # Create plain text version
+    text = f"""
 您好，
 
 这是您请求的葡萄酒智能助手访问令牌：
@@ -228,71 +232,53 @@ def send_token_email(email: str, token: str) -> Tuple[bool, str]:
 
 谢谢！
 葡萄酒智能助手团队
-        """
-        
-        # Create HTML version
-        html = f"""
+    """
+    
+    # Create HTML version
+    html = f"""
 <!DOCTYPE html>
 <html>
 <head>
-    <meta charset="UTF-8">
-    <style>
-        body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
-        .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
-        .header {{ color: #722f37; text-align: center; padding-bottom: 20px; border-bottom: 1px solid #eee; }}
-        .content {{ padding: 20px 0; }}
-        .token {{ font-size: 24px; font-weight: bold; text-align: center; 
-                 padding: 15px; margin: 20px 0; color: #722f37; 
-                 border: 1px dashed #ccc; background-color: #f9f9f9; }}
-        .footer {{ padding-top: 20px; border-top: 1px solid #eee; font-size: 12px; color: #777; }}
-    </style>
+<meta charset="UTF-8">
+<style>
+    body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
+    .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
+    .header {{ color: #722f37; text-align: center; padding-bottom: 20px; border-bottom: 1px solid #eee; }}
+    .content {{ padding: 20px 0; }}
+    .token {{ font-size: 24px; font-weight: bold; text-align: center; 
+             padding: 15px; margin: 20px 0; color: #722f37; 
+             border: 1px dashed #ccc; background-color: #f9f9f9; }}
+    .footer {{ padding-top: 20px; border-top: 1px solid #eee; font-size: 12px; color: #777; }}
+</style>
 </head>
 <body>
-    <div class="container">
-        <div class="header">
-            <h1>葡萄酒智能助手</h1>
-        </div>
-        <div class="content">
-            <p>您好，</p>
-            <p>这是您请求的葡萄酒智能助手访问令牌：</p>
-            <div class="token">{token}</div>
-            <p>此令牌有效期为 {TOKEN_EXPIRY_HOURS} 小时。</p>
-            <p>请使用此令牌访问葡萄酒智能助手。</p>
-        </div>
-        <div class="footer">
-            <p>此邮件由系统自动发送，请勿回复。</p>
-            <p>© 葡萄酒智能助手团队</p>
-        </div>
+<div class="container">
+    <div class="header">
+        <h1>葡萄酒智能助手</h1>
+    </div>
+    <div class="content">
+        <p>您好，</p>
+        <p>这是您请求的葡萄酒智能助手访问令牌：</p>
+        <div class="token">{token}</div>
+        <p>此令牌有效期为 {TOKEN_EXPIRY_HOURS} 小时。</p>
+        <p>请使用此令牌访问葡萄酒智能助手。</p>
+    </div>
+    <div class="footer">
+        <p>此邮件由系统自动发送，请勿回复。</p>
+        <p>© 葡萄酒智能助手团队</p>
     </div>
+</div>
 </body>
 </html>
-        """
-        
-        # Attach parts
-        part1 = MIMEText(text, 'plain')
-        part2 = MIMEText(html, 'html')
-        msg.attach(part1)
-        msg.attach(part2)
-        
-        # Setup server connection
-        server = smtplib.SMTP(EMAIL_HOST, EMAIL_PORT)
-        if EMAIL_USE_TLS:
-            server.starttls()
-        
-        # Login if credentials are provided
-        if EMAIL_USER and EMAIL_PASSWORD:
-            server.login(EMAIL_USER, EMAIL_PASSWORD)
-        
-        # Send email
-        server.sendmail(EMAIL_FROM, email, msg.as_string())
-        server.quit()
-        
-        logger.info(f"Successfully sent token email to {email}")
-        return (True, "email")
-        
-    except Exception as e:
-        logger.error(f"Failed to send email to {email}: {e}")
-        return (False, "display")
+    """
+    
+    # Attach parts
+    part1 = MIMEText(text, 'plain')
+    part2 = MIMEText(html, 'html')
+    msg.attach(part1)
+    msg.attach(part2)
+    
+    return msg.as_string()
 
 # Get all tokens for an email
 def get_tokens_for_email(email: str) -> List[Dict]:
@@ -303,20 +289,16 @@ def get_tokens_for_email(email: str) -> List[Dict]:
     result = []
     
     # Check active tokens
-    active_tokens = load_tokens()
-    for t in active_tokens:
-        if t.get("email") == email:
-            t_copy = t.copy()
-            t_copy["status"] = "active"
-            result.append(t_copy)
+    for t in _get_store().tokens_for_email(email):
+        t_copy = t.copy()
+        t_copy["status"] = "active"
+        result.append(t_copy)
     
     # Check expired tokens
-    expired_tokens = load_expired_tokens()
-    for t in expired_tokens:
-        if t.get("email") == email:
-            t_copy = t.copy()
-            t_copy["status"] = "expired"
-            result.append(t_copy)
+    for t in _get_backend().expired_for_email(email):
+        t_copy = t.copy()
+        t_copy["status"] = "expired"
+        result.append(t_copy)
     
     # Sort by creation time (newest first)
     result.sort(key=lambda x: x.get("created", 0), reverse=True)
@@ -328,15 +310,15 @@ def get_token_history(limit: int = 50) -> List[Dict]:
     """Get token usage history (most recent tokens first)"""
     result = []
     
-    # Get active tokens
-    active_tokens = load_tokens()
+    # Get the newest active tokens (a partial selection, not a full sort)
+    active_tokens = heapq.nlargest(limit, _get_store().records(), key=lambda x: x.get("created", 0))
     for t in active_tokens:
         t_copy = t.copy()
         t_copy["status"] = "active"
         result.append(t_copy)
     
-    # Get expired tokens
-    expired_tokens = load_expired_tokens()
+    # Get the newest expired tokens (an indexed LIMIT query with the sqlite backend)
+    expired_tokens = _get_backend().expired_history(limit)
     for t in expired_tokens:
         t_copy = t.copy()
         t_copy["status"] = "expired"
@@ -354,18 +336,13 @@ def clear_old_expired_tokens(days: int = 90) -> int:
     Clear expired tokens older than the specified number of days
     Returns the number of tokens cleared
     """
-    expired_tokens = load_expired_tokens()
     current_time = int(time.time())
     cutoff_time = current_time - (days * 24 * 3600)
     
-    # Filter out tokens older than cutoff
-    new_expired_tokens = [t for t in expired_tokens if t.get("expired_at", 0) > cutoff_time]
-    
-    # Calculate how many were removed
-    tokens_cleared = len(expired_tokens) - len(new_expired_tokens)
+    # Drop archived tokens that expired before the cutoff
+    tokens_cleared = _get_backend().clear_expired_before(cutoff_time)
     
     if tokens_cleared > 0:
         logger.info(f"Cleared {tokens_cleared} expired tokens older than {days} days")
-        save_expired_tokens(new_expired_tokens)
     
     return tokens_cleared 
\ No newline at end of file
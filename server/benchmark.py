@@ -0,0 +1,417 @@
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+import shutil
+import tempfile
+import logging
+from types import SimpleNamespace
+import logger
+import rag_utils
+from rag_utils import build_index, retrieve_context, retrieve_contexts, load_knowledge_index
+from knowledge_index import query_terms
+from sparse_engine import SparseRetrievalEngine
+from lsh_index import LSHIndex, hashed_features, LSH_TABLES, LSH_BITS
+
+# Keep per-query INFO logging out of the timings
+logging.getLogger("wine-ai").setLevel(logging.WARNING)
+
+SAMPLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "wine_basics.md")
+SAMPLE_QUERIES = [
+    "What is Merlot?",
+    "赤霞珠的特点",
+    "Which wine goes with grilled steak?",
+    "Champagne serving temperature",
+    "Tell me about wine regions in France",
+    "Pinot Noir tannins",
+]
+
+
+def synthetic_corpus(target_chars, seed=42):
+    """Builds a corpus of roughly `target_chars` characters by shuffling and perturbing the sample file."""
+    with open(SAMPLE_FILE, 'r', encoding='utf-8') as f:
+        base_lines = [line for line in f.read().splitlines() if line.strip()]
+    rng = random.Random(seed)
+    lines = []
+    total = 0
+    serial = 0
+    while total < target_chars:
+        line = f"{rng.choice(base_lines)} (variant {serial})"
+        lines.append(line)
+        total += len(line) + 1
+        serial += 1
+    return "\n".join(lines)
+
+
+def time_queries(fn, queries, repeat):
+    """Returns per-query latencies in milliseconds."""
+    latencies = []
+    for _ in range(repeat):
+        for query in queries:
+            start = time.perf_counter()
+            fn(query)
+            latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def bench_retrieval(args):
+    """Per-query latency of indexed retrieval as the corpus grows."""
+    print(f"Retrieval mode: {args.mode}")
+    print(f"{'corpus chars':>12} {'lines':>8} {'build s':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for size in args.sizes:
+        corpus = synthetic_corpus(size)
+        start = time.perf_counter()
+        index = build_index(corpus)
+        build_s = time.perf_counter() - start
+        latencies = time_queries(lambda q: retrieve_context(q, index, mode=args.mode, use_cache=False), SAMPLE_QUERIES, args.repeat)
+        p50 = statistics.median(latencies)
+        p95 = statistics.quantiles(latencies, n=20)[-1]
+        print(f"{size:>12} {len(index):>8} {build_s:>8.2f} {p50:>8.3f} {p95:>8.3f}")
+        if args.legacy:
+            legacy = time_queries(lambda q: retrieve_context(q, corpus, use_cache=False), SAMPLE_QUERIES[:1], 1)
+            print(f"{'':>12} legacy full scan: {legacy[0]:.1f} ms/query")
+
+
+def bench_engines(args):
+    """Python posting-list scoring vs the numpy sparse-matrix engine on the same corpus."""
+    corpus = synthetic_corpus(args.size)
+    index = build_index(corpus)
+    start = time.perf_counter()
+    index.sparse_engine = SparseRetrievalEngine(index)
+    print(f"{len(index)} lines, {len(index.chunks)} chunks; sparse matrix built in {time.perf_counter() - start:.2f}s")
+    print(f"{'mode':>6} {'engine':>7} {'p50 ms':>8} {'p95 ms':>8}  same results")
+    for mode in ("bm25", "chunk"):
+        results = {}
+        for engine in ("python", "numpy"):
+            latencies = time_queries(lambda q: retrieve_context(q, index, mode=mode, engine=engine, use_cache=False), SAMPLE_QUERIES, args.repeat)
+            results[engine] = [retrieve_context(q, index, mode=mode, engine=engine, use_cache=False) for q in SAMPLE_QUERIES]
+            same = sum(set(a) == set(b) for a, b in zip(results["python"], results[engine]))
+            print(f"{mode:>6} {engine:>7} {statistics.median(latencies):>8.3f} "
+                  f"{statistics.quantiles(latencies, n=20)[-1]:>8.3f}  {same}/{len(SAMPLE_QUERIES)}")
+
+    term_sets = [query_terms(q) for q in SAMPLE_QUERIES] * args.batch
+    start = time.perf_counter()
+    for terms in term_sets:
+        index.sparse_engine.top_k(index.sparse_engine.score(terms), 40)
+    loop_s = time.perf_counter() - start
+    start = time.perf_counter()
+    for _, scores in index.sparse_engine.score_batch(term_sets):
+        index.sparse_engine.top_k(scores, 40)
+    batch_s = time.perf_counter() - start
+    print(f"{len(term_sets)} queries: one-by-one {len(term_sets) / loop_s:.0f} q/s, batched {len(term_sets) / batch_s:.0f} q/s")
+
+
+def bench_lsh(args):
+    """Recall and latency of LSH chunk retrieval vs exact n-gram search and the BM25 chunk path."""
+    index = build_index(synthetic_corpus(args.size))
+    start = time.perf_counter()
+    lsh = LSHIndex(index, tables=args.tables, bits=args.bits)
+    print(f"{len(lsh)} chunks, {len(lsh.feature_ids)} features; LSH ({args.tables}x{args.bits} bits) built in {time.perf_counter() - start:.2f}s")
+
+    recalls = []
+    candidate_share = []
+    for query in SAMPLE_QUERIES:
+        exact = lsh.search(query, args.k, exact=True)
+        if not exact:
+            continue
+        approx = lsh.search(query, args.k, multiprobe=args.multiprobe)
+        # Tie-aware recall: an approximate hit counts if it scores at least the exact k-th similarity
+        threshold = exact[-1][1] - 1e-6
+        recalls.append(sum(score >= threshold for _, score in approx) / len(exact))
+        fids, vector = lsh._vectorize(hashed_features(query))
+        candidate_share.append(len(lsh.candidates(fids, vector, args.multiprobe)) / len(lsh))
+    print(f"recall@{args.k}: {statistics.mean(recalls):.2f}, candidates scored: {statistics.mean(candidate_share):.0%} of chunks")
+
+    print(f"{'path':>12} {'p50 ms':>8} {'p95 ms':>8}")
+    paths = {
+        "lsh": lambda q: lsh.search(q, args.k, multiprobe=args.multiprobe),
+        "exact": lambda q: lsh.search(q, args.k, exact=True),
+        "bm25 chunks": lambda q: retrieve_context(q, index, mode="chunk", engine="python", use_cache=False),
+    }
+    for name, fn in paths.items():
+        latencies = time_queries(fn, SAMPLE_QUERIES, args.repeat)
+        print(f"{name:>12} {statistics.median(latencies):>8.3f} {statistics.quantiles(latencies, n=20)[-1]:>8.3f}")
+
+
+def bench_ingest(args):
+    """Cold ingestion throughput of a many-file knowledge directory for different worker counts."""
+    corpus = synthetic_corpus(args.size).splitlines()
+    per_file = max(1, len(corpus) // args.files)
+    directory = tempfile.mkdtemp(prefix="wine-ai-ingest-")
+    try:
+        for number, start in enumerate(range(0, len(corpus), per_file)):
+            with open(os.path.join(directory, f"doc_{number:05d}.md"), "w", encoding="utf-8") as f:
+                f.write("\n".join(corpus[start:start + per_file]))
+        file_count = len(os.listdir(directory))
+        megabytes = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)) / (1024 * 1024)
+
+        print(f"{file_count} files, {megabytes:.2f} MB")
+        print(f"{'workers':>8} {'seconds':>8} {'files/s':>8} {'MB/s':>8}")
+        for workers in args.workers:
+            rag_utils.INGEST_WORKERS = workers
+            start = time.perf_counter()
+            load_knowledge_index(directory, snapshot_file=None)
+            elapsed = time.perf_counter() - start
+            print(f"{workers:>8} {elapsed:>8.2f} {file_count / elapsed:>8.1f} {megabytes / elapsed:>8.2f}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def stub_llm_client(latency):
+    """Stand-in for openai.AsyncOpenAI whose chat completions just sleep for `latency` seconds."""
+    async def create(**kwargs):
+        await asyncio.sleep(latency)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="stub answer"))])
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+def bench_concurrency(args):
+    """End-to-end /api/query throughput against a stubbed upstream LLM, by client concurrency."""
+    asyncio.run(_bench_concurrency(args))
+
+
+async def _bench_concurrency(args):
+    import httpx
+    import acl
+    import wine_server
+
+    directory = tempfile.mkdtemp(prefix="wine-ai-load-")
+    try:
+        acl.TOKEN_FILE = os.path.join(directory, "tokens.json")
+        acl.EXPIRED_TOKEN_FILE = os.path.join(directory, "expired_tokens.json")
+        acl.EXPIRED_TOKEN_DIR = os.path.join(directory, "expired_tokens")
+        acl.init_token_storage()
+        headers = {"X-API-Token": acl.create_token("load-test@example.com"), "X-Bypass-Cache": "1"}
+        if args.base_url:
+            from upstream import create_client
+            wine_server.client = create_client("stub", args.base_url)
+        else:
+            wine_server.client = stub_llm_client(args.latency)
+        wine_server.knowledge_base = build_index(synthetic_corpus(args.size))
+        rag_utils.llm_slots = asyncio.Semaphore(args.llm_concurrency)
+
+        transport = httpx.ASGITransport(app=wine_server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://wine-ai", timeout=None) as http:
+            upstream = f"upstream {args.base_url}" if args.base_url else f"upstream latency {args.latency * 1000:.0f} ms"
+            print(f"{upstream}, LLM_MAX_CONCURRENCY {args.llm_concurrency}")
+            print(f"{'clients':>8} {'q/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'coalesced':>9}")
+            for clients in args.clients:
+                latencies = []
+                coalesced = rag_utils.query_flights.stats()["coalesced"]
+
+                async def worker(worker_id):
+                    for n in range(args.requests // clients):
+                        # Distinct per worker and request, so concurrent requests are not coalesced into one
+                        query = f"{SAMPLE_QUERIES[(worker_id + n) % len(SAMPLE_QUERIES)]} {worker_id}-{n}"
+                        start = time.perf_counter()
+                        response = await http.get("/api/query", params={"query": query}, headers=headers)
+                        response.raise_for_status()
+                        latencies.append((time.perf_counter() - start) * 1000)
+
+                start = time.perf_counter()
+                await asyncio.gather(*(worker(i) for i in range(clients)))
+                elapsed = time.perf_counter() - start
+                print(f"{clients:>8} {len(latencies) / elapsed:>8.1f} {statistics.median(latencies):>8.1f} "
+                      f"{statistics.quantiles(latencies, n=20)[-1]:>8.1f} "
+                      f"{rag_utils.query_flights.stats()['coalesced'] - coalesced:>9}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_batch(args):
+    """Batch query API vs looping over /api/query: retrieval alone, then end-to-end against a stubbed upstream."""
+    asyncio.run(_bench_batch(args))
+
+
+async def _bench_batch(args):
+    import json
+    import httpx
+    import acl
+    import wine_server
+
+    index = build_index(synthetic_corpus(args.size))
+    rng = random.Random(7)
+    # Distinct queries, so neither the retrieval nor the answer cache helps either path
+    queries = [f"{rng.choice(SAMPLE_QUERIES)} {rng.choice(SAMPLE_QUERIES).split()[-1]} {n}" for n in range(args.queries)]
+
+    start = time.perf_counter()
+    for query in queries:
+        retrieve_context(query, index, use_cache=False)
+    looped = time.perf_counter() - start
+    start = time.perf_counter()
+    retrieve_contexts(queries, index, use_cache=False)
+    batched = time.perf_counter() - start
+    print(f"retrieval of {len(queries)} queries ({rag_utils.RETRIEVAL_MODE} mode, {len(index)} lines): "
+          f"looped {len(queries) / looped:.1f} q/s, batched {len(queries) / batched:.1f} q/s")
+
+    directory = tempfile.mkdtemp(prefix="wine-ai-batch-")
+    try:
+        acl.TOKEN_FILE = os.path.join(directory, "tokens.json")
+        acl.EXPIRED_TOKEN_FILE = os.path.join(directory, "expired_tokens.json")
+        acl.EXPIRED_TOKEN_DIR = os.path.join(directory, "expired_tokens")
+        acl.init_token_storage()
+        headers = {"X-API-Token": acl.create_token("load-test@example.com"), "X-Bypass-Cache": "1"}
+        wine_server.client = stub_llm_client(args.latency)
+        wine_server.knowledge_base = index
+        rag_utils.retrieval_cache.clear()
+
+        transport = httpx.ASGITransport(app=wine_server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://wine-ai", timeout=None) as http:
+            looped_queries = queries[:args.loop_queries]
+            start = time.perf_counter()
+            for query in looped_queries:
+                response = await http.get("/api/query", params={"query": query}, headers=headers)
+                response.raise_for_status()
+            looped = time.perf_counter() - start
+
+            rag_utils.retrieval_cache.clear()
+            answered = 0
+            start = time.perf_counter()
+            async with http.stream("POST", "/api/query/batch", json={"queries": queries}, headers=headers) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if line:
+                        answered += "answer" in json.loads(line)
+            batched = time.perf_counter() - start
+        print(f"end to end, upstream latency {args.latency * 1000:.0f} ms, BATCH_CONCURRENCY {rag_utils.BATCH_CONCURRENCY}: "
+              f"looped /api/query {len(looped_queries) / looped:.1f} q/s, "
+              f"/api/query/batch {answered / batched:.1f} q/s ({answered}/{len(queries)} answered)")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_tokens(args):
+    """Token store cost (startup load, create, flush, validate, admin queries, archiving, retention) by backend and token count."""
+    import acl
+
+    print(f"{'backend':>8} {'tokens':>8} {'load ms':>8} {'create us':>10} {'flush ms':>9} {'validate us':>12} "
+          f"{'history ms':>11} {'email ms':>9} {'lookup ms':>10} {'archive ms':>11} {'retention ms':>13}")
+    for backend in args.backends:
+        for count in args.counts:
+            directory = tempfile.mkdtemp(prefix="wine-ai-tokens-")
+            try:
+                acl.TOKEN_BACKEND = backend
+                acl.TOKEN_FILE = os.path.join(directory, "tokens.json")
+                acl.EXPIRED_TOKEN_FILE = os.path.join(directory, "expired_tokens.json")
+                acl.EXPIRED_TOKEN_DIR = os.path.join(directory, "expired_tokens")
+                acl.TOKEN_DB_FILE = os.path.join(directory, "tokens.db")
+                acl.TOKEN_WRITE_DELAY = 3600  # flushes are timed explicitly
+                acl.init_token_storage()
+                # Seed `count` active and `count` archived tokens directly through the backend
+                now = int(time.time())
+                active = [{"email": f"user{n}@example.com", "token": f"A{n:07d}", "expiry": now + 86400, "created": now - n}
+                          for n in range(count)]
+                acl.token_backend.write_active({t["token"]: t for t in active}, lambda: active)
+                # Archived tokens expired one every 10 minutes going back in time (100k: about two years)
+                acl.token_backend.archive_expired([{"email": f"user{n}@example.com", "token": f"E{n:07d}", "expiry": now - 600 * n,
+                                                    "created": now - 600 * n - 86400, "expired_at": now - 600 * n} for n in range(count)])
+
+                start = time.perf_counter()
+                acl.init_token_storage()
+                load_ms = (time.perf_counter() - start) * 1000
+
+                creates = 1000
+                start = time.perf_counter()
+                for n in range(creates):
+                    acl.create_token(f"new{n}@example.com")
+                create_us = (time.perf_counter() - start) * 1e6 / creates
+                start = time.perf_counter()
+                acl.flush_tokens()
+                flush_ms = (time.perf_counter() - start) * 1000
+
+                probes = [f"A{n:07d}" for n in random.Random(1).sample(range(count), min(count, 10000))]
+                start = time.perf_counter()
+                for token in probes:
+                    acl.validate_token(token)
+                validate_us = (time.perf_counter() - start) * 1e6 / len(probes)
+
+                start = time.perf_counter()
+                acl.get_token_history(50)
+                history_ms = (time.perf_counter() - start) * 1000
+                start = time.perf_counter()
+                acl.get_tokens_for_email(f"user{count // 2}@example.com")
+                email_ms = (time.perf_counter() - start) * 1000
+                start = time.perf_counter()
+                acl.get_email_for_token(f"E{count // 2:07d}")
+                lookup_ms = (time.perf_counter() - start) * 1000
+
+                expiring = [{"email": f"gone{n}@example.com", "token": f"G{n:07d}", "expiry": now, "created": now - 86400,
+                             "expired_at": now} for n in range(100)]
+                start = time.perf_counter()
+                acl.token_backend.archive_expired(expiring)
+                archive_ms = (time.perf_counter() - start) * 1000
+                start = time.perf_counter()
+                acl.clear_old_expired_tokens(90)
+                retention_ms = (time.perf_counter() - start) * 1000
+
+                print(f"{backend:>8} {count:>8} {load_ms:>8.1f} {create_us:>10.1f} {flush_ms:>9.1f} {validate_us:>12.2f} "
+                      f"{history_ms:>11.2f} {email_ms:>9.2f} {lookup_ms:>10.2f} {archive_ms:>11.2f} {retention_ms:>13.2f}")
+            finally:
+                acl.token_backend.close()
+                acl.token_store = acl.token_backend = None
+                shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Wine-AI performance benchmarks.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    retrieval_parser = subparsers.add_parser("retrieval", help=bench_retrieval.__doc__)
+    retrieval_parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    retrieval_parser.add_argument("--repeat", type=int, default=20)
+    retrieval_parser.add_argument("--mode", choices=["chunk", "bm25", "overlap"], default="chunk")
+    retrieval_parser.add_argument("--legacy", action="store_true", help="Also time re-tokenizing the corpus per query.")
+    retrieval_parser.set_defaults(func=bench_retrieval)
+
+    engines_parser = subparsers.add_parser("engines", help=bench_engines.__doc__)
+    engines_parser.add_argument("--size", type=int, default=1000000)
+    engines_parser.add_argument("--repeat", type=int, default=20)
+    engines_parser.add_argument("--batch", type=int, default=50, help="Repetitions of the sample queries for batch scoring.")
+    engines_parser.set_defaults(func=bench_engines)
+
+    lsh_parser = subparsers.add_parser("lsh", help=bench_lsh.__doc__)
+    lsh_parser.add_argument("--size", type=int, default=1000000)
+    lsh_parser.add_argument("--repeat", type=int, default=10)
+    lsh_parser.add_argument("--k", type=int, default=10)
+    lsh_parser.add_argument("--tables", type=int, default=LSH_TABLES)
+    lsh_parser.add_argument("--bits", type=int, default=LSH_BITS)
+    lsh_parser.add_argument("--no-multiprobe", dest="multiprobe", action="store_false",
+                            help="Only probe the query's own bucket in each table.")
+    lsh_parser.set_defaults(func=bench_lsh)
+
+    ingest_parser = subparsers.add_parser("ingest", help=bench_ingest.__doc__)
+    ingest_parser.add_argument("--size", type=int, default=5000000)
+    ingest_parser.add_argument("--files", type=int, default=500)
+    ingest_parser.add_argument("--workers", type=int, nargs="+", default=[1, os.cpu_count() or 1])
+    ingest_parser.set_defaults(func=bench_ingest)
+
+    concurrency_parser = subparsers.add_parser("concurrency", help=bench_concurrency.__doc__)
+    concurrency_parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16, 64])
+    concurrency_parser.add_argument("--requests", type=int, default=128, help="Queries per concurrency level.")
+    concurrency_parser.add_argument("--latency", type=float, default=0.2, help="Stubbed upstream latency in seconds.")
+    concurrency_parser.add_argument("--llm-concurrency", type=int, default=rag_utils.LLM_MAX_CONCURRENCY)
+    concurrency_parser.add_argument("--size", type=int, default=100000)
+    concurrency_parser.add_argument("--base-url", help="Call this OpenAI-compatible API (e.g. server/stub_llm.py) instead of an in-process stub.")
+    concurrency_parser.set_defaults(func=bench_concurrency)
+
+    batch_parser = subparsers.add_parser("batch", help=bench_batch.__doc__)
+    batch_parser.add_argument("--queries", type=int, default=500, help="Queries in the batch.")
+    batch_parser.add_argument("--loop-queries", type=int, default=50, help="Queries sent one at a time for comparison.")
+    batch_parser.add_argument("--latency", type=float, default=0.05, help="Stubbed upstream latency in seconds.")
+    batch_parser.add_argument("--size", type=int, default=1000000)
+    batch_parser.set_defaults(func=bench_batch)
+
+    tokens_parser = subparsers.add_parser("tokens", help=bench_tokens.__doc__)
+    tokens_parser.add_argument("--counts", type=int, nargs="+", default=[1000, 10000, 100000])
+    tokens_parser.add_argument("--backends", nargs="+", choices=["json", "sqlite"], default=["json", "sqlite"])
+    tokens_parser.set_defaults(func=bench_tokens)
+
+    args = parser.parse_args()
+    logger.info(f"Running benchmark: {args.command}")
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
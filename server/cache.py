@@ -0,0 +1,121 @@
+import os
+import sys
+import json
+import time
+import threading
+from collections import OrderedDict
+
+
+def approximate_size(value):
+    """Rough in-memory size of a cached value in bytes (strings, bytes and nested lists/tuples/dicts)."""
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(approximate_size(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(approximate_size(k) + approximate_size(v) for k, v in value.items())
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache with a per-entry TTL, bounded both by entry count and
+    by the approximate number of bytes held. Keeps hit/miss/eviction counters.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=32 * 1024 * 1024, ttl=600.0, sizeof=approximate_size):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self._entries = OrderedDict()  # key -> (value, size, expires_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the cached value, or None on a miss or an expired entry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, expires_at = entry
+            if self.ttl and time.monotonic() >= expires_at:
+                del self._entries[key]
+                self._bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        """Stores a value, evicting least recently used entries to stay within both limits."""
+        size = self.sizeof(key) + self.sizeof(value)
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def save(self, path):
+        """Persists unexpired entries as JSON (keys and values must be JSON-serializable). Returns the entry count."""
+        now_wall, now_mono = time.time(), time.monotonic()
+        with self._lock:
+            records = [
+                [key, value, now_wall + (expires_at - now_mono)]
+                for key, (value, _, expires_at) in self._entries.items()
+                if expires_at > now_mono
+            ]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(records, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        return len(records)
+
+    def load(self, path):
+        """Restores entries written by save(), oldest first, skipping expired ones. Returns the entry count."""
+        if not os.path.exists(path):
+            return 0
+        with open(path, "r", encoding="utf-8") as f:
+            records = json.load(f)
+        now = time.time()
+        loaded = 0
+        for key, value, expires_wall in records:
+            if expires_wall > now:
+                self.put(key, value, ttl=expires_wall - now)
+                loaded += 1
+        return loaded
@@ -0,0 +1,248 @@
+import os
+import time
+import random
+import asyncio
+import smtplib
+import itertools
+from collections import Counter, OrderedDict
+import logger
+from metrics import LatencyStats
+
+# --- Constants ---
+EMAIL_POOL_SIZE = int(os.getenv("EMAIL_POOL_SIZE", "2"))  # SMTP connections (and concurrent sends) kept open for reuse
+EMAIL_QUEUE_SIZE = int(os.getenv("EMAIL_QUEUE_SIZE", "1000"))  # Emails waiting to be sent; beyond it tokens are displayed instead
+EMAIL_TIMEOUT = float(os.getenv("EMAIL_TIMEOUT", "10"))  # Seconds for each SMTP connect or command
+EMAIL_MAX_RETRIES = int(os.getenv("EMAIL_MAX_RETRIES", "3"))  # Retries after a temporary failure (4xx reply, connection error, timeout)
+EMAIL_BACKOFF_BASE = float(os.getenv("EMAIL_BACKOFF_BASE", "2"))  # Seconds; doubles per retry, with full jitter
+EMAIL_BACKOFF_MAX = float(os.getenv("EMAIL_BACKOFF_MAX", "60"))  # Seconds
+EMAIL_STATUS_HISTORY = int(os.getenv("EMAIL_STATUS_HISTORY", "1000"))  # Most recent deliveries whose status is kept
+
+
+def _is_retryable(error):
+    """Temporary failures: 4xx replies, dropped connections, network errors and timeouts."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return not 500 <= error.smtp_code < 600
+    if isinstance(error, smtplib.SMTPNotSupportedError):
+        return False
+    return isinstance(error, (smtplib.SMTPException, OSError))
+
+
+def _server_closed(error):
+    """Whether `error` means the server closed the connection (e.g. after an idle timeout)."""
+    return isinstance(error, smtplib.SMTPServerDisconnected) or getattr(error, "smtp_code", None) == 421
+
+
+def _connection_usable_after(error):
+    """Whether the SMTP session is still in a known state after `error` (the server refused one message)."""
+    if _server_closed(error):
+        return False
+    return isinstance(error, (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError))
+
+
+class _Slot:
+    """One pooled SMTP connection, used by one worker at a time."""
+
+    def __init__(self):
+        self.connection = None
+
+
+class EmailQueue:
+    """
+    Sends emails from a background queue over a small pool of reused SMTP connections.
+
+    submit() only enqueues, so request handlers never wait for the mail server.
+    Each of `pool_size` worker tasks owns one connection, opened (with STARTTLS
+    and login) on first use and kept open across emails; a connection the server
+    has closed meanwhile is reopened once without counting as a failure. smtplib
+    is blocking, so each send runs in a thread. Temporary failures are retried
+    with jittered exponential backoff, outside the pool so other emails are not
+    held up; permanent ones (5xx) are not. The status of the most recent
+    deliveries is kept for GET /admin/emails.
+    """
+
+    def __init__(self, host, port, user, password, use_tls, sender, pool_size=EMAIL_POOL_SIZE,
+                 queue_size=EMAIL_QUEUE_SIZE, max_retries=EMAIL_MAX_RETRIES, history=EMAIL_STATUS_HISTORY):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.use_tls = use_tls
+        self.sender = sender
+        self.pool_size = max(1, pool_size)
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.history = history
+        self.counters = Counter()  # submitted, sent, failed, retries, connections_opened, reconnects
+        self.delivery_time = LatencyStats()  # Submitted -> accepted by the mail server
+        self._deliveries = OrderedDict()  # delivery id -> status record, oldest first
+        self._ids = itertools.count(1)
+        self._queue = None
+        self._slots = []
+        self._workers = []
+        self._retries = set()  # Tasks waiting out a backoff before re-queueing
+
+    @property
+    def running(self):
+        return bool(self._workers)
+
+    def start(self):
+        """Starts the workers; call from the event loop."""
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._slots = [_Slot() for _ in range(self.pool_size)]
+        self._workers = [asyncio.create_task(self._work(slot)) for slot in self._slots]
+        logger.info(f"Email queue started: {self.pool_size} SMTP connections to {self.host}:{self.port}")
+
+    async def stop(self, timeout=10.0):
+        """Waits up to `timeout` seconds for queued emails to be sent, then stops the workers and closes the connections."""
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Email queue stopped with {self._queue.qsize()} emails unsent")
+        for task in list(self._retries) + self._workers:
+            task.cancel()
+        await asyncio.gather(*self._retries, *self._workers, return_exceptions=True)
+        self._workers = []
+        for slot in self._slots:
+            await asyncio.to_thread(self._close, slot)
+
+    def submit(self, recipient, message):
+        """
+        Queues `message` (a string with headers) for `recipient` and returns its delivery id.
+        Raises asyncio.QueueFull if the queue is full and RuntimeError if it isn't started.
+        """
+        if not self.running:
+            raise RuntimeError("Email queue is not running")
+        delivery = {"id": next(self._ids), "email": recipient, "status": "queued", "attempts": 0,
+                    "queued_at": int(time.time()), "sent_at": None, "error": None}
+        self._queue.put_nowait((delivery, message, time.perf_counter()))
+        self._deliveries[delivery["id"]] = delivery
+        while len(self._deliveries) > self.history:
+            self._deliveries.popitem(last=False)
+        self.counters["submitted"] += 1
+        return delivery["id"]
+
+    async def _work(self, slot):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._attempt(slot, *job)
+            except Exception as e:
+                logger.error(f"Email worker error: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _attempt(self, slot, delivery, message, submitted):
+        delivery["status"] = "sending"
+        delivery["attempts"] += 1
+        try:
+            await asyncio.to_thread(self._send, slot, delivery["email"], message)
+        except Exception as e:
+            delivery["error"] = f"{type(e).__name__}: {e}"
+            if _is_retryable(e) and delivery["attempts"] <= self.max_retries:
+                delay = random.uniform(0, min(EMAIL_BACKOFF_MAX, EMAIL_BACKOFF_BASE * 2 ** (delivery["attempts"] - 1)))
+                delivery["status"] = "retrying"
+                self.counters["retries"] += 1
+                logger.warning(f"Email to {delivery['email']} failed ({delivery['error']}); "
+                               f"retry {delivery['attempts']}/{self.max_retries} in {delay:.1f}s.")
+                task = asyncio.create_task(self._retry_later(delay, (delivery, message, submitted)))
+                self._retries.add(task)
+                task.add_done_callback(self._retries.discard)
+            else:
+                delivery["status"] = "failed"
+                self.counters["failed"] += 1
+                logger.error(f"Failed to send email to {delivery['email']} after {delivery['attempts']} attempts: {delivery['error']}")
+            return
+        delivery["status"] = "sent"
+        delivery["sent_at"] = int(time.time())
+        delivery["error"] = None
+        self.counters["sent"] += 1
+        self.delivery_time.record((time.perf_counter() - submitted) * 1000)
+        logger.info(f"Successfully sent email {delivery['id']} to {delivery['email']}")
+
+    async def _retry_later(self, delay, job):
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            job[0]["status"] = "failed"
+            self.counters["failed"] += 1
+            raise
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            delivery = job[0]
+            delivery["status"] = "failed"
+            self.counters["failed"] += 1
+            logger.error(f"Email to {delivery['email']} dropped: queue full when retrying")
+
+    def _connect(self):
+        connection = smtplib.SMTP(self.host, self.port, timeout=EMAIL_TIMEOUT)
+        try:
+            if self.use_tls:
+                connection.starttls()
+            if self.user and self.password:
+                connection.login(self.user, self.password)
+        except BaseException:
+            connection.close()
+            raise
+        self.counters["connections_opened"] += 1
+        return connection
+
+    def _send(self, slot, recipient, message):
+        """Sends over the slot's connection, opening it if needed. Runs in a thread."""
+        reused = slot.connection is not None
+        if not reused:
+            slot.connection = self._connect()
+        try:
+            try:
+                slot.connection.sendmail(self.sender, [recipient], message)
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException) as e:
+                if not reused or not _server_closed(e):
+                    raise
+                # The server closed the pooled connection while it was idle
+                self._close(slot)
+                self.counters["reconnects"] += 1
+                slot.connection = self._connect()
+                slot.connection.sendmail(self.sender, [recipient], message)
+        except Exception as e:
+            if not _connection_usable_after(e):
+                self._close(slot)
+            raise
+
+    @staticmethod
+    def _close(slot):
+        connection, slot.connection = slot.connection, None
+        if connection is None:
+            return
+        try:
+            connection.quit()
+        except Exception:
+            connection.close()
+
+    def deliveries(self, email=None, limit=50):
+        """Status records of the most recent deliveries (optionally to one address), newest first."""
+        found = []
+        for delivery in reversed(self._deliveries.values()):
+            if email is None or delivery["email"] == email:
+                found.append(dict(delivery))
+                if len(found) >= limit:
+                    break
+        return found
+
+    def stats(self):
+        statuses = Counter(delivery["status"] for delivery in self._deliveries.values())
+        return {
+            "running": self.running,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "retry_pending": len(self._retries),
+            "connections_open": sum(slot.connection is not None for slot in self._slots),
+            **{name: self.counters[name] for name in
+               ("submitted", "sent", "failed", "retries", "connections_opened", "reconnects")},
+            "recent_statuses": dict(statuses),
+            "delivery_time": self.delivery_time.stats(),
+        }
@@ -0,0 +1,167 @@
+import os
+import sys
+import json
+import mmap
+import struct
+from array import array
+import logger
+from knowledge_index import SegmentedDocument
+
+# --- Constants ---
+SNAPSHOT_MAGIC = b"WAIX"
+SNAPSHOT_VERSION = 1
+_PREAMBLE = struct.Struct("<4sII")  # magic, format version, metadata length
+_UINT32 = 'I'
+
+# File layout (all arrays native uint32, 4-byte aligned):
+#   preamble | metadata JSON (padded) | text offsets | token offsets | token ids | line text (UTF-8)
+# Metadata holds the per-file table (source, mtime, size, sha1, line range) and the vocabulary.
+
+
+def save_snapshot(snapshot_file, documents):
+    """Writes segmented documents to a compact binary snapshot. Returns True on success."""
+    vocab = {}
+    text = bytearray()
+    text_offsets = array(_UINT32, [0])
+    token_offsets = array(_UINT32, [0])
+    token_ids = array(_UINT32)
+    files = []
+    line_count = 0
+
+    for doc in documents:
+        files.append({
+            "source": doc.source,
+            "mtime_ns": doc.mtime_ns,
+            "size": doc.size,
+            "sha1": doc.sha1,
+            "chars": doc.chars,
+            "first_line": line_count,
+            "line_count": len(doc.lines),
+        })
+        for line, tokens in zip(doc.lines, doc.tokens):
+            text += line.encode('utf-8')
+            text_offsets.append(len(text))
+            for token in tokens:
+                token_ids.append(vocab.setdefault(token, len(vocab)))
+            token_offsets.append(len(token_ids))
+            line_count += 1
+
+    metadata = json.dumps({
+        "byteorder": sys.byteorder,
+        "line_count": line_count,
+        "token_count": len(token_ids),
+        "files": files,
+        "vocab": list(vocab),
+    }, ensure_ascii=False).encode('utf-8')
+    metadata += b" " * (-len(metadata) % 4)
+
+    tmp_file = f"{snapshot_file}.tmp"
+    try:
+        with open(tmp_file, "wb") as f:
+            f.write(_PREAMBLE.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(metadata)))
+            f.write(metadata)
+            text_offsets.tofile(f)
+            token_offsets.tofile(f)
+            token_ids.tofile(f)
+            f.write(text)
+        os.replace(tmp_file, snapshot_file)
+        logger.info(f"Index snapshot saved to {snapshot_file} ({len(files)} files, {line_count} lines).")
+        return True
+    except Exception as e:
+        logger.error(f"Error saving index snapshot {snapshot_file}: {e}")
+        return False
+
+
+class IndexSnapshot:
+    """
+    Read-only, memory-mapped view of a snapshot written by save_snapshot.
+
+    Only the metadata is parsed on open; line text and token ids are decoded
+    from the mapping when a document is actually requested.
+    """
+
+    def __init__(self, snapshot_file):
+        self._file = open(snapshot_file, "rb")
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        self._views = []
+        try:
+            self._parse()
+        except Exception:
+            self.close()
+            raise
+
+    def _parse(self):
+        magic, version, metadata_len = _PREAMBLE.unpack_from(self._mmap, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported snapshot format ({magic!r}, v{version})")
+        offset = _PREAMBLE.size
+        metadata = json.loads(bytes(self._mmap[offset:offset + metadata_len]).decode('utf-8'))
+        if metadata["byteorder"] != sys.byteorder:
+            raise ValueError("snapshot was written on a machine with a different byte order")
+        offset += metadata_len
+
+        line_count = metadata["line_count"]
+        token_count = metadata["token_count"]
+        self._text_offsets = self._uint32_view(offset, line_count + 1)
+        offset += (line_count + 1) * 4
+        self._token_offsets = self._uint32_view(offset, line_count + 1)
+        offset += (line_count + 1) * 4
+        self._token_ids = self._uint32_view(offset, token_count)
+        offset += token_count * 4
+        self._text_start = offset
+
+        self.vocab = metadata["vocab"]
+        self.files = {entry["source"]: entry for entry in metadata["files"]}
+
+    def _uint32_view(self, offset, count):
+        view = memoryview(self._mmap)[offset:offset + count * 4].cast(_UINT32)
+        self._views.append(view)
+        return view
+
+    def get(self, source):
+        """Returns the stored file entry for `source`, or None."""
+        return self.files.get(source)
+
+    def read_document(self, entry):
+        """Decodes one file's lines and tokens from the mapping into a SegmentedDocument."""
+        lines = []
+        tokens = []
+        vocab = self.vocab
+        for line_id in range(entry["first_line"], entry["first_line"] + entry["line_count"]):
+            start = self._text_start + self._text_offsets[line_id]
+            end = self._text_start + self._text_offsets[line_id + 1]
+            lines.append(self._mmap[start:end].decode('utf-8'))
+            ids = self._token_ids[self._token_offsets[line_id]:self._token_offsets[line_id + 1]]
+            tokens.append([vocab[token_id] for token_id in ids])
+        return SegmentedDocument(
+            entry["source"], lines, tokens,
+            mtime_ns=entry["mtime_ns"], size=entry["size"], sha1=entry["sha1"], chars=entry["chars"],
+        )
+
+    def close(self):
+        for view in self._views:
+            view.release()
+        self._views = []
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def load_snapshot(snapshot_file):
+    """Opens a snapshot if one exists and is readable. Returns an IndexSnapshot or None."""
+    if not snapshot_file or not os.path.exists(snapshot_file):
+        return None
+    try:
+        return IndexSnapshot(snapshot_file)
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable index snapshot {snapshot_file}: {e}")
+        return None
@@ -0,0 +1,94 @@
+import os
+import time
+import hashlib
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import jieba
+import logger
+from knowledge_index import segment_document
+
+# --- Constants ---
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 1)))  # 1 segments in-process
+PARALLEL_MIN_FILES = 16  # Below this a process pool costs more to start than it saves
+QUEUE_DEPTH_PER_WORKER = 2  # Bound on files in flight per worker
+
+
+class IngestTask:
+    """One file that needs reading and (unless its content is unchanged) segmenting."""
+
+    __slots__ = ("filepath", "relpath", "mtime_ns", "size", "known_sha1")
+
+    def __init__(self, filepath, relpath, mtime_ns, size, known_sha1=None):
+        self.filepath = filepath
+        self.relpath = relpath
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.known_sha1 = known_sha1  # hash of the copy we already have, if any
+
+
+def read_and_segment(task):
+    """
+    Reads and hashes one file and segments it into a SegmentedDocument.
+    Returns (sha1, document); document is None when the hash equals task.known_sha1.
+    """
+    with open(task.filepath, 'rb') as f:
+        raw = f.read()
+    sha1 = hashlib.sha1(raw).hexdigest()
+    if sha1 == task.known_sha1:
+        return sha1, None
+    content = raw.decode('utf-8')
+    doc = segment_document(
+        task.relpath, f"# Source: {task.relpath}\n\n{content}",
+        mtime_ns=task.mtime_ns, size=task.size, sha1=sha1, chars=len(content),
+    )
+    return sha1, doc
+
+
+def _init_worker():
+    jieba.setLogLevel(logging.WARNING)
+    jieba.initialize()
+
+
+def _safe_read_and_segment(task):
+    try:
+        return read_and_segment(task)
+    except Exception as e:
+        return e
+
+
+def ingest_files(tasks, workers=INGEST_WORKERS):
+    """
+    Reads and segments files, fanning out across a process pool when there are enough of them.
+
+    Yields one result per task, in task order: (sha1, document) as from
+    read_and_segment, or the exception raised. At most
+    `workers * QUEUE_DEPTH_PER_WORKER` files are in flight or waiting to be
+    consumed at once, so memory stays bounded however many files are queued.
+    """
+    start = time.perf_counter()
+    if workers <= 1 or len(tasks) < PARALLEL_MIN_FILES:
+        workers = 1
+        for task in tasks:
+            yield _safe_read_and_segment(task)
+    else:
+        window = workers * QUEUE_DEPTH_PER_WORKER
+        in_flight = deque()
+        # spawn: the server may be multi-threaded (reloads run in worker threads), which fork is not safe with
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker) as pool:
+            for task in tasks:
+                if len(in_flight) >= window:
+                    yield in_flight.popleft().result()
+                in_flight.append(pool.submit(_safe_read_and_segment, task))
+            while in_flight:
+                yield in_flight.popleft().result()
+
+    if tasks:
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        megabytes = sum(task.size for task in tasks) / (1024 * 1024)
+        logger.info(
+            f"Ingested {len(tasks)} files ({megabytes:.2f} MB) in {elapsed:.2f}s with {workers} worker(s): "
+            f"{len(tasks) / elapsed:.1f} files/s, {megabytes / elapsed:.2f} MB/s."
+        )
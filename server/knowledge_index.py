@@ -0,0 +1,379 @@
+import os
+import re
+import math
+import heapq
+import itertools
+import jieba
+
+# Serialized prefix dictionary; jieba rebuilds it from its 5 MB word list (~1s) only when this file is missing
+JIEBA_CACHE_FILE = os.getenv("JIEBA_CACHE_FILE", "server/jieba.cache")
+if JIEBA_CACHE_FILE:
+    jieba.dt.cache_file = os.path.abspath(JIEBA_CACHE_FILE)
+
+# Combined Chinese and English stopwords (applied to queries only)
+CHINESE_STOP_WORDS = set([
+    '的', '了', '和', '是', '就', '都', '而', '及', '与', '这', '那', '有', '在',
+    '中', '上', '下', '由', '为', '以', '到', '等', '让', '向', '又', '但', '如',
+    '或', '所', '因', '于', '只', '从', '给', '被', '得', '地', '着', '把', '之'
+])
+
+ENGLISH_STOP_WORDS = set([
+    'i', 'me', 'my', 'myself', 'we', 'our', 'ours', 'ourselves', 'you', 'your',
+    'yours', 'yourself', 'yourselves', 'he', 'him', 'his', 'himself', 'she', 'her',
+    'hers', 'herself', 'it', 'its', 'itself', 'they', 'them', 'their', 'theirs',
+    'themselves', 'what', 'which', 'who', 'whom', 'this', 'that', 'these', 'those',
+    'am', 'is', 'are', 'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had',
+    'having', 'do', 'does', 'did', 'doing', 'a', 'an', 'the', 'and', 'but', 'if',
+    'or', 'because', 'as', 'until', 'while', 'of', 'at', 'by', 'for', 'with',
+    'about', 'against', 'between', 'into', 'through', 'during', 'before', 'after',
+    'above', 'below', 'to', 'from', 'up', 'down', 'in', 'out', 'on', 'off', 'over',
+    'under', 'again', 'further', 'then', 'once', 'here', 'there', 'when', 'where',
+    'why', 'how', 'all', 'any', 'both', 'each', 'few', 'more', 'most', 'other',
+    'some', 'such', 'no', 'nor', 'not', 'only', 'own', 'same', 'so', 'than', 'too',
+    'very', 's', 't', 'can', 'will', 'just', 'don', 'should', 'now'
+])
+
+STOP_WORDS = CHINESE_STOP_WORDS.union(ENGLISH_STOP_WORDS)
+
+_PUNCTUATION_RE = re.compile(r'^\W+$')
+_HEADING_RE = re.compile(r'^(#{1,6})\s+(.+?)\s*#*\s*$')
+# CJK ideographs, kana, hangul and full-width punctuation: roughly one LLM token each
+_CJK_RE = re.compile(r'[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+_STAMPS = itertools.count(1)
+
+# Sections longer than this are split into several chunks sharing one heading path
+CHUNK_MAX_CHARS = 1500
+
+# Once less than this much of the token budget is left, context packing stops looking for snippets that fit
+MIN_SNIPPET_TOKENS = 16
+# ... and after this many consecutive ranked snippets that do not fit
+MAX_PACK_MISSES = 20
+
+# Okapi BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def warm_up_tokenizer():
+    """Loads jieba's prefix dictionary now instead of on the first query that needs segmenting."""
+    jieba.initialize()
+
+def estimate_tokens(text):
+    """
+    Estimates the LLM tokens in `text` without a tokenizer model: one per CJK
+    character and one per four other characters (typical of BPE on English).
+    """
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def tokenize(text):
+    """Segments mixed Chinese/English text with jieba, dropping whitespace and pure punctuation."""
+    tokens = []
+    for token in jieba.cut(text.lower()):
+        if not token.strip() or _PUNCTUATION_RE.match(token):
+            continue
+        tokens.append(token)
+    return tokens
+
+
+def query_terms(query):
+    """Returns the set of searchable terms in a query (tokenized, stopwords removed)."""
+    return set(token for token in tokenize(query) if token not in STOP_WORDS)
+
+
+class SegmentedDocument:
+    """
+    A knowledge file split into non-empty lines, each with its tokens.
+
+    Segmentation is the expensive part of indexing, so documents are the unit
+    that gets cached on disk and reused when the underlying file is unchanged.
+    """
+
+    def __init__(self, source, lines, tokens, mtime_ns=0, size=0, sha1="", chars=0):
+        self.source = source      # path relative to the knowledge directory
+        self.lines = lines
+        self.tokens = tokens      # one token list per line
+        self.mtime_ns = mtime_ns
+        self.size = size          # file size in bytes
+        self.sha1 = sha1          # hex digest of the file content
+        self.chars = chars        # characters of content, for load statistics
+
+
+def segment_document(source, text, **file_info):
+    """Tokenizes every non-empty line of `text` into a SegmentedDocument."""
+    lines = [line for line in text.splitlines() if line.strip()]
+    tokens = [tokenize(line.strip()) for line in lines]
+    return SegmentedDocument(source, lines, tokens, **file_info)
+
+
+class Chunk:
+    """A heading-scoped section of a document, stored as a range of line ids in the index."""
+
+    __slots__ = ("source", "heading_path", "first_line", "end_line", "chars")
+
+    def __init__(self, source, heading_path, first_line, end_line, chars):
+        self.source = source
+        self.heading_path = heading_path  # tuple of enclosing heading titles, outermost first
+        self.first_line = first_line      # first line id (inclusive)
+        self.end_line = end_line          # last line id (exclusive)
+        self.chars = chars                # length of the chunk's lines, newlines included
+
+
+class KnowledgeIndex:
+    """
+    Inverted index over the lines of the knowledge base, grouped into heading-scoped chunks.
+
+    Every line is segmented once when it is added; lookups only touch the
+    posting lists of the query's own terms, so query cost no longer grows
+    with the size of the corpus.
+    """
+
+    def __init__(self):
+        self.lines = []         # line id -> original line text
+        self.line_lengths = []  # line id -> number of tokens
+        self.postings = {}      # term -> ascending list of line ids
+        self.term_freqs = {}    # term -> term frequency per posting (parallel to postings)
+        self.idf = {}           # term -> BM25 inverse document frequency, see finalize()
+        self.avg_line_length = 0.0
+        self.chunks = []        # chunk id -> Chunk
+        self.line_chunks = []   # line id -> chunk id
+        self.documents = {}     # source -> SegmentedDocument, reused by incremental reloads
+        self.version = 0        # bumped by the server each time a reloaded index is swapped in
+        self.stamp = next(_STAMPS)  # unique per index object; keys cached results to this exact version
+        self.sparse_engine = None  # optional vectorized scorer, see sparse_engine.py
+        self.lsh_index = None      # optional approximate n-gram retrieval, see lsh_index.py
+        self.minhash = None        # optional near-duplicate signatures for context packing, see minhash.py
+        self._line_token_prefix = None  # prefix sums of estimated tokens per line, built on first pack
+
+    def __len__(self):
+        return len(self.lines)
+
+    def add_line(self, line, tokens=None):
+        """Adds a line to the index. Lines without any searchable token are skipped."""
+        if tokens is None:
+            tokens = tokenize(line.strip())
+        if not tokens:
+            return
+        line_id = len(self.lines)
+        self.lines.append(line)
+        self.line_lengths.append(len(tokens))
+        counts = {}
+        for term in tokens:
+            counts[term] = counts.get(term, 0) + 1
+        for term, count in counts.items():
+            self.postings.setdefault(term, []).append(line_id)
+            self.term_freqs.setdefault(term, []).append(count)
+
+    def add_document(self, document):
+        """
+        Adds every line of a pre-segmented document without re-tokenizing it.
+
+        Lines are grouped into chunks at each markdown heading; every chunk records
+        the path of headings above it, so it can be returned with its context.
+        """
+        self.documents[document.source] = document
+        headings = []  # (level, title) stack
+        heading_path = ()
+        chunk_start = len(self.lines)
+        chunk_chars = 0
+        for line, tokens in zip(document.lines, document.tokens):
+            match = _HEADING_RE.match(line.strip())
+            if match or (chunk_chars + len(line) > CHUNK_MAX_CHARS and len(self.lines) > chunk_start):
+                self._close_chunk(document.source, heading_path, chunk_start, chunk_chars)
+                chunk_start = len(self.lines)
+                chunk_chars = 0
+            if match:
+                level = len(match.group(1))
+                headings = [h for h in headings if h[0] < level] + [(level, match.group(2))]
+                heading_path = tuple(title for _, title in headings)
+            line_count = len(self.lines)
+            self.add_line(line, tokens)
+            if len(self.lines) > line_count:
+                chunk_chars += len(line) + 1
+        self._close_chunk(document.source, heading_path, chunk_start, chunk_chars)
+
+    def _close_chunk(self, source, heading_path, first_line, chars):
+        end_line = len(self.lines)
+        if end_line > first_line:
+            self.line_chunks.extend([len(self.chunks)] * (end_line - first_line))
+            self.chunks.append(Chunk(source, heading_path, first_line, end_line, chars))
+
+    def chunk_text(self, chunk_id):
+        """Renders a chunk with a breadcrumb of its source file and enclosing headings."""
+        chunk = self.chunks[chunk_id]
+        lines = self.lines[chunk.first_line:chunk.end_line]
+        ancestors = chunk.heading_path
+        if ancestors and _HEADING_RE.match(lines[0].strip()):
+            ancestors = ancestors[:-1]  # the chunk starts with its own heading
+        breadcrumb = ((chunk.source,) if chunk.source else ()) + ancestors
+        if breadcrumb and not lines[0].startswith("# Source:"):
+            lines = [f"[{' > '.join(breadcrumb)}]"] + lines
+        return "\n".join(lines)
+
+    def finalize(self):
+        """Precomputes corpus statistics for BM25. Call after the last add_line."""
+        n = len(self.lines)
+        self.avg_line_length = (sum(self.line_lengths) / n) if n else 0.0
+        self.idf = {
+            term: math.log(1 + (n - len(ids) + 0.5) / (len(ids) + 0.5))
+            for term, ids in self.postings.items()
+        }
+
+    def lookup_ids(self, terms, limit=None):
+        """
+        Returns the ids of lines containing any of the given terms, in document order.
+
+        Posting lists are already sorted, so they are k-way merged and the
+        merge stops as soon as `limit` distinct lines have been collected.
+        """
+        posting_lists = [self.postings[term] for term in terms if term in self.postings]
+        if not posting_lists:
+            return []
+        line_ids = []
+        last_id = -1
+        for line_id in heapq.merge(*posting_lists):
+            if line_id == last_id:
+                continue
+            line_ids.append(line_id)
+            last_id = line_id
+            if limit is not None and len(line_ids) >= limit:
+                break
+        return line_ids
+
+    def lookup(self, terms, limit=None):
+        """Returns lines containing any of the given terms, in document order."""
+        return [self.lines[line_id] for line_id in self.lookup_ids(terms, limit)]
+
+    def _score_lines(self, terms):
+        """Accumulates BM25 scores over the terms' postings. Returns {line id: score}."""
+        if not self.idf and self.postings:
+            self.finalize()
+        avg_length = self.avg_line_length or 1.0
+        scores = {}
+        for term in terms:
+            line_ids = self.postings.get(term)
+            if not line_ids:
+                continue
+            idf = self.idf[term]
+            for line_id, tf in zip(line_ids, self.term_freqs[term]):
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.line_lengths[line_id] / avg_length)
+                scores[line_id] = scores.get(line_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return scores
+
+    def search_ids(self, terms, k):
+        """
+        Returns the ids of the `k` best lines for the given terms ranked by BM25, best first.
+
+        Scores are accumulated only over the terms' postings, and the top-k is
+        selected with a bounded heap rather than sorting every candidate.
+        """
+        best = heapq.nlargest(k, self._score_lines(terms).items(), key=lambda item: item[1])
+        return [line_id for line_id, _ in best]
+
+    def search(self, terms, k):
+        """Returns the `k` best lines for the given terms ranked by BM25, best first."""
+        return [self.lines[line_id] for line_id in self.search_ids(terms, k)]
+
+    def search_chunks(self, terms, token_budget, dedup_threshold=0.0):
+        """
+        Packs whole chunks ranked by their best-matching line into `token_budget`
+        (see _pack). Returns (snippets, packing stats).
+        """
+        chunk_scores = {}
+        for line_id, score in self._score_lines(terms).items():
+            chunk_id = self.line_chunks[line_id]
+            if score > chunk_scores.get(chunk_id, 0.0):
+                chunk_scores[chunk_id] = score
+        heap = [(-score, chunk_id) for chunk_id, score in chunk_scores.items()]
+        heapq.heapify(heap)
+        return self.pack_chunks((heapq.heappop(heap)[1] for _ in range(len(heap))), token_budget, dedup_threshold)
+
+    def pack_chunks(self, ranked_chunk_ids, token_budget, dedup_threshold=0.0):
+        """Packs chunks, given best first, into `token_budget`. Returns (snippets, packing stats)."""
+        chunks = self.chunks
+        spans = ((chunks[i].first_line, chunks[i].end_line, i) for i in ranked_chunk_ids)
+        return self._pack(spans, token_budget, dedup_threshold)
+
+    def pack_lines(self, ranked_line_ids, token_budget, dedup_threshold=0.0):
+        """Packs single lines, given best first, into `token_budget`. Returns (snippets, packing stats)."""
+        return self._pack(((line_id, line_id + 1, None) for line_id in ranked_line_ids), token_budget, dedup_threshold)
+
+    def _span_tokens(self, first_line, end_line):
+        """Estimated tokens of a span's lines (without breadcrumb), from prefix sums: O(1) per span."""
+        if self._line_token_prefix is None:
+            prefix = [0]
+            for line in self.lines:
+                prefix.append(prefix[-1] + estimate_tokens(line))
+            self._line_token_prefix = prefix
+        return self._line_token_prefix[end_line] - self._line_token_prefix[first_line]
+
+    def _render_span(self, first_line, end_line, chunk_id):
+        return self.chunk_text(chunk_id) if chunk_id is not None else "\n".join(self.lines[first_line:end_line])
+
+    def _pack(self, ranked_spans, token_budget, dedup_threshold=0.0):
+        """
+        Fills a token budget with the highest-ranked (first line, end line, chunk id) spans.
+
+        Spans are taken in rank order; one whose text repeats an already chosen
+        span is dropped, as is (with a `dedup_threshold` and MinHash signatures
+        attached) one whose estimated Jaccard similarity to a chosen span reaches
+        the threshold. One that does not fit is skipped in favour of smaller,
+        lower-ranked ones. Chosen spans that are adjacent in the same file are then
+        merged into one snippet (so a breadcrumb is not repeated), placed at the
+        rank of its best member. Packing stops once the budget is nearly full or
+        MAX_PACK_MISSES spans in a row did not fit.
+        Returns (snippets, stats) where stats counts the tokens used, the tokens
+        saved against the unbounded context (every ranked span, as sent before
+        packing existed; spans past the point where packing stopped are estimated
+        from their lines), and the duplicates removed.
+        """
+        near_duplicates = self.minhash.new_filter(dedup_threshold) if self.minhash and dedup_threshold > 0 else None
+        stats = {"exact_duplicates": 0, "near_duplicates": 0, "near_duplicate_tokens": 0}
+        chosen = []
+        seen = set()
+        used = 0
+        unbounded = 0  # tokens of every ranked span, sent or not
+        misses = 0
+        ranked_spans = iter(ranked_spans)
+        for rank, (first_line, end_line, chunk_id) in enumerate(ranked_spans):
+            if (used and token_budget - used < MIN_SNIPPET_TOKENS) or misses >= MAX_PACK_MISSES:
+                unbounded += self._span_tokens(first_line, end_line)
+                break
+            tokens = estimate_tokens(self._render_span(first_line, end_line, chunk_id))
+            unbounded += tokens
+            fingerprint = " ".join("\n".join(self.lines[first_line:end_line]).lower().split())
+            if fingerprint in seen:
+                stats["exact_duplicates"] += 1
+                continue
+            if near_duplicates is not None and near_duplicates.is_duplicate(first_line, chunk_id):
+                stats["near_duplicates"] += 1
+                stats["near_duplicate_tokens"] += tokens
+                continue
+            if used + tokens > token_budget:
+                misses += 1
+                continue
+            misses = 0
+            seen.add(fingerprint)
+            if near_duplicates is not None:
+                near_duplicates.add(first_line, chunk_id)
+            chosen.append((first_line, end_line, chunk_id, rank))
+            used += tokens
+
+        unbounded += sum(self._span_tokens(first_line, end_line) for first_line, end_line, _ in ranked_spans)
+
+        groups = []  # [best rank, text parts, end line, source]
+        for first_line, end_line, chunk_id, rank in sorted(chosen):
+            source = self.chunks[self.line_chunks[first_line]].source if first_line < len(self.line_chunks) else ""
+            if groups and groups[-1][2] == first_line and groups[-1][3] == source:
+                group = groups[-1]
+                group[0] = min(group[0], rank)
+                group[1].extend(self.lines[first_line:end_line])
+                group[2] = end_line
+            else:
+                groups.append([rank, [self._render_span(first_line, end_line, chunk_id)], end_line, source])
+        groups.sort(key=lambda group: group[0])
+        snippets = ["\n".join(group[1]) for group in groups]
+        stats["tokens_used"] = sum(estimate_tokens(snippet) for snippet in snippets)
+        stats["tokens_saved"] = max(unbounded - stats["tokens_used"], 0)
+        return snippets, stats
@@ -0,0 +1,183 @@
+import re
+import math
+import zlib
+from collections import Counter
+import numpy as np
+
+# --- Constants ---
+NGRAM_SIZES = (2, 3)         # character n-grams; robust to word boundaries in mixed Chinese/English text
+HASH_DIMENSIONS = 1 << 20    # hashing-trick feature space
+LSH_TABLES = 16              # independent hash tables
+LSH_BITS = 8                 # random hyperplanes per table (bucket key width)
+LSH_SEED = 20240601
+LSH_SIGN_CACHE_BYTES = 32 << 20  # hyperplane signs are precomputed (int8) up to this size, else derived per vector
+_SIGN_BLOCK = 1 << 14            # features hashed per step when precomputing, bounding the uint64 intermediate
+
+_SEPARATOR_RE = re.compile(r'[\W_]+')
+
+
+def char_ngrams(text):
+    """Counts the character n-grams of `text`, with punctuation runs collapsed to a single space."""
+    normalized = f" {_SEPARATOR_RE.sub(' ', text.lower()).strip()} "
+    counts = Counter()
+    for n in NGRAM_SIZES:
+        counts.update(normalized[i:i + n] for i in range(len(normalized) - n + 1))
+    counts.pop(" " * 2, None)
+    return counts
+
+
+def hashed_features(text):
+    """Maps `text` to {hashed feature: count} using crc32 (stable across processes, unlike hash())."""
+    features = {}
+    for gram, count in char_ngrams(text).items():
+        feature = zlib.crc32(gram.encode('utf-8')) % HASH_DIMENSIONS
+        features[feature] = features.get(feature, 0) + count
+    return features
+
+
+class LSHIndex:
+    """
+    Approximate nearest-neighbour index over the chunks of a KnowledgeIndex.
+
+    Every chunk becomes a hashed character n-gram TF-IDF vector. LSH_TABLES hash
+    tables each bucket the chunks by the signs of LSH_BITS random projections
+    (SimHash), so a query only scores the chunks sharing a bucket with it (plus
+    the buckets one bit away) instead of the whole corpus. Candidates are then
+    re-ranked by exact cosine similarity.
+
+    Short queries against long chunks separate poorly under SimHash: with these
+    defaults `benchmark.py lsh` still scores about two thirds of the chunks (recall@10
+    about 0.9) at 200k and 1M characters, and fewer bits, more tables or no
+    multiprobe either lose most of the recall or scan as much. It is therefore
+    not faster than the BM25 chunk path and stays an opt-in retrieval mode.
+    The random hyperplane coordinates are derived from each feature's hash; they
+    are precomputed as int8 only while that fits LSH_SIGN_CACHE_BYTES, so memory
+    does not grow with vocabulary times projections.
+    """
+
+    def __init__(self, index, tables=LSH_TABLES, bits=LSH_BITS, seed=LSH_SEED):
+        self.tables = tables
+        self.bits = bits
+        chunk_features = [hashed_features(index.chunk_text(chunk_id)) for chunk_id in range(len(index.chunks))]
+
+        # Compact the hashed features that actually occur and compute their IDF over chunks
+        feature_ids = {}
+        doc_freq = []
+        for features in chunk_features:
+            for feature in features:
+                fid = feature_ids.setdefault(feature, len(feature_ids))
+                if fid == len(doc_freq):
+                    doc_freq.append(0)
+                doc_freq[fid] += 1
+        n_chunks = len(chunk_features)
+        self.feature_ids = feature_ids
+        self.idf = np.log((1 + n_chunks) / (1 + np.asarray(doc_freq, dtype=np.float64))) + 1
+
+        # One random +/-1 hyperplane coordinate per (feature, projection), derived from the feature hash
+        rng = np.random.default_rng(seed)
+        self._multipliers = rng.integers(1, 2**63, size=tables * bits, dtype=np.uint64) | np.uint64(1)
+        self._offsets = rng.integers(0, 2**63, size=tables * bits, dtype=np.uint64)
+        self._feature_hashes = np.fromiter(feature_ids, dtype=np.uint64, count=len(feature_ids))
+        self._signs = None
+        if len(feature_ids) * tables * bits <= LSH_SIGN_CACHE_BYTES:
+            self._signs = np.empty((len(feature_ids), tables * bits), dtype=np.int8)
+            for start in range(0, len(feature_ids), _SIGN_BLOCK):
+                block = np.arange(start, min(start + _SIGN_BLOCK, len(feature_ids)))
+                self._signs[block] = self._derive_signs(block)
+
+        # Sparse chunk vectors (CSR) and their LSH bucket keys
+        self.indptr = np.zeros(n_chunks + 1, dtype=np.int64)
+        ids = []
+        weights = []
+        for chunk_id, features in enumerate(chunk_features):
+            fids, vector = self._vectorize(features)
+            ids.append(fids)
+            weights.append(vector)
+            self.indptr[chunk_id + 1] = self.indptr[chunk_id] + len(fids)
+        self.indices = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+        self.data = np.concatenate(weights) if weights else np.zeros(0, dtype=np.float32)
+
+        self.buckets = [{} for _ in range(tables)]
+        for chunk_id in range(n_chunks):
+            start, end = self.indptr[chunk_id], self.indptr[chunk_id + 1]
+            for table, key in enumerate(self._bucket_keys(self.indices[start:end], self.data[start:end])):
+                self.buckets[table].setdefault(key, []).append(chunk_id)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def _hyperplane_signs(self, fids):
+        """Returns a (len(fids) x tables*bits) matrix of +/-1 from a multiply-shift hash of each feature."""
+        if self._signs is not None:
+            return self._signs[fids]
+        return self._derive_signs(fids)
+
+    def _derive_signs(self, fids):
+        with np.errstate(over='ignore'):
+            mixed = self._feature_hashes[fids][:, None] * self._multipliers[None, :] + self._offsets[None, :]
+        return np.where(mixed >> np.uint64(63), 1, -1).astype(np.int8)
+
+    def _vectorize(self, features):
+        """Converts {hashed feature: count} to (compact feature ids, L2-normalized TF-IDF weights); unseen features are dropped."""
+        fids = []
+        tfs = []
+        for feature, count in features.items():
+            fid = self.feature_ids.get(feature)
+            if fid is not None:
+                fids.append(fid)
+                tfs.append(1 + math.log(count))
+        fids = np.asarray(fids, dtype=np.int64)
+        vector = np.asarray(tfs, dtype=np.float64) * self.idf[fids]
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return fids, vector.astype(np.float32)
+
+    def _bucket_keys(self, fids, vector):
+        projection = vector @ self._hyperplane_signs(fids) if len(fids) else np.zeros(self.tables * self.bits, dtype=np.float32)
+        bits = (projection > 0).reshape(self.tables, self.bits)
+        return (bits.astype(np.int64) << np.arange(self.bits, dtype=np.int64)).sum(axis=1).tolist()
+
+    def candidates(self, fids, vector, multiprobe=True):
+        """Chunk ids sharing a bucket with the query in any table (optionally also buckets one bit away)."""
+        found = set()
+        for table, key in enumerate(self._bucket_keys(fids, vector)):
+            buckets = self.buckets[table]
+            found.update(buckets.get(key, ()))
+            if multiprobe:
+                for bit in range(self.bits):
+                    found.update(buckets.get(key ^ (1 << bit), ()))
+        return found
+
+    def cosine(self, fids, vector, chunk_ids):
+        """Exact cosine similarity between the query vector and the given chunks (one gather + reduceat)."""
+        dense = np.zeros(len(self.idf), dtype=np.float32)
+        dense[fids] = vector
+        chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        starts = self.indptr[chunk_ids]
+        lengths = self.indptr[chunk_ids + 1] - starts
+        offsets = np.cumsum(lengths) - lengths
+        positions = np.repeat(starts - offsets, lengths) + np.arange(int(lengths.sum()))
+        products = dense[self.indices[positions]] * self.data[positions]
+        scores = np.zeros(len(chunk_ids), dtype=np.float64)
+        nonempty = lengths > 0
+        if products.size:
+            scores[nonempty] = np.add.reduceat(products, offsets[nonempty])
+        return scores
+
+    def search(self, text, k, exact=False, multiprobe=True):
+        """
+        Returns up to `k` (chunk id, similarity) pairs for `text`, best first.
+
+        With `exact` every chunk is scored (brute force), which is what the LSH
+        candidates are measured against.
+        """
+        fids, vector = self._vectorize(hashed_features(text))
+        if not len(fids):
+            return []
+        chunk_ids = list(range(len(self))) if exact else list(self.candidates(fids, vector, multiprobe))
+        if not chunk_ids:
+            return []
+        scores = self.cosine(fids, vector, chunk_ids)
+        order = np.argsort(-scores, kind='stable')[:k]
+        return [(chunk_ids[i], scores[i]) for i in order if scores[i] > 0]
@@ -0,0 +1,38 @@
+import threading
+from collections import deque
+
+# Samples kept per latency metric; percentiles describe this recent window
+LATENCY_WINDOW = 1000
+
+
+class LatencyStats:
+    """Thread-safe latency recorder: lifetime count and mean plus percentiles over a recent window."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total_ms = 0.0
+
+    def record(self, milliseconds):
+        with self._lock:
+            self._samples.append(milliseconds)
+            self.count += 1
+            self.total_ms += milliseconds
+
+    def stats(self):
+        with self._lock:
+            samples = sorted(self._samples)
+            count, total_ms = self.count, self.total_ms
+
+        def percentile(fraction):
+            return round(samples[min(len(samples) - 1, int(fraction * len(samples)))], 1) if samples else None
+
+        return {
+            "count": count,
+            "mean_ms": round(total_ms / count, 1) if count else None,
+            "p50_ms": percentile(0.50),
+            "p95_ms": percentile(0.95),
+            "p99_ms": percentile(0.99),
+            "max_ms": round(samples[-1], 1) if samples else None,
+        }
@@ -0,0 +1,89 @@
+import zlib
+import numpy as np
+
+# --- Constants ---
+MINHASH_PERMUTATIONS = 32
+MINHASH_SEED = 20240611
+_EMPTY = np.iinfo(np.uint32).max
+
+
+class MinHashSignatures:
+    """
+    MinHash signatures of every line and chunk of a KnowledgeIndex, over their term sets.
+
+    Built once at load time from the postings: each (term, line) pair is hashed
+    by MINHASH_PERMUTATIONS multiply-shift hash functions and the minimum is kept
+    per line. A chunk's term set is the union of its lines', so its signature is
+    the element-wise minimum of its lines' signatures.
+    """
+
+    def __init__(self, index, permutations=MINHASH_PERMUTATIONS, seed=MINHASH_SEED):
+        rng = np.random.default_rng(seed)
+        multipliers = rng.integers(1, 2**63, size=permutations, dtype=np.uint64) | np.uint64(1)
+        offsets = rng.integers(0, 2**63, size=permutations, dtype=np.uint64)
+
+        terms = list(index.postings)
+        counts = np.fromiter((len(index.postings[term]) for term in terms), dtype=np.int64, count=len(terms))
+        term_hashes = np.fromiter((zlib.crc32(term.encode('utf-8')) for term in terms), dtype=np.uint64, count=len(terms))
+        line_ids = np.fromiter(
+            (line_id for term in terms for line_id in index.postings[term]), dtype=np.int64, count=int(counts.sum())
+        )
+        order = np.argsort(line_ids, kind='stable')
+        line_ids = line_ids[order]
+        hashes = np.repeat(term_hashes, counts)[order]
+
+        self.line_signatures = np.full((len(index), permutations), _EMPTY, dtype=np.uint32)
+        if len(line_ids):
+            starts = np.flatnonzero(np.r_[True, line_ids[1:] != line_ids[:-1]])
+            rows = line_ids[starts]
+            with np.errstate(over='ignore'):
+                for column in range(permutations):
+                    mixed = (hashes * multipliers[column] + offsets[column]) >> np.uint64(32)
+                    self.line_signatures[rows, column] = np.minimum.reduceat(mixed, starts).astype(np.uint32)
+
+        # Chunks are contiguous line ranges covering the index, so their signatures are one reduceat
+        chunk_starts = np.fromiter((chunk.first_line for chunk in index.chunks), dtype=np.int64, count=len(index.chunks))
+        if len(chunk_starts) and chunk_starts[0] == 0 and index.chunks[-1].end_line == len(index):
+            self.chunk_signatures = np.minimum.reduceat(self.line_signatures, chunk_starts, axis=0)
+        else:
+            self.chunk_signatures = None
+
+    def signature(self, first_line, chunk_id=None):
+        """Signature of a chunk, or of a single line when `chunk_id` is None."""
+        if chunk_id is not None and self.chunk_signatures is not None:
+            return self.chunk_signatures[chunk_id]
+        return self.line_signatures[first_line]
+
+    def new_filter(self, threshold):
+        return NearDuplicateFilter(self, threshold)
+
+
+class NearDuplicateFilter:
+    """
+    Remembers the snippets kept while packing one context and flags later ones whose
+    estimated Jaccard similarity to any of them is at least `threshold`.
+
+    Each check compares against every kept signature in one vectorized step. A
+    context holds at most a few hundred snippets, so this stays cheap, and unlike
+    LSH banding it flags every pair at the configured threshold, not only pairs
+    similar enough to share a band.
+    """
+
+    def __init__(self, signatures, threshold):
+        self.signatures = signatures
+        self.threshold = threshold
+        self._kept = np.empty((16, signatures.line_signatures.shape[1]), dtype=np.uint32)
+        self._count = 0
+
+    def is_duplicate(self, first_line, chunk_id=None):
+        if not self._count:
+            return False
+        signature = self.signatures.signature(first_line, chunk_id)
+        matches = np.count_nonzero(self._kept[:self._count] == signature, axis=1)
+        return bool(matches.max() >= self.threshold * len(signature))
+
+    def add(self, first_line, chunk_id=None):
+        if self._count == len(self._kept):
+            self._kept = np.concatenate([self._kept, np.empty_like(self._kept)])
+        self._kept[self._count] = self.signatures.signature(first_line, chunk_id)
+        self._count += 1
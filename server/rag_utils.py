@@ -1,175 +1,406 @@
 import os
-import openai
-import jieba
-import re
+import copy
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from collections import Counter
 import logger
+from knowledge_index import KnowledgeIndex, query_terms, segment_document
+from index_snapshot import load_snapshot, save_snapshot
+from cache import LRUCache
+from singleflight import SingleFlight
+from upstream import UpstreamUnavailable, call_upstream
+from ingest import IngestTask, ingest_files, INGEST_WORKERS
 
 # --- Constants ---
 KNOWLEDGE_DIR = "data"  # Default knowledge source path
-MAX_CONTEXT_LINES = 120  # Used only by retrieve_context
-MAX_TOTAL_CHARS = 1024000  # Limit total characters read by load_knowledge
+MAX_CONTEXT_LINES = 120  # Used only by retrieve_context in "overlap" mode
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "chunk").lower()  # "chunk" (ranked sections), "lsh" (approximate n-gram similarity), "bm25" (ranked lines) or "overlap" (first matches in file order)
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "40"))  # Lines returned in "bm25" mode; chunks ranked in "lsh" mode
+RETRIEVAL_ENGINE = os.getenv("RETRIEVAL_ENGINE", "python").lower()  # "python" (posting-list loops) or "numpy" (sparse matrix scoring)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000"))  # Estimated LLM tokens of context sent per query, in every mode
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.8"))  # MinHash Jaccard above which snippets count as near-duplicates; 0 disables
+SINGLE_FILE_EXTENSIONS = (".md", ".txt")  # Allowed when the knowledge path is a single file
+INDEX_SNAPSHOT_FILE = os.getenv("INDEX_SNAPSHOT_FILE", "server/index_snapshot.bin")  # Segmented corpus cache; empty disables it
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "2048"))  # Cached retrieval results; 0 disables
+RETRIEVAL_CACHE_TTL = float(os.getenv("RETRIEVAL_CACHE_TTL", "3600"))  # Seconds
+RETRIEVAL_CACHE_MAX_BYTES = int(os.getenv("RETRIEVAL_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))  # Cached LLM answers; 0 disables
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))  # Seconds
+ANSWER_CACHE_MAX_BYTES = int(os.getenv("ANSWER_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+ANSWER_CACHE_FILE = os.getenv("ANSWER_CACHE_FILE", "server/answer_cache.json")  # Persisted across restarts; empty disables
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))  # Upstream LLM calls in flight at once; further queries wait
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))  # Queries of one batch request answered at once (within LLM_MAX_CONCURRENCY)
 API_TEMPERATURE = 0.7
 MODEL_NAME = "deepseek-chat"
 
+# Retrieval results keyed by (index stamp, query term set, retrieval settings)
+retrieval_cache = LRUCache(RETRIEVAL_CACHE_SIZE, RETRIEVAL_CACHE_MAX_BYTES, RETRIEVAL_CACHE_TTL)
+# LLM answers keyed by (model, temperature, prompt hash)
+answer_cache = LRUCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_MAX_BYTES, ANSWER_CACHE_TTL)
+# Cumulative context packing counters (duplicates removed, tokens used/saved), reported at GET /admin/context
+context_stats = Counter()
+_context_stats_lock = threading.Lock()
+# Caps concurrent upstream LLM calls across all requests
+llm_slots = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+# Identical queries in flight at the same time share one retrieval and LLM call
+query_flights = SingleFlight()
+
 # --- Core Functions ---
 
-def load_knowledge(path=KNOWLEDGE_DIR):
-    """Loads knowledge. Returns (knowledge_string, is_single_file) or (None, False) on error."""
-    if os.path.isdir(path):
-        knowledge_base_list = []
-        total_chars = 0
-        logger.info(f"Scanning directory '{path}' for markdown (.md) files...")
+def iter_knowledge_files(path):
+    """Yields (filepath, relative_path) for every visible markdown file under `path`, in walk order.
+    A single-file `path` yields itself, keyed by its basename."""
+    if os.path.isfile(path):
+        yield path, os.path.basename(path)
+        return
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        files = [f for f in files if not f.startswith('.')]
+        for filename in files:
+            if filename.lower().endswith(".md"):
+                filepath = os.path.join(root, filename)
+                yield filepath, os.path.relpath(filepath, path)
+
+def build_index(knowledge_str):
+    """Builds an inverted index over the lines of a knowledge string. Run once at startup."""
+    index = KnowledgeIndex()
+    if not knowledge_str:
+        return index
+    index.add_document(segment_document("", knowledge_str))
+    index.finalize()
+    _attach_engines(index)
+    logger.info(f"Knowledge index built: {len(index)} lines, {len(index.postings)} terms.")
+    return index
+
+def _attach_engines(index):
+    """Builds the optional retrieval structures selected by RETRIEVAL_ENGINE / RETRIEVAL_MODE / CONTEXT_DEDUP_THRESHOLD."""
+    # numpy-backed structures are imported on demand, so numpy is only loaded when one is enabled
+    if RETRIEVAL_ENGINE == "numpy":
+        from sparse_engine import SparseRetrievalEngine
+        start = time.perf_counter()
+        index.sparse_engine = SparseRetrievalEngine(index)
+        logger.info(f"Sparse retrieval matrix built ({len(index.sparse_engine.data)} entries) in {time.perf_counter() - start:.2f}s.")
+    if RETRIEVAL_MODE == "lsh":
+        from lsh_index import LSHIndex
+        start = time.perf_counter()
+        index.lsh_index = LSHIndex(index)
+        logger.info(f"LSH index built over {len(index.lsh_index)} chunks in {time.perf_counter() - start:.2f}s.")
+    if CONTEXT_DEDUP_THRESHOLD > 0:
+        from minhash import MinHashSignatures
+        start = time.perf_counter()
+        index.minhash = MinHashSignatures(index)
+        logger.info(f"MinHash signatures computed for {len(index)} lines in {time.perf_counter() - start:.2f}s.")
+
+def _cached_document(relpath, stat, previous, snapshot, sha1=None):
+    """
+    Returns an already segmented copy of `relpath` if the file is unchanged, else None.
+
+    A copy matches when mtime and size are identical, or when `sha1` is given and
+    equals the stored content hash. Copies come from the previous in-memory index
+    when reloading, otherwise from the on-disk snapshot.
+    """
+    if previous is not None:
+        doc = previous.documents.get(relpath)
+        if doc and ((doc.mtime_ns == stat.st_mtime_ns and doc.size == stat.st_size) or doc.sha1 == sha1):
+            return doc
+        return None
+    entry = snapshot.get(relpath) if snapshot else None
+    if entry and ((entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size) or entry["sha1"] == sha1):
+        return snapshot.read_document(entry)
+    return None
+
+def _is_unchanged(relpath, stat, previous, snapshot):
+    """True when `previous` (or else the snapshot) holds `relpath` with the same mtime and size."""
+    if previous is not None:
+        doc = previous.documents.get(relpath)
+        return doc is not None and doc.mtime_ns == stat.st_mtime_ns and doc.size == stat.st_size
+    entry = snapshot.get(relpath) if snapshot else None
+    return entry is not None and entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size
+
+def _known_sha1(relpath, previous, snapshot):
+    """Content hash of the copy of `relpath` already held by `previous` or the snapshot, if any."""
+    if previous is not None:
+        doc = previous.documents.get(relpath)
+        return doc.sha1 if doc else None
+    entry = snapshot.get(relpath) if snapshot else None
+    return entry["sha1"] if entry else None
+
+def iter_knowledge_documents(path=KNOWLEDGE_DIR, previous=None, snapshot=None):
+    """
+    Yields (SegmentedDocument, status) for every knowledge file, in walk order.
+
+    Files whose mtime and size match a copy in `previous` or `snapshot` are taken
+    from there without being read ("reused"). All others are read, hashed and
+    segmented by the ingest pool ("segmented"), unless the content hash shows the
+    file did not actually change: then the stored copy is reused with the new
+    mtime ("refreshed"). Files that cannot be read are logged and skipped.
+    """
+    entries = []  # (relpath, stat, ingest task or None) per file; metadata only
+    tasks = []
+    for filepath, relpath in iter_knowledge_files(path):
         try:
-            for root, dirs, files in os.walk(path):
-                dirs[:] = [d for d in dirs if not d.startswith('.')]
-                files = [f for f in files if not f.startswith('.')]
-                for filename in files:
-                    if filename.lower().endswith(".md"):
-                        filepath = os.path.join(root, filename)
-                        try:
-                            with open(filepath, 'r', encoding='utf-8') as f:
-                                content = f.read()
-                                if total_chars + len(content) > MAX_TOTAL_CHARS:
-                                    logger.warning(f"Reached character limit ({MAX_TOTAL_CHARS}). Stopping loading.")
-                                    knowledge = "\n\n---\n\n".join(knowledge_base_list)
-                                    logger.info(f"Knowledge loaded from {len(knowledge_base_list)} files in '{path}'.")
-                                    return knowledge, False
-                                knowledge_base_list.append(f"# Source: {os.path.relpath(filepath, path)}\n\n{content}")
-                                total_chars += len(content)
-                        except Exception as e:
-                            logger.warning(f"Error reading file {filepath}: {e}")
-            if not knowledge_base_list:
-                logger.warning(f"No markdown (.md) files found in directory {path}")
-                return "", False
-            knowledge = "\n\n---\n\n".join(knowledge_base_list)
-            logger.info(f"Knowledge loaded successfully from {len(knowledge_base_list)} files in '{path}'.")
-            return knowledge, False
-        except Exception as e:
-            logger.error(f"Error scanning directory {path}: {e}")
-            return None, False
-    elif os.path.isfile(path):
-        allowed_extensions = (".md", ".txt")
-        if path.lower().endswith(allowed_extensions):
-            logger.info(f"Loading knowledge from single file: {path}")
-            try:
-                with open(path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    if len(content) > MAX_TOTAL_CHARS:
-                        logger.warning(f"File content exceeds limit ({MAX_TOTAL_CHARS}). Truncating.")
-                        content = content[:MAX_TOTAL_CHARS]
-                    knowledge = f"# Source: {os.path.basename(path)}\n\n{content}"
-                    logger.info(f"Knowledge loaded successfully from {path}.")
-                    return knowledge, True
-            except Exception as e:
-                logger.error(f"Error reading file {path}: {e}")
-                return None, False
+            stat = os.stat(filepath)
+        except OSError as e:
+            logger.warning(f"Error reading file {filepath}: {e}")
+            continue
+        task = None
+        if not _is_unchanged(relpath, stat, previous, snapshot):
+            task = IngestTask(filepath, relpath, stat.st_mtime_ns, stat.st_size, _known_sha1(relpath, previous, snapshot))
+            tasks.append(task)
+        entries.append((relpath, stat, task))
+
+    results = ingest_files(tasks, INGEST_WORKERS)
+    for relpath, stat, task in entries:
+        if task is None:
+            yield _cached_document(relpath, stat, previous, snapshot), "reused"
+            continue
+        result = next(results)
+        if isinstance(result, Exception):
+            logger.warning(f"Error reading file {task.filepath}: {result}")
+            continue
+        sha1, doc = result
+        if doc is None:
+            # Only the mtime changed: record it on a copy, as `previous` may still be serving queries
+            doc = copy.copy(_cached_document(relpath, stat, previous, snapshot, sha1))
+            doc.mtime_ns = stat.st_mtime_ns
+            yield doc, "refreshed"
         else:
-            logger.error(f"Input file '{path}' not allowed ({allowed_extensions}).")
-            return None, False
-    else:
+            yield doc, "segmented"
+    next(results, None)  # run the ingest generator to completion: shuts its pool down and logs throughput
+
+def knowledge_fingerprint(path=KNOWLEDGE_DIR):
+    """Cheap stat-only fingerprint of the knowledge source, used to detect changes without reading files."""
+    if os.path.isdir(path):
+        fingerprint = []
+        for filepath, relpath in iter_knowledge_files(path):
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                continue
+            fingerprint.append((relpath, stat.st_mtime_ns, stat.st_size))
+        return tuple(fingerprint)
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return ((path, stat.st_mtime_ns, stat.st_size),)
+    return ()
+
+def load_knowledge_index(path=KNOWLEDGE_DIR, snapshot_file=INDEX_SNAPSHOT_FILE, previous=None):
+    """
+    Builds the knowledge index for a directory or single file, re-segmenting only files that changed.
+
+    Unchanged files are reused from `previous` (an index being reloaded) or, at
+    startup, from the on-disk snapshot. Files whose path, mtime and size match are
+    not even read; files whose mtime changed are hashed and reused if the content
+    is identical. The snapshot is rewritten whenever anything changed, including
+    only the mtime of a file (so it does not stay stale after a checkout that
+    resets mtimes, which would make every startup re-hash those files).
+    Returns a new KnowledgeIndex (never mutates `previous`), or None on error.
+    """
+    if not os.path.exists(path):
         logger.error(f"Knowledge path not found: '{path}'")
-        return None, False
+        return None
+    if os.path.isfile(path) and not path.lower().endswith(SINGLE_FILE_EXTENSIONS):
+        logger.error(f"Input file '{path}' not allowed ({SINGLE_FILE_EXTENSIONS}).")
+        return None
+    start = time.perf_counter()
+    snapshot = load_snapshot(snapshot_file) if previous is None else None
+    known_files = len(previous.documents) if previous is not None else (len(snapshot.files) if snapshot else -1)
+    index = KnowledgeIndex()
+    segmented = 0
+    refreshed = 0  # reused with a new mtime
+    logger.info(f"Indexing '{path}' (reusing: {'previous index' if previous is not None else 'snapshot' if snapshot else 'nothing'})...")
+    try:
+        # Documents are added as they arrive, so only the index (not the raw text) is held in memory
+        for doc, status in iter_knowledge_documents(path, previous, snapshot):
+            index.add_document(doc)
+            segmented += status == "segmented"
+            refreshed += status == "refreshed"
+    except Exception as e:
+        logger.error(f"Error scanning directory {path}: {e}")
+        return None
+    finally:
+        if snapshot:
+            snapshot.close()
+    documents = index.documents
+
+    if not documents:
+        logger.warning(f"No markdown (.md) files found in directory {path}")
 
-def retrieve_context(query, knowledge_str):
-    """Retrieves relevant context snippets using both Chinese and English tokenization."""
-    if knowledge_str is None: return []
-    if not knowledge_str: return []
+    # Deleted files and new mtimes also invalidate the snapshot
+    if (segmented or refreshed or known_files != len(documents)) and snapshot_file:
+        save_snapshot(snapshot_file, documents.values())
+
+    index.finalize()
+    _attach_engines(index)
+    logger.info(
+        f"Knowledge index built from {len(documents)} files ({segmented} segmented, "
+        f"{len(documents) - segmented} reused ({refreshed} with a new mtime), {sum(doc.chars for doc in documents.values())} chars): "
+        f"{len(index)} lines, {len(index.postings)} terms in {time.perf_counter() - start:.2f}s."
+    )
+    return index
+
+def _sparse_engine(knowledge):
+    """The index's numpy scoring engine, built on first use."""
+    if knowledge.sparse_engine is None:
+        from sparse_engine import SparseRetrievalEngine
+        knowledge.sparse_engine = SparseRetrievalEngine(knowledge)
+    return knowledge.sparse_engine
+
+def _search(query, query_words, knowledge, mode, top_k, engine):
+    """Runs one retrieval mode against an index. Returns (snippets, packing stats)."""
+    if mode == "lsh":
+        if knowledge.lsh_index is None:
+            from lsh_index import LSHIndex
+            knowledge.lsh_index = LSHIndex(knowledge)
+        ranked = [chunk_id for chunk_id, _ in knowledge.lsh_index.search(query, top_k)]
+        return knowledge.pack_chunks(ranked, CONTEXT_TOKEN_BUDGET, CONTEXT_DEDUP_THRESHOLD)
+
+    sparse_engine = _sparse_engine(knowledge) if engine == "numpy" else None
+
+    if mode == "chunk" and sparse_engine is not None:
+        return knowledge.pack_chunks(sparse_engine.search_chunks(query_words), CONTEXT_TOKEN_BUDGET, CONTEXT_DEDUP_THRESHOLD)
+    if mode == "bm25" and sparse_engine is not None:
+        return knowledge.pack_lines(sparse_engine.search(query_words, top_k), CONTEXT_TOKEN_BUDGET, CONTEXT_DEDUP_THRESHOLD)
+    if mode == "chunk":
+        return knowledge.search_chunks(query_words, CONTEXT_TOKEN_BUDGET, CONTEXT_DEDUP_THRESHOLD)
+    if mode == "bm25":
+        return knowledge.pack_lines(knowledge.search_ids(query_words, top_k), CONTEXT_TOKEN_BUDGET, CONTEXT_DEDUP_THRESHOLD)
+    return knowledge.pack_lines(knowledge.lookup_ids(query_words, limit=MAX_CONTEXT_LINES), CONTEXT_TOKEN_BUDGET, CONTEXT_DEDUP_THRESHOLD)
+
+def retrieve_context(query, knowledge, mode=None, top_k=None, engine=None, use_cache=True):
+    """Retrieves relevant context snippets using both Chinese and English tokenization.
+
+    `knowledge` is normally a prebuilt KnowledgeIndex; a raw knowledge string is
+    still accepted but is indexed on the fly (O(corpus) per call).
+    In "chunk" mode whole heading-scoped sections are returned, best first ("lsh" mode ranks them by approximate character
+    n-gram similarity instead, which also catches paraphrases); in "bm25" mode the
+    `top_k` best-scoring lines, best first; in "overlap" mode every matching line up
+    to MAX_CONTEXT_LINES, in file order. In every mode the snippets are packed into
+    CONTEXT_TOKEN_BUDGET estimated tokens: duplicates and (per MinHash signatures
+    computed at load time) near-duplicates are dropped, and snippets adjacent in
+    the same file are merged.
+    With the "numpy" engine, ranked modes are scored on the index's sparse matrix.
+
+    Results are cached per index by the query's normalized term set, so queries that
+    differ only in word order, punctuation, case or stopwords share an entry.
+    """
+    mode = mode or RETRIEVAL_MODE
+    top_k = top_k or RETRIEVAL_TOP_K
+    engine = engine or RETRIEVAL_ENGINE
+    if knowledge is None: return []
+    if not knowledge: return []
     try:
         query = query.strip()
         if not query: return []
-        
-        # Combined Chinese and English stopwords
-        chinese_stop_words = set([
-            '的', '了', '和', '是', '就', '都', '而', '及', '与', '这', '那', '有', '在',
-            '中', '上', '下', '由', '为', '以', '到', '等', '让', '向', '又', '但', '如',
-            '或', '所', '因', '于', '只', '从', '给', '被', '得', '地', '着', '把', '之'
-        ])
-        
-        english_stop_words = set([
-            'i', 'me', 'my', 'myself', 'we', 'our', 'ours', 'ourselves', 'you', 'your', 
-            'yours', 'yourself', 'yourselves', 'he', 'him', 'his', 'himself', 'she', 'her', 
-            'hers', 'herself', 'it', 'its', 'itself', 'they', 'them', 'their', 'theirs', 
-            'themselves', 'what', 'which', 'who', 'whom', 'this', 'that', 'these', 'those', 
-            'am', 'is', 'are', 'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had', 
-            'having', 'do', 'does', 'did', 'doing', 'a', 'an', 'the', 'and', 'but', 'if', 
-            'or', 'because', 'as', 'until', 'while', 'of', 'at', 'by', 'for', 'with', 
-            'about', 'against', 'between', 'into', 'through', 'during', 'before', 'after', 
-            'above', 'below', 'to', 'from', 'up', 'down', 'in', 'out', 'on', 'off', 'over', 
-            'under', 'again', 'further', 'then', 'once', 'here', 'there', 'when', 'where', 
-            'why', 'how', 'all', 'any', 'both', 'each', 'few', 'more', 'most', 'other', 
-            'some', 'such', 'no', 'nor', 'not', 'only', 'own', 'same', 'so', 'than', 'too', 
-            'very', 's', 't', 'can', 'will', 'just', 'don', 'should', 'now'
-        ])
-        
-        # Combine both stopword sets
-        stop_words = chinese_stop_words.union(english_stop_words)
-        
+
+        if not isinstance(knowledge, KnowledgeIndex):
+            knowledge = build_index(knowledge)
+            use_cache = False
+
         # Use jieba to segment mixed text - jieba handles both Chinese and English
-        query_tokens = list(jieba.cut(query.lower()))
-        
-        # Post-process tokens to handle mixed language better
-        processed_tokens = []
-        for token in query_tokens:
-            # Skip empty tokens
-            if not token.strip():
-                continue
-                
-            # Skip pure punctuation
-            if re.match(r'^\W+$', token):
-                continue
-                
-            # Skip stopwords (from either language)
-            if token in stop_words:
-                continue
-                
-            # Add to processed tokens
-            processed_tokens.append(token)
-            
-        query_words = set(processed_tokens)
-        
+        query_words = query_terms(query)
+
         logger.debug(f"Tokenized query words: {query_words}")
-        
-        # Process the knowledge base
-        lines = knowledge_str.splitlines()
-        relevant_lines = []
-        
-        for line in lines:
-            line_stripped = line.strip()
-            if not line_stripped: 
-                continue
-            
-            # Process line with same technique as query
-            line_tokens = list(jieba.cut(line_stripped.lower()))
-            processed_line_tokens = []
-            
-            for token in line_tokens:
-                if not token.strip() or re.match(r'^\W+$', token):
-                    continue
-                processed_line_tokens.append(token)
-                
-            line_words = set(processed_line_tokens)
-            
-            # Check for overlap with query terms
-            if query_words.intersection(line_words):
-                relevant_lines.append(line)
-                
+
+        cache_key = None
+        if use_cache and query_words:
+            cache_key = (knowledge.stamp, frozenset(query_words), mode, engine, top_k, CONTEXT_TOKEN_BUDGET, CONTEXT_DEDUP_THRESHOLD)
+            packed = retrieval_cache.get(cache_key)
+            if packed is not None:
+                stats = packed[1]
+                logger.info(
+                    f"Retrieval cache hit ({len(packed[0])} snippets, ~{stats['tokens_used']} tokens, "
+                    f"~{stats['tokens_saved']} tokens saved)."
+                )
+                return packed[0]
+
+        packed = _search(query, query_words, knowledge, mode, top_k, engine)
+        if cache_key is not None:
+            retrieval_cache.put(cache_key, packed)
+        relevant_lines, stats = packed
+        _record_pack_stats(stats)
+
     except Exception as e:
         logger.error(f"Failed during context retrieval: {e}")
         return []
-        
-    logger.info(f"Found {len(relevant_lines)} potentially relevant lines.")
-    return relevant_lines[:MAX_CONTEXT_LINES]
 
-def generate_answer(query, context_str, client, is_dry_run):
-    """Generates an answer using OpenAI or performs a dry run."""
-    if not client:
-        logger.error("OpenAI client is not initialized. Cannot generate answer.")
-        return "OpenAI client is not initialized. Cannot generate answer."
+    logger.info(
+        f"Found {len(relevant_lines)} potentially relevant {'lines' if mode in ('bm25', 'overlap') else 'chunks'}: "
+        f"~{stats['tokens_used']} of {CONTEXT_TOKEN_BUDGET} context tokens used, ~{stats['tokens_saved']} tokens saved "
+        f"({stats['exact_duplicates']} duplicates, {stats['near_duplicates']} near-duplicates removed)."
+    )
+    return relevant_lines
 
-    model_name = MODEL_NAME
-    temperature = API_TEMPERATURE
-    messages = []
+def _record_pack_stats(stats):
+    with _context_stats_lock:
+        context_stats["packs"] += 1
+        context_stats.update(stats)
 
+def retrieve_contexts(queries, knowledge, mode=None, top_k=None, use_cache=True):
+    """Batch variant of retrieve_context: returns one list of snippets per query, in order.
+
+    In "chunk" and "bm25" mode the queries not found in the retrieval cache are
+    scored together, one sparse matrix product per block of queries (the numpy
+    engine, whatever RETRIEVAL_ENGINE says), and queries with the same term set
+    are scored once. Other modes, and raw knowledge strings, retrieve per query.
+    """
+    mode = mode or RETRIEVAL_MODE
+    top_k = top_k or RETRIEVAL_TOP_K
+    if not isinstance(knowledge, KnowledgeIndex) or mode not in ("chunk", "bm25"):
+        return [retrieve_context(query, knowledge, mode, top_k, use_cache=use_cache) for query in queries]
+
+    start = time.perf_counter()
+    results = [[] for _ in queries]
+    pending = {}  # cache key -> (query terms, positions of the queries with those terms)
+    for position, query in enumerate(queries):
+        query_words = query_terms(query.strip()) if query.strip() else []
+        if not query_words:
+            continue
+        cache_key = (knowledge.stamp, frozenset(query_words), mode, "numpy", top_k, CONTEXT_TOKEN_BUDGET, CONTEXT_DEDUP_THRESHOLD)
+        packed = retrieval_cache.get(cache_key) if use_cache else None
+        if packed is not None:
+            results[position] = packed[0]
+            continue
+        pending.setdefault(cache_key, (query_words, []))[1].append(position)
+
+    if pending:
+        try:
+            sparse_engine = _sparse_engine(knowledge)
+            keys = list(pending)
+            for key_position, line_scores in sparse_engine.score_batch([pending[key][0] for key in keys]):
+                if mode == "chunk":
+                    chunk_scores = sparse_engine.chunk_scores(line_scores)
+                    ranked = sparse_engine.top_k(chunk_scores, len(chunk_scores)) if len(chunk_scores) else chunk_scores
+                    packed = knowledge.pack_chunks(ranked, CONTEXT_TOKEN_BUDGET, CONTEXT_DEDUP_THRESHOLD)
+                else:
+                    packed = knowledge.pack_lines(sparse_engine.top_k(line_scores, top_k), CONTEXT_TOKEN_BUDGET, CONTEXT_DEDUP_THRESHOLD)
+                if use_cache:
+                    retrieval_cache.put(keys[key_position], packed)
+                _record_pack_stats(packed[1])
+                for position in pending[keys[key_position]][1]:
+                    results[position] = packed[0]
+        except Exception as e:
+            logger.error(f"Failed during batch context retrieval: {e}")
+
+    logger.info(
+        f"Retrieved context for {len(queries)} queries ({len(pending)} distinct scored, "
+        f"{len(queries) - sum(len(positions) for _, positions in pending.values())} cached or empty) "
+        f"in {(time.perf_counter() - start) * 1000:.1f} ms."
+    )
+    return results
+
+def answer_cache_key(model_name, temperature, messages):
+    """Cache key for an LLM call: identical model, temperature and prompt give the same key."""
+    prompt_hash = hashlib.sha256(json.dumps(messages, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+    return f"{model_name}|{temperature}|{prompt_hash}"
+
+DRY_RUN_ANSWER = "[Server in dry-run mode - No API call made]"
+
+def build_messages(query, context_str):
+    """Builds the chat messages for a query, grounded in `context_str` when there is any."""
     if context_str:
         logger.info("Generating answer using retrieved context.")
         system_prompt = "You are a knowledgeable wine expert assistant. Please prioritize answering based on the provided context. If the context is relevant, mention that you're basing your answer on that context. If the context isn't relevant or insufficient to answer the question, use your own knowledge to provide the best possible answer. Respond in Chinese."
@@ -181,39 +412,69 @@ def generate_answer(query, context_str, client, is_dry_run):
 Question: {query}
 
 Answer:"""
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ]
     else:
         logger.info("No relevant context found. Generating answer using general knowledge.")
         system_prompt = "You are a knowledgeable wine expert assistant. Respond in Chinese."
         user_prompt = query
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ]
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+
+def _log_dry_run(model_name, messages, temperature):
+    logger.info("DRY RUN MODE - API Call details:")
+    logger.debug(f"  Model: {model_name}")
+    logger.debug("  Messages:")
+    for msg in messages:
+        logger.debug(f"    Role: {msg['role']}")
+        content_preview = msg['content'][:200] + "..." if len(msg['content']) > 200 else msg['content']
+        logger.debug(f"    Content: {content_preview}")
+    logger.debug(f"  Temperature: {temperature}")
+
+async def generate_answer(query, context_str, client, is_dry_run, use_cache=True):
+    """Generates an answer using an openai.AsyncOpenAI client or performs a dry run.
+
+    Answers to byte-identical prompts are served from `answer_cache` unless
+    `use_cache` is False; a fresh answer still refreshes the cache entry.
+    At most LLM_MAX_CONCURRENCY upstream calls run at once; the event loop keeps
+    serving other requests while they are in flight. Failed calls are retried by
+    call_upstream; UpstreamUnavailable (circuit open) is raised to the caller.
+    """
+    if not client:
+        logger.error("OpenAI client is not initialized. Cannot generate answer.")
+        return "OpenAI client is not initialized. Cannot generate answer."
+
+    model_name = MODEL_NAME
+    temperature = API_TEMPERATURE
+    messages = build_messages(query, context_str)
 
     if is_dry_run:
-        logger.info("DRY RUN MODE - API Call details:")
-        logger.debug(f"  Model: {model_name}")
-        logger.debug("  Messages:")
-        for msg in messages:
-            logger.debug(f"    Role: {msg['role']}")
-            content_preview = msg['content'][:200] + "..." if len(msg['content']) > 200 else msg['content']
-            logger.debug(f"    Content: {content_preview}")
-        logger.debug(f"  Temperature: {temperature}")
-        return "[Server in dry-run mode - No API call made]"
+        _log_dry_run(model_name, messages, temperature)
+        return DRY_RUN_ANSWER
 
+    cache_key = answer_cache_key(model_name, temperature, messages)
+    if use_cache:
+        cached_answer = answer_cache.get(cache_key)
+        if cached_answer is not None:
+            logger.info("Answer cache hit; skipping API call.")
+            return cached_answer
+
+    import openai  # deferred: importing the SDK takes most of a second and only matters once a client exists
     try:
         logger.info(f"Attempting to generate answer for query: '{query}' using Model {model_name}...")
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=messages,
-            temperature=temperature,
-        )
+        async with llm_slots:
+            response = await call_upstream(lambda: client.chat.completions.create(
+                model=model_name,
+                messages=messages,
+                temperature=temperature,
+            ))
         logger.info("OpenAI API call successful.")
-        return response.choices[0].message.content.strip()
+        answer = response.choices[0].message.content.strip()
+        answer_cache.put(cache_key, answer)
+        return answer
+    except UpstreamUnavailable:
+        logger.warning("LLM API circuit open; failing fast.")
+        raise
     except openai.APIError as e:
         logger.error(f"OpenAI API Error: {e}")
         return f"Sorry, there was an API error while contacting OpenAI: {e}"
@@ -221,22 +482,141 @@ Answer:"""
         logger.error(f"An unexpected error occurred: {e}")
         return f"Sorry, an unexpected error occurred: {e}"
 
-def rag_query(query, current_knowledge, current_is_single_file, client, is_dry_run):
-    """Performs RAG. If is_single_file, uses full knowledge; otherwise filters context."""
+async def stream_answer(query, context_str, client, is_dry_run, use_cache=True):
+    """Like generate_answer, but yields the answer as text deltas while the LLM produces them.
+
+    A cached (or dry-run) answer is yielded in one piece; a streamed answer is
+    cached once complete. Upstream errors are logged and re-raised, since part
+    of the answer may already have been sent; only opening the stream is retried.
+    """
+    model_name = MODEL_NAME
+    temperature = API_TEMPERATURE
+    messages = build_messages(query, context_str)
+
+    if is_dry_run:
+        _log_dry_run(model_name, messages, temperature)
+        yield DRY_RUN_ANSWER
+        return
+
+    cache_key = answer_cache_key(model_name, temperature, messages)
+    if use_cache:
+        cached_answer = answer_cache.get(cache_key)
+        if cached_answer is not None:
+            logger.info("Answer cache hit; skipping API call.")
+            yield cached_answer
+            return
+
+    pieces = []
+    try:
+        logger.info(f"Streaming answer for query: '{query}' using Model {model_name}...")
+        async with llm_slots:
+            stream = await call_upstream(lambda: client.chat.completions.create(
+                model=model_name,
+                messages=messages,
+                temperature=temperature,
+                stream=True,
+            ))
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    pieces.append(delta)
+                    yield delta
+    except Exception as e:
+        logger.error(f"Error while streaming answer: {e}")
+        raise
+    answer = "".join(pieces).strip()
+    if answer:
+        answer_cache.put(cache_key, answer)
+
+async def build_context(query, current_knowledge):
+    """Returns the context string for a query: the retrieved snippets, packed within the token budget."""
+    logger.info("Filtering knowledge based on query.")
+    # Retrieval is CPU-bound; run it off the event loop
+    relevant_lines = await asyncio.to_thread(retrieve_context, query, current_knowledge)
+    return "\n\n".join(relevant_lines)
+
+def normalize_query(query):
+    """Case- and whitespace-insensitive form of a query, used to recognize identical questions."""
+    return " ".join(query.split()).casefold()
+
+def _flight_key(query, current_knowledge, current_is_single_file, is_dry_run, use_cache):
+    """Single-flight key: queries equal after normalize_query, against the same knowledge version."""
+    knowledge_version = getattr(current_knowledge, "stamp", id(current_knowledge))
+    return (normalize_query(query), knowledge_version, current_is_single_file, bool(is_dry_run), use_cache)
+
+async def rag_query(query, current_knowledge, current_is_single_file, client, is_dry_run, use_cache=True):
+    """Performs RAG. Filters context from an indexed knowledge base; a raw single-file string is used in full if it fits the token budget.
+
+    Concurrent calls for the same normalized query against the same knowledge
+    version (and so the same context) are coalesced: they share one retrieval
+    and one upstream call, and all receive its answer or its exception.
+    """
     if current_knowledge is None:
         logger.error("Knowledge base not loaded.")
         return "Knowledge base not loaded."
 
-    context_string = ""
-    if current_is_single_file:
-        logger.info("Using full knowledge from single file as context.")
-        context_string = current_knowledge
-    else:
-        logger.info("Filtering knowledge from directory scan based on query.")
-        relevant_lines = retrieve_context(query, current_knowledge)
-        if relevant_lines:
-            context_string = "\n".join(relevant_lines)
+    key = _flight_key(query, current_knowledge, current_is_single_file, is_dry_run, use_cache)
+    return await query_flights.run(
+        key, lambda: _answer_query(query, current_knowledge, current_is_single_file, client, is_dry_run, use_cache)
+    )
+
+async def _answer_query(query, current_knowledge, current_is_single_file, client, is_dry_run, use_cache):
+    context_string = await build_context(query, current_knowledge)
 
     # Pass client and is_dry_run flag to generate_answer
-    answer = generate_answer(query, context_string, client, is_dry_run)
-    return answer 
\ No newline at end of file
+    answer = await generate_answer(query, context_string, client, is_dry_run, use_cache=use_cache)
+    return answer
+
+async def rag_query_batch(queries, current_knowledge, current_is_single_file, client, is_dry_run,
+                          use_cache=True, concurrency=BATCH_CONCURRENCY):
+    """
+    Answers many queries, yielding (position, answer or exception) as each completes.
+
+    Context for all queries is retrieved up front in one pass (retrieve_contexts);
+    then at most `concurrency` LLM calls of this batch are in flight at once, on
+    top of the server-wide LLM_MAX_CONCURRENCY cap. Answers are coalesced with
+    concurrent identical queries like rag_query's. Closing the generator cancels
+    the calls still running.
+    """
+    if current_knowledge is None:
+        logger.error("Knowledge base not loaded.")
+        for position in range(len(queries)):
+            yield position, "Knowledge base not loaded."
+        return
+
+    # One scoring pass for the whole batch, off the event loop
+    snippet_lists = await asyncio.to_thread(retrieve_contexts, queries, current_knowledge)
+    contexts = ["\n\n".join(snippets) for snippets in snippet_lists]
+
+    async def answer(position):
+        query = queries[position]
+        key = _flight_key(query, current_knowledge, current_is_single_file, is_dry_run, use_cache)
+        try:
+            return position, await query_flights.run(
+                key, lambda: generate_answer(query, contexts[position], client, is_dry_run, use_cache=use_cache)
+            )
+        except Exception as e:
+            return position, e
+
+    upcoming = iter(range(len(queries)))
+    in_flight = set()
+    try:
+        while True:
+            for position in upcoming:
+                in_flight.add(asyncio.ensure_future(answer(position)))
+                if len(in_flight) >= max(1, concurrency):
+                    break
+            if not in_flight:
+                return
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+async def rag_query_stream(query, current_knowledge, current_is_single_file, client, is_dry_run, use_cache=True):
+    """Streaming variant of rag_query: yields answer text deltas (see stream_answer)."""
+    context_string = await build_context(query, current_knowledge)
+    async for delta in stream_answer(query, context_string, client, is_dry_run, use_cache=use_cache):
+        yield delta
@@ -0,0 +1,48 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key onto one in-progress call.
+
+    The first caller for a key starts the work as a task; callers arriving while
+    it runs await that same task and receive its result, or the exception it
+    raised. The task is shielded, so a caller that is cancelled (e.g. the client
+    disconnected) does not cancel the work the others are waiting for. Keys are
+    forgotten as soon as the call finishes: this shares work, it does not cache.
+    """
+
+    def __init__(self):
+        self._calls = {}  # key -> asyncio.Task
+        self.calls = 0       # calls that did the work
+        self.coalesced = 0   # calls that joined one already in flight
+        self.errors = 0      # calls whose work raised (each shared by all its waiters)
+
+    async def run(self, key, fn):
+        """Returns the result of `await fn()`, sharing it with concurrent calls for the same key."""
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            self.calls += 1
+            task.add_done_callback(lambda finished: self._finish(key, finished))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Retrieve the exception so it is not reported as unhandled if every waiter went away
+        if not task.cancelled() and task.exception() is not None:
+            self.errors += 1
+
+    def stats(self):
+        total = self.calls + self.coalesced
+        return {
+            "in_flight": len(self._calls),
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "coalesced_rate": round(self.coalesced / total, 4) if total else 0.0,
+        }
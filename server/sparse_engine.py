@@ -0,0 +1,105 @@
+import itertools
+import numpy as np
+from knowledge_index import BM25_K1, BM25_B
+
+# Upper bound on the dense (queries x lines) score block materialized by batch scoring (8 MB of float64)
+MAX_BATCH_CELLS = 1_000_000
+
+
+class SparseRetrievalEngine:
+    """
+    Vectorized BM25 scorer over a KnowledgeIndex.
+
+    The index's postings are packed once into a CSR term-document matrix whose
+    entries are the query-independent BM25 term weights. Scoring a query is then
+    a sparse matrix-vector product (the sum of the query terms' rows), and a
+    batch of queries is a single sparse matrix-matrix product. Top-k selection
+    uses argpartition instead of a full sort.
+    """
+
+    def __init__(self, index):
+        if not index.idf and index.postings:
+            index.finalize()
+        terms = list(index.postings)
+        self.term_rows = {term: row for row, term in enumerate(terms)}
+        self.n_lines = len(index)
+
+        row_lengths = np.fromiter((len(index.postings[term]) for term in terms), dtype=np.int64, count=len(terms))
+        self.indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(row_lengths, out=self.indptr[1:])
+        nnz = int(self.indptr[-1])
+        self.indices = np.fromiter(
+            itertools.chain.from_iterable(index.postings[term] for term in terms), dtype=np.int32, count=nnz
+        )
+        tf = np.fromiter(
+            itertools.chain.from_iterable(index.term_freqs[term] for term in terms), dtype=np.float64, count=nnz
+        )
+        idf = np.repeat(np.fromiter((index.idf[term] for term in terms), dtype=np.float64, count=len(terms)), row_lengths)
+        line_lengths = np.asarray(index.line_lengths, dtype=np.float64)[self.indices]
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * line_lengths / (index.avg_line_length or 1.0))
+        self.data = (idf * tf * (BM25_K1 + 1) / (tf + norm)).astype(np.float32)
+
+        # Chunks are contiguous line ranges, so per-chunk maxima are a single reduceat
+        self.chunk_starts = np.fromiter((chunk.first_line for chunk in index.chunks), dtype=np.int64, count=len(index.chunks))
+        self.covers_all_lines = bool(index.chunks) and index.chunks[-1].end_line == self.n_lines and self.chunk_starts[0] == 0
+
+    def _rows(self, terms):
+        return [self.term_rows[term] for term in terms if term in self.term_rows]
+
+    def score(self, terms):
+        """Returns a dense vector of BM25 scores for every line (sparse matrix-vector product)."""
+        rows = self._rows(terms)
+        if not rows:
+            return np.zeros(self.n_lines, dtype=np.float64)
+        line_ids = np.concatenate([self.indices[self.indptr[row]:self.indptr[row + 1]] for row in rows])
+        weights = np.concatenate([self.data[self.indptr[row]:self.indptr[row + 1]] for row in rows])
+        return np.bincount(line_ids, weights=weights, minlength=self.n_lines)
+
+    def score_batch(self, term_sets):
+        """
+        Scores many queries at once as one sparse (queries x terms) by (terms x lines) product.
+
+        Yields (query position, score vector) in input order; queries are processed in
+        blocks so that at most MAX_BATCH_CELLS scores are materialized at a time.
+        """
+        block_size = max(1, MAX_BATCH_CELLS // max(self.n_lines, 1))
+        for block_start in range(0, len(term_sets), block_size):
+            block = term_sets[block_start:block_start + block_size]
+            cells = []
+            weights = []
+            for position, terms in enumerate(block):
+                for row in self._rows(terms):
+                    start, end = self.indptr[row], self.indptr[row + 1]
+                    cells.append(self.indices[start:end].astype(np.int64) + position * self.n_lines)
+                    weights.append(self.data[start:end])
+            if cells:
+                scores = np.bincount(
+                    np.concatenate(cells), weights=np.concatenate(weights), minlength=len(block) * self.n_lines
+                ).reshape(len(block), self.n_lines)
+            else:
+                scores = np.zeros((len(block), self.n_lines), dtype=np.float64)
+            for position in range(len(block)):
+                yield block_start + position, scores[position]
+
+    @staticmethod
+    def top_k(scores, k):
+        """Returns the ids of the `k` highest positive scores, best first."""
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+    def chunk_scores(self, line_scores):
+        """Reduces line scores to each chunk's best line score."""
+        if not self.covers_all_lines:
+            return np.zeros(0, dtype=np.float64)
+        return np.maximum.reduceat(line_scores, self.chunk_starts)
+
+    def search(self, terms, k):
+        """Line ids of the `k` best lines for the given terms, best first."""
+        return self.top_k(self.score(terms), k)
+
+    def search_chunks(self, terms):
+        """Chunk ids with any matching line, ranked by their best line, best first."""
+        scores = self.chunk_scores(self.score(terms))
+        return self.top_k(scores, len(scores)) if len(scores) else scores
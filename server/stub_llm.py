@@ -0,0 +1,151 @@
+import json
+import time
+import random
+import asyncio
+import argparse
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import logger
+
+FILLER = ("This is a stub answer from the local test server. Good wine pairs acidity, tannin and fruit "
+          "with the dish it is served with, and tastes best at the right temperature.").split()
+
+
+class StubConfig:
+    """Behavior of the stub LLM: latency distribution, token rate, answer length and injected failures."""
+
+    def __init__(self, latency_ms=800.0, latency_dist="lognormal", latency_spread=0.5, token_rate=40.0,
+                 answer_tokens=120, error_rate=0.0, error_statuses=(429, 500, 502, 503), hang_rate=0.0, seed=None):
+        self.latency_ms = latency_ms          # Median (lognormal) or mean time to the first token
+        self.latency_dist = latency_dist      # "fixed", "uniform", "exponential" or "lognormal"
+        self.latency_spread = latency_spread  # uniform: +/- fraction of latency_ms; lognormal: sigma
+        self.token_rate = token_rate          # Generated tokens per second; 0 sends the answer at once
+        self.answer_tokens = answer_tokens    # Tokens per answer
+        self.error_rate = error_rate          # Fraction of requests answered with one of error_statuses
+        self.error_statuses = tuple(error_statuses)
+        self.hang_rate = hang_rate            # Fraction of requests that never answer (exercises client timeouts)
+        self.rng = random.Random(seed)
+
+    def first_token_delay(self):
+        """Seconds before the first token, drawn from the configured distribution."""
+        mean = self.latency_ms / 1000
+        if self.latency_dist == "fixed":
+            return mean
+        if self.latency_dist == "uniform":
+            return max(0.0, self.rng.uniform(mean * (1 - self.latency_spread), mean * (1 + self.latency_spread)))
+        if self.latency_dist == "exponential":
+            return self.rng.expovariate(1 / mean) if mean > 0 else 0.0
+        if self.latency_dist == "lognormal":
+            return mean * self.rng.lognormvariate(0, self.latency_spread)
+        raise ValueError(f"Unknown latency distribution: {self.latency_dist}")
+
+
+def _answer_tokens(messages, count):
+    """A deterministic answer: the start of the question echoed back, padded with filler words."""
+    question = next((m.get("content", "") for m in reversed(messages) if m.get("role") == "user"), "")
+    # rag_utils.build_messages puts the question after the context
+    question = question.rsplit("Question:", 1)[-1].strip().splitlines()[0][:60] if question.strip() else ""
+    words = [f"[stub] {question}"] if question else []
+    words += [FILLER[position % len(FILLER)] for position in range(max(0, count - len(words)))]
+    return [word + " " for word in words[:count]]
+
+
+def create_app(config):
+    """An OpenAI-compatible chat-completions server (streaming included) with simulated latency and failures."""
+    app = FastAPI(title="Stub LLM")
+    stats = {"requests": 0, "errors": 0, "hangs": 0, "in_flight": 0, "max_in_flight": 0}
+    completion_ids = iter(range(1, 1 << 62))
+
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        streaming = bool(body.get("stream"))
+        streamed = False  # Once the response streams, its generator ends the request
+        try:
+            roll = config.rng.random()
+            if roll < config.hang_rate:
+                stats["hangs"] += 1
+                await asyncio.sleep(3600)
+            await asyncio.sleep(config.first_token_delay())
+            if roll < config.hang_rate + config.error_rate:
+                stats["errors"] += 1
+                status = config.rng.choice(config.error_statuses)
+                headers = {"Retry-After": "1"} if status == 429 else None
+                return JSONResponse({"error": {"message": f"Injected stub error ({status})", "type": "stub_error",
+                                               "code": status}}, status_code=status, headers=headers)
+
+            model = body.get("model", "stub")
+            tokens = _answer_tokens(body.get("messages", []), config.answer_tokens)
+            completion_id = f"chatcmpl-stub-{next(completion_ids)}"
+            created = int(time.time())
+            if not streaming:
+                if config.token_rate > 0:
+                    await asyncio.sleep(len(tokens) / config.token_rate)
+                prompt_chars = sum(len(m.get("content", "")) for m in body.get("messages", []))
+                return {
+                    "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": "".join(tokens).strip()}}],
+                    "usage": {"prompt_tokens": prompt_chars // 4, "completion_tokens": len(tokens),
+                              "total_tokens": prompt_chars // 4 + len(tokens)},
+                }
+            streamed = True
+        finally:
+            if not streamed:
+                stats["in_flight"] -= 1
+
+        async def events():
+            try:
+                for position, token in enumerate(tokens):
+                    if position and config.token_rate > 0:
+                        await asyncio.sleep(1 / config.token_rate)
+                    delta = {"role": "assistant", "content": token} if position == 0 else {"content": token}
+                    chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                             "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                         "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+                yield "data: [DONE]\n\n"
+            finally:
+                stats["in_flight"] -= 1
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    async def list_models():
+        return {"object": "list", "data": [{"id": "deepseek-chat", "object": "model", "created": 0, "owned_by": "stub"}]}
+
+    async def get_stats():
+        return stats
+
+    # Both with and without /v1, so either form of base URL works
+    for prefix in ("", "/v1"):
+        app.add_api_route(f"{prefix}/chat/completions", chat_completions, methods=["POST"])
+        app.add_api_route(f"{prefix}/models", list_models, methods=["GET"])
+    app.add_api_route("/stub/stats", get_stats, methods=["GET"])
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible stub LLM for load tests and offline runs.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-ms", type=float, default=800.0, help="Median/mean time to first token.")
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "exponential", "lognormal"], default="lognormal")
+    parser.add_argument("--latency-spread", type=float, default=0.5, help="uniform: +/- fraction of the latency; lognormal: sigma.")
+    parser.add_argument("--token-rate", type=float, default=40.0, help="Generated tokens per second (0: instant).")
+    parser.add_argument("--answer-tokens", type=int, default=120)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with an error status.")
+    parser.add_argument("--error-statuses", type=int, nargs="+", default=[429, 500, 502, 503])
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="Fraction of requests that never answer.")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    import uvicorn
+
+    config = StubConfig(args.latency_ms, args.latency_dist, args.latency_spread, args.token_rate, args.answer_tokens,
+                        args.error_rate, args.error_statuses, args.hang_rate, args.seed)
+    logger.info(f"Starting stub LLM on http://{args.host}:{args.port} ({vars(args)})")
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
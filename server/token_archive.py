@@ -0,0 +1,142 @@
+import os
+import json
+import heapq
+import threading
+from datetime import datetime, timezone
+import logger
+
+SEGMENT_SUFFIX = ".jsonl"
+_START_FORMAT = "%Y-%m-%dT%H"
+
+
+class SegmentedTokenArchive:
+    """
+    Expired-token archive partitioned by expiry time into append-only segment files.
+
+    Each segment holds the tokens whose `expired_at` falls in one window of
+    `segment_hours` (UTC-aligned), one JSON record per line, in a file named after
+    the window: `2026-10-17T00_24h.jsonl`. Archiving appends to the current
+    segments only; retention deletes whole segments and rewrites at most the one
+    that straddles its cutoff; history reads segments newest first and stops as
+    soon as older ones cannot hold a newer token. The cost of each operation
+    depends on the segments it touches, not on the archive's age.
+    """
+
+    def __init__(self, directory, segment_hours=24):
+        self.directory = directory
+        self.segment_seconds = int(segment_hours * 3600)
+        self._lock = threading.Lock()
+
+    def init(self, legacy_file=None):
+        """Creates the directory; moves the records of a legacy single-file archive into segments once."""
+        os.makedirs(self.directory, exist_ok=True)
+        if legacy_file and os.path.exists(legacy_file):
+            try:
+                with open(legacy_file, "r") as f:
+                    records = json.load(f).get("expired_tokens", [])
+            except Exception as e:
+                logger.error(f"Error loading {legacy_file}; not migrating it: {e}")
+                return
+            self.append(records)
+            os.replace(legacy_file, f"{legacy_file}.migrated")
+            logger.info(f"Moved {len(records)} expired tokens from {legacy_file} into segments in {self.directory}")
+
+    def _segment_name(self, expired_at):
+        start = expired_at - expired_at % self.segment_seconds
+        label = datetime.fromtimestamp(start, timezone.utc).strftime(_START_FORMAT)
+        return f"{label}_{self.segment_seconds // 3600}h{SEGMENT_SUFFIX}"
+
+    @staticmethod
+    def _segment_bounds(name):
+        """(start, end) epoch seconds of a segment file name, or None if it isn't one."""
+        try:
+            label, hours = name[:-len(SEGMENT_SUFFIX)].split("_")
+            start = int(datetime.strptime(label, _START_FORMAT).replace(tzinfo=timezone.utc).timestamp())
+            return start, start + int(hours.rstrip("h")) * 3600
+        except ValueError:
+            return None
+
+    def segments(self):
+        """(start, end, path) of every segment, newest first."""
+        found = []
+        for name in os.listdir(self.directory) if os.path.isdir(self.directory) else ():
+            bounds = self._segment_bounds(name) if name.endswith(SEGMENT_SUFFIX) else None
+            if bounds:
+                found.append((bounds[0], bounds[1], os.path.join(self.directory, name)))
+        found.sort(reverse=True)
+        return found
+
+    @staticmethod
+    def _read(path):
+        records = []
+        try:
+            with open(path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        records.append(json.loads(line))
+        except FileNotFoundError:
+            pass  # deleted by retention meanwhile
+        except Exception as e:
+            logger.error(f"Error reading expired-token segment {path}: {e}")
+        return records
+
+    def append(self, records):
+        """Appends records to the segments of their `expired_at`."""
+        by_segment = {}
+        for record in records:
+            by_segment.setdefault(self._segment_name(int(record.get("expired_at", 0))), []).append(record)
+        with self._lock:
+            for name, segment_records in by_segment.items():
+                with open(os.path.join(self.directory, name), "a") as f:
+                    f.write("".join(json.dumps(record) + "\n" for record in segment_records))
+
+    def records(self):
+        """Every archived record, newest segment first."""
+        for _, _, path in self.segments():
+            yield from self._read(path)
+
+    def newest(self, limit):
+        """The `limit` records with the latest `created`, newest first, reading only the segments needed."""
+        if limit <= 0:
+            return []
+        best = []  # min-heap of (created, sequence, record)
+        sequence = 0
+        # Latest end first: segments of different lengths (TOKEN_ARCHIVE_SEGMENT_HOURS changed) can overlap
+        for _, end, path in sorted(self.segments(), key=lambda segment: segment[1], reverse=True):
+            # Tokens expire after they are created, so a segment ending at `end` only has created < end,
+            # and so have all the segments after it
+            if len(best) >= limit and end <= best[0][0]:
+                break
+            for record in self._read(path):
+                item = (record.get("created", 0), sequence, record)
+                sequence += 1
+                if len(best) < limit:
+                    heapq.heappush(best, item)
+                elif item[0] > best[0][0]:
+                    heapq.heapreplace(best, item)
+        return [record for _, _, record in sorted(best, reverse=True)]
+
+    def drop_before(self, cutoff):
+        """
+        Deletes the records with `expired_at` <= `cutoff`. Returns how many there were.
+
+        Segments entirely before the cutoff are deleted; the one segment that
+        straddles it is rewritten with only its newer records.
+        """
+        dropped = 0
+        with self._lock:
+            for start, end, path in self.segments():
+                if end - 1 <= cutoff:  # expired_at < end: every record is old enough
+                    with open(path, "rb") as f:
+                        dropped += f.read().count(b"\n")
+                    os.remove(path)
+                elif start <= cutoff:
+                    records = self._read(path)
+                    kept = [record for record in records if int(record.get("expired_at", 0)) > cutoff]
+                    if len(kept) < len(records):
+                        temp_file = f"{path}.tmp"
+                        with open(temp_file, "w") as f:
+                            f.write("".join(json.dumps(record) + "\n" for record in kept))
+                        os.replace(temp_file, path)
+                        dropped += len(records) - len(kept)
+        return dropped
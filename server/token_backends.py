@@ -0,0 +1,204 @@
+import os
+import json
+import sqlite3
+import threading
+import logger
+from token_archive import SegmentedTokenArchive
+
+# Columns of a token record, in table order
+TOKEN_FIELDS = ("token", "email", "expiry", "created")
+EXPIRED_FIELDS = TOKEN_FIELDS + ("expired_at",)
+
+
+def _newest_first(records, limit=None):
+    records = sorted(records, key=lambda r: r.get("created", 0), reverse=True)
+    return records[:limit] if limit is not None else records
+
+
+class JsonTokenBackend:
+    """
+    Token persistence in files: the active tokens in one JSON file, rewritten on
+    every write, and the expired tokens in a SegmentedTokenArchive, appended to
+    and dropped by time segment. A legacy single-file archive is split into
+    segments on first use.
+    """
+
+    name = "json"
+
+    def __init__(self, token_file, archive_dir, segment_hours=24, legacy_expired_file=None):
+        self.token_file = token_file
+        self.archive = SegmentedTokenArchive(archive_dir, segment_hours)
+        self.legacy_expired_file = legacy_expired_file
+
+    def init(self):
+        """Creates the token file and archive directory if they don't exist."""
+        if not os.path.exists(self.token_file):
+            self._write_json(self.token_file, {"tokens": []})
+            logger.info(f"Token storage initialized at {self.token_file}")
+        self.archive.init(self.legacy_expired_file)
+
+    @staticmethod
+    def _read_json(path, key):
+        try:
+            if os.path.exists(path):
+                with open(path, "r") as f:
+                    return json.load(f).get(key, [])
+            return []
+        except Exception as e:
+            logger.error(f"Error loading {path}: {e}")
+            return []
+
+    @staticmethod
+    def _write_json(path, data):
+        """Writes atomically: a crash mid-write leaves the previous file intact."""
+        temp_file = f"{path}.tmp"
+        with open(temp_file, "w") as f:
+            json.dump(data, f)
+        os.replace(temp_file, path)
+
+    def load_active(self):
+        return self._read_json(self.token_file, "tokens")
+
+    def write_active(self, changes, records):
+        """Persists the active tokens; `changes` (token -> record, or None if removed) is ignored, the file is rewritten."""
+        self._write_json(self.token_file, {"tokens": records()})
+
+    def archive_expired(self, records):
+        """Appends expired token records to the archive."""
+        self.archive.append(records)
+
+    def find_expired(self, token):
+        return next((t for t in self.archive.records() if t.get("token") == token), None)
+
+    def expired_for_email(self, email):
+        return _newest_first(t for t in self.archive.records() if t.get("email") == email)
+
+    def expired_history(self, limit):
+        return self.archive.newest(limit)
+
+    def clear_expired_before(self, cutoff):
+        """Drops the archived tokens that expired at or before `cutoff`. Returns how many there were."""
+        return self.archive.drop_before(cutoff)
+
+    def close(self):
+        pass
+
+
+class SqliteTokenBackend:
+    """
+    Token persistence in a SQLite database in WAL mode, with indexes on token,
+    email, created and expired_at. Active-token writes are incremental upserts and
+    deletes; archive queries are indexed LIMIT queries. On first use, tokens from
+    the json backend's files (token file, archive segments, legacy archive file)
+    are imported once and renamed to *.migrated.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, db_file, legacy_token_file=None, legacy_expired_file=None, legacy_archive_dir=None):
+        self.db_file = db_file
+        self.legacy_token_file = legacy_token_file
+        self.legacy_expired_file = legacy_expired_file
+        self.legacy_archive_dir = legacy_archive_dir
+        self._db = None
+        self._lock = threading.Lock()  # the connection is shared by the event loop and the writer thread
+
+    def init(self):
+        """Opens (creating if needed) the database and migrates the JSON files on first use."""
+        self._db = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")  # durable across application crashes; WAL keeps it consistent
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS tokens (
+                    token TEXT PRIMARY KEY, email TEXT NOT NULL, expiry INTEGER NOT NULL, created INTEGER NOT NULL);
+                CREATE INDEX IF NOT EXISTS tokens_email ON tokens (email);
+                CREATE INDEX IF NOT EXISTS tokens_created ON tokens (created);
+                CREATE TABLE IF NOT EXISTS expired_tokens (
+                    id INTEGER PRIMARY KEY, token TEXT NOT NULL, email TEXT, expiry INTEGER, created INTEGER,
+                    expired_at INTEGER);
+                CREATE INDEX IF NOT EXISTS expired_tokens_token ON expired_tokens (token);
+                CREATE INDEX IF NOT EXISTS expired_tokens_email ON expired_tokens (email, created);
+                CREATE INDEX IF NOT EXISTS expired_tokens_created ON expired_tokens (created);
+                CREATE INDEX IF NOT EXISTS expired_tokens_expired_at ON expired_tokens (expired_at);
+            """)
+        logger.info(f"Token database opened at {self.db_file} (WAL)")
+        self._migrate_json()
+
+    def _migrate_json(self):
+        legacy_files = [path for path in (self.legacy_token_file, self.legacy_expired_file, self.legacy_archive_dir)
+                        if path and os.path.exists(path)]
+        if not legacy_files:
+            return
+        with self._lock:
+            populated = self._db.execute("SELECT EXISTS (SELECT 1 FROM tokens) OR EXISTS (SELECT 1 FROM expired_tokens)").fetchone()[0]
+        if populated:
+            logger.warning(f"Token database is not empty; not migrating {', '.join(legacy_files)}")
+            return
+        active = JsonTokenBackend._read_json(self.legacy_token_file, "tokens") if self.legacy_token_file else []
+        expired = JsonTokenBackend._read_json(self.legacy_expired_file, "expired_tokens") if self.legacy_expired_file else []
+        if self.legacy_archive_dir and os.path.isdir(self.legacy_archive_dir):
+            expired.extend(SegmentedTokenArchive(self.legacy_archive_dir).records())
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "INSERT OR REPLACE INTO tokens (token, email, expiry, created) VALUES (?, ?, ?, ?)",
+                ([t.get(field, 0) for field in TOKEN_FIELDS] for t in active if t.get("token")))
+            self._db.executemany(
+                "INSERT INTO expired_tokens (token, email, expiry, created, expired_at) VALUES (?, ?, ?, ?, ?)",
+                ([t.get(field, 0) for field in EXPIRED_FIELDS] for t in expired if t.get("token")))
+            self._db.execute("COMMIT")
+        for path in legacy_files:
+            os.replace(path, f"{path}.migrated")
+        logger.info(f"Migrated {len(active)} active and {len(expired)} expired tokens from JSON into {self.db_file}")
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            cursor = self._db.execute(sql, params)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def load_active(self):
+        return self._query("SELECT token, email, expiry, created FROM tokens")
+
+    def write_active(self, changes, records):
+        """Applies `changes` (token -> record, or None if removed) in one transaction; `records` is not needed."""
+        upserts = [[record[field] for field in TOKEN_FIELDS] for record in changes.values() if record is not None]
+        deletes = [(token,) for token, record in changes.items() if record is None]
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany("DELETE FROM tokens WHERE token = ?", deletes)
+                self._db.executemany("INSERT OR REPLACE INTO tokens (token, email, expiry, created) VALUES (?, ?, ?, ?)", upserts)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def archive_expired(self, records):
+        with self._lock:
+            self._db.executemany(
+                "INSERT INTO expired_tokens (token, email, expiry, created, expired_at) VALUES (?, ?, ?, ?, ?)",
+                ([t.get(field, 0) for field in EXPIRED_FIELDS] for t in records))
+
+    def find_expired(self, token):
+        rows = self._query("SELECT token, email, expiry, created, expired_at FROM expired_tokens WHERE token = ? LIMIT 1", (token,))
+        return rows[0] if rows else None
+
+    def expired_for_email(self, email):
+        return self._query(
+            "SELECT token, email, expiry, created, expired_at FROM expired_tokens WHERE email = ? ORDER BY created DESC", (email,))
+
+    def expired_history(self, limit):
+        return self._query(
+            "SELECT token, email, expiry, created, expired_at FROM expired_tokens ORDER BY created DESC LIMIT ?", (limit,))
+
+    def clear_expired_before(self, cutoff):
+        with self._lock:
+            return self._db.execute("DELETE FROM expired_tokens WHERE expired_at <= ?", (cutoff,)).rowcount
+
+    def close(self):
+        if self._db is not None:
+            with self._lock:
+                self._db.close()
+            self._db = None
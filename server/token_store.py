@@ -0,0 +1,164 @@
+import time
+import heapq
+import atexit
+import threading
+import logger
+
+
+class TokenStore:
+    """
+    In-memory index of the active tokens, persisted in the background (write-behind).
+
+    Tokens live in a dict keyed by token, with a secondary index from email to
+    its tokens and a min-heap of (expiry, token) so expired tokens are found
+    without a scan. Lookups never touch the disk: changes are recorded as pending
+    and a writer thread hands them to `write(changes, records)` at most once every
+    `write_delay` seconds, and once more on flush() (called at shutdown and exit).
+    `changes` maps each changed token to its record, or None if it was removed;
+    `records` returns all active records, for backends that rewrite everything.
+    Heap entries are not removed when a token is replaced; stale ones are skipped
+    when popped.
+    """
+
+    def __init__(self, write, write_delay=1.0):
+        self._write = write
+        self.write_delay = write_delay
+        self._tokens = {}    # token -> record
+        self._by_email = {}  # email -> set of tokens
+        self._expiry_heap = []  # (expiry, token)
+        self._pending = {}   # token -> record, or None if removed; not yet written
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()  # one save at a time
+        self._dirty = threading.Event()
+        self._writer = None
+        atexit.register(self.flush)
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def load(self, records):
+        """Replaces the contents with `records` (e.g. read from disk at startup)."""
+        with self._lock:
+            self._tokens.clear()
+            self._by_email.clear()
+            self._expiry_heap = []
+            for record in records:
+                self._insert(record)
+                self._expiry_heap.append((record.get("expiry", 0), record["token"]))
+            heapq.heapify(self._expiry_heap)
+            self._pending.clear()
+
+    def _insert(self, record):
+        token = record["token"]
+        if token in self._tokens:
+            self._remove(token)
+        self._tokens[token] = record
+        self._by_email.setdefault(record.get("email"), set()).add(token)
+
+    def _remove(self, token):
+        record = self._tokens.pop(token)
+        self._pending[token] = None
+        tokens = self._by_email.get(record.get("email"))
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._by_email[record.get("email")]
+        return record
+
+    def add(self, record):
+        """Adds a token, replacing every other token of the same email. Returns the replaced records."""
+        with self._lock:
+            replaced = [self._remove(token) for token in list(self._by_email.get(record.get("email"), ()))]
+            if record["token"] in self._tokens:
+                replaced.append(self._remove(record["token"]))
+            self._insert(record)
+            self._pending[record["token"]] = record
+            heapq.heappush(self._expiry_heap, (record.get("expiry", 0), record["token"]))
+        self._mark_dirty()
+        return replaced
+
+    def get(self, token):
+        """The record of an active token, or None."""
+        return self._tokens.get(token)
+
+    def __contains__(self, token):
+        return token in self._tokens
+
+    def tokens_for_email(self, email):
+        with self._lock:
+            return [self._tokens[token] for token in self._by_email.get(email, ())]
+
+    def records(self):
+        with self._lock:
+            return list(self._tokens.values())
+
+    def next_expiry(self):
+        """Expiry time of the token that expires first, or None if the store is empty."""
+        with self._lock:
+            while self._expiry_heap:
+                expiry, token = self._expiry_heap[0]
+                record = self._tokens.get(token)
+                if record is not None and record.get("expiry", 0) == expiry:
+                    return expiry
+                heapq.heappop(self._expiry_heap)  # stale: token replaced or removed
+            return None
+
+    def count_expired(self, now):
+        """Number of tokens with expiry <= `now` still in the store; visits only the heap entries that are due."""
+        count = 0
+        with self._lock:
+            heap = self._expiry_heap
+            stack = [0] if heap else []
+            while stack:
+                position = stack.pop()
+                expiry, token = heap[position]
+                if expiry > now:
+                    continue  # the whole subtree expires later
+                record = self._tokens.get(token)
+                if record is not None and record.get("expiry", 0) == expiry:
+                    count += 1
+                stack.extend(child for child in (2 * position + 1, 2 * position + 2) if child < len(heap))
+        return count
+
+    def pop_expired(self, now):
+        """Removes and returns the records of all tokens with expiry <= `now`, soonest first."""
+        expired = []
+        with self._lock:
+            while self._expiry_heap and self._expiry_heap[0][0] <= now:
+                expiry, token = heapq.heappop(self._expiry_heap)
+                record = self._tokens.get(token)
+                if record is not None and record.get("expiry", 0) == expiry:
+                    expired.append(self._remove(token))
+        if expired:
+            self._mark_dirty()
+        return expired
+
+    def _mark_dirty(self):
+        self._dirty.set()
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run_writer, name="token-writer", daemon=True)
+                self._writer.start()
+
+    def _run_writer(self):
+        while True:
+            self._dirty.wait()
+            time.sleep(self.write_delay)  # let a burst of changes accumulate into one write
+            self.flush()
+
+    def flush(self):
+        """Writes pending changes now, if there are any."""
+        with self._write_lock:
+            if not self._dirty.is_set():
+                return
+            with self._lock:
+                self._dirty.clear()
+                changes, self._pending = self._pending, {}
+            try:
+                self._write(changes, self.records)
+            except Exception as e:
+                logger.error(f"Error persisting tokens: {e}")
+                with self._lock:
+                    for token, record in changes.items():
+                        self._pending.setdefault(token, record)  # newer changes win
+                self._dirty.set()
@@ -0,0 +1,89 @@
+import os
+import time
+import asyncio
+import logger
+from metrics import LatencyStats
+
+# --- Constants ---
+TOKEN_SWEEP_BATCH_WINDOW = float(os.getenv("TOKEN_SWEEP_BATCH_WINDOW", "1"))  # Min seconds between sweeps; tokens expiring within it are archived in one write
+TOKEN_SWEEP_MAX_WAIT = float(os.getenv("TOKEN_SWEEP_MAX_WAIT", "60"))  # Max seconds between checks of the next expiry time
+
+
+class TokenExpirySweeper:
+    """
+    Moves tokens to the archive when they expire, from a background task.
+
+    The task sleeps until the expiry time of the first token to expire, read from
+    the token store's min-heap, and then calls `sweep(now)`, which moves every
+    token expired by `now` in one archive write. Sweeps are at least
+    `batch_window` seconds apart, so tokens that expire close together are
+    archived together rather than one write each. The wait is capped at
+    `max_wait` seconds so a token that expires sooner than the one waited for
+    (e.g. after a reload of the storage) is not missed.
+    """
+
+    def __init__(self, sweep, next_expiry, count_expired, batch_window=TOKEN_SWEEP_BATCH_WINDOW,
+                 max_wait=TOKEN_SWEEP_MAX_WAIT):
+        self._sweep = sweep                  # sweep(now) -> number of tokens moved; blocking, run in a thread
+        self._next_expiry = next_expiry      # () -> earliest expiry time, or None
+        self._count_expired = count_expired  # (now) -> expired tokens not moved yet
+        self.batch_window = batch_window
+        self.max_wait = max_wait
+        self.sweeps = 0
+        self.tokens_expired = 0
+        self.errors = 0
+        self.last_batch = 0
+        self.max_batch = 0
+        self._last_sweep = 0.0
+        self.sweep_duration = LatencyStats()  # Time spent in one sweep, archive write included
+        self.expiry_lag = LatencyStats()      # Expiry time of the first token of a sweep -> start of the sweep
+
+    async def run(self):
+        while True:
+            try:
+                next_expiry = self._next_expiry()
+                now = time.time()
+                if next_expiry is None:
+                    await asyncio.sleep(self.max_wait)
+                    continue
+                due = max(next_expiry, self._last_sweep + self.batch_window)
+                if due > now:
+                    await asyncio.sleep(min(due - now, self.max_wait))
+                    continue  # the first expiry may have changed meanwhile
+                await self.sweep_now(next_expiry)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Token sweeper error: {e}")
+                await asyncio.sleep(max(self.batch_window, 1.0))
+
+    async def sweep_now(self, first_expiry=None):
+        """Moves every expired token to the archive. Returns how many were moved."""
+        start = time.perf_counter()
+        self._last_sweep = now = time.time()
+        if first_expiry is not None:
+            self.expiry_lag.record(max(0.0, now - first_expiry) * 1000)
+        moved = await asyncio.to_thread(self._sweep, int(now))
+        self.sweep_duration.record((time.perf_counter() - start) * 1000)
+        self.sweeps += 1
+        self.tokens_expired += moved
+        self.last_batch = moved
+        self.max_batch = max(self.max_batch, moved)
+        if moved:
+            logger.info(f"Token sweeper archived {moved} expired tokens in {(time.perf_counter() - start) * 1000:.1f} ms.")
+        return moved
+
+    def stats(self):
+        next_expiry = self._next_expiry()
+        return {
+            "sweeps": self.sweeps,
+            "tokens_expired": self.tokens_expired,
+            "errors": self.errors,
+            "backlog": self._count_expired(int(time.time())),  # Expired tokens waiting for the next sweep
+            "last_batch": self.last_batch,
+            "max_batch": self.max_batch,
+            "next_expiry_in_s": round(next_expiry - time.time(), 1) if next_expiry is not None else None,
+            "sweep_duration": self.sweep_duration.stats(),
+            "expiry_lag": self.expiry_lag.stats(),
+        }
@@ -0,0 +1,190 @@
+import os
+import time
+import random
+import asyncio
+from collections import Counter
+import logger
+
+# --- Constants ---
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "32"))  # Max open connections to the LLM API
+UPSTREAM_KEEPALIVE_CONNECTIONS = int(os.getenv("UPSTREAM_KEEPALIVE_CONNECTIONS", "32"))  # Idle connections kept open for reuse
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "60"))  # Seconds an idle connection stays open
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))  # Seconds to connect (or wait for a pooled connection)
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "30"))  # Seconds without data from the API before an attempt fails
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "2"))  # Retries after a 429, 5xx, timeout or connection error
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.5"))  # Seconds; doubles per retry, with full jitter
+UPSTREAM_BACKOFF_MAX = float(os.getenv("UPSTREAM_BACKOFF_MAX", "8"))  # Seconds; also caps a Retry-After from the API
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))  # Consecutive failed attempts that open the circuit; 0 disables
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))  # Seconds the circuit stays open before a trial call
+
+
+class UpstreamUnavailable(Exception):
+    """Raised instead of calling the LLM API while the circuit breaker is open."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after  # Seconds until a call will be let through again
+
+
+class CircuitBreaker:
+    """
+    Stops calling an upstream that keeps failing.
+
+    Closed: calls go through; `failure_threshold` consecutive failures open it.
+    Open: calls fail at once with UpstreamUnavailable for `reset_timeout` seconds.
+    Half-open: one trial call goes through; success closes the circuit, failure
+    opens it again. Used from the event loop only, so it needs no lock.
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0  # Consecutive
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+        self._trial_in_flight = False
+
+    def before_call(self):
+        """Raises UpstreamUnavailable if the call must not go through."""
+        if self.failure_threshold <= 0:
+            return
+        if self.state == "open":
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                self.rejected += 1
+                raise UpstreamUnavailable(
+                    f"LLM API circuit open after {self.failures} consecutive failures; "
+                    f"next attempt in {remaining:.0f}s", remaining)
+            self.state = "half_open"
+            logger.info("LLM API circuit half-open; sending a trial call.")
+        if self.state == "half_open":
+            if self._trial_in_flight:
+                self.rejected += 1
+                raise UpstreamUnavailable("LLM API circuit half-open; waiting for the trial call", 1.0)
+            self._trial_in_flight = True
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info("LLM API circuit closed; upstream is answering again.")
+        self.state = "closed"
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.failure_threshold > 0 and (self.state == "half_open" or self.failures >= self.failure_threshold):
+            if self.state != "open":
+                self.times_opened += 1
+                logger.warning(f"LLM API circuit open after {self.failures} consecutive failures; "
+                               f"failing fast for {self.reset_timeout:.0f}s.")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """Forgets a call that ended without telling anything about upstream health (e.g. cancelled)."""
+        self._trial_in_flight = False
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected,
+        }
+
+
+# Shared by every upstream call of the server
+upstream_breaker = CircuitBreaker()
+# Cumulative attempt/retry/failure counters, reported at GET /admin/metrics
+upstream_stats = Counter()
+
+
+def create_client(api_key, base_url):
+    """
+    Creates the openai.AsyncOpenAI client with an explicit connection pool and
+    timeouts. The SDK's own retries are disabled: call_upstream retries instead,
+    so that every attempt is seen by the circuit breaker.
+    """
+    import openai  # deferred: the SDK is the slowest import of the server
+    # The SDK's own Limits type, so this works with whichever HTTP library it is built on
+    limits = type(openai.DEFAULT_CONNECTION_LIMITS)(
+        max_connections=UPSTREAM_POOL_SIZE,
+        max_keepalive_connections=min(UPSTREAM_KEEPALIVE_CONNECTIONS, UPSTREAM_POOL_SIZE),
+        keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+    )
+    timeout = openai.Timeout(UPSTREAM_READ_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT)
+    return openai.AsyncOpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        timeout=timeout,
+        max_retries=0,
+        http_client=openai.DefaultAsyncHttpxClient(limits=limits, timeout=timeout),
+    )
+
+
+def _is_retryable(error, openai):
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, openai.APIConnectionError)  # Includes APITimeoutError
+
+
+def _retry_after(error):
+    """Seconds from a Retry-After header on the error's response, if any."""
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Full-jitter exponential backoff before retry number `attempt` (0-based), honoring Retry-After."""
+    delay = random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, UPSTREAM_BACKOFF_MAX))
+    return delay
+
+
+async def call_upstream(request, retries=UPSTREAM_MAX_RETRIES, breaker=upstream_breaker):
+    """
+    Awaits `request()`, a function returning a fresh awaitable SDK call, retrying
+    429/5xx/timeout/connection errors with jittered backoff. Raises
+    UpstreamUnavailable without calling upstream while the circuit is open;
+    otherwise the last error once retries are exhausted.
+    """
+    import openai
+    attempt = 0
+    while True:
+        breaker.before_call()
+        upstream_stats["attempts"] += 1
+        try:
+            result = await request()
+        except Exception as e:
+            if not _is_retryable(e, openai):
+                if isinstance(e, openai.APIStatusError):
+                    breaker.record_success()  # Upstream is up; it rejected this request
+                else:
+                    breaker.release()
+                raise
+            upstream_stats["failures"] += 1
+            breaker.record_failure()
+            if attempt >= retries:
+                raise
+            delay = backoff_delay(attempt, _retry_after(e))
+            attempt += 1
+            upstream_stats["retries"] += 1
+            logger.warning(f"LLM API call failed ({type(e).__name__}: {e}); retry {attempt}/{retries} in {delay:.2f}s.")
+            await asyncio.sleep(delay)
+        except BaseException:
+            breaker.release()
+            raise
+        else:
+            breaker.record_success()
+            return result
+
+
+def upstream_metrics():
+    return {"circuit": upstream_breaker.stats(), **upstream_stats}
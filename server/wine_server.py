@@ -1,30 +1,51 @@
 import os
+import json
+import secrets
+import time
+import asyncio
+from contextlib import contextmanager
 from dotenv import load_dotenv
-import openai
 import argparse
-import uvicorn
-from fastapi import FastAPI, HTTPException, Request, APIRouter, Depends, Response, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
+from typing import Optional
+from fastapi import FastAPI, HTTPException, Request, APIRouter, Depends, Response, Form, Header
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.security import APIKeyHeader
 from pydantic import BaseModel, EmailStr
-from rag_utils import load_knowledge, rag_query, KNOWLEDGE_DIR
+from rag_utils import load_knowledge_index, knowledge_fingerprint, rag_query, rag_query_stream, rag_query_batch, retrieve_context, retrieval_cache, answer_cache, context_stats, query_flights, KNOWLEDGE_DIR, ANSWER_CACHE_FILE, CONTEXT_TOKEN_BUDGET, CONTEXT_DEDUP_THRESHOLD
 import logger
 import acl
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.status import HTTP_307_TEMPORARY_REDIRECT, HTTP_401_UNAUTHORIZED
 from datetime import datetime
 from acl import TOKEN_EXPIRY_HOURS
+from knowledge_index import warm_up_tokenizer
+from metrics import LatencyStats
+from upstream import UpstreamUnavailable, create_client, upstream_metrics
+from token_sweeper import TokenExpirySweeper
 
 # Load environment variables
 load_dotenv()
 llm_api_key = os.getenv("LLM_API_KEY")
-api_base_url = "https://api.deepseek.com"
+api_base_url = os.getenv("LLM_API_BASE_URL", "https://api.deepseek.com")  # Any OpenAI-compatible API, e.g. server/stub_llm.py
+KNOWLEDGE_RELOAD_INTERVAL = float(os.getenv("KNOWLEDGE_RELOAD_INTERVAL", "30"))  # Seconds between change polls; 0 disables
+BATCH_MAX_QUERIES = int(os.getenv("BATCH_MAX_QUERIES", "10000"))  # Largest accepted POST /api/query/batch
+UPSTREAM_WARMUP_TIMEOUT = float(os.getenv("UPSTREAM_WARMUP_TIMEOUT", "5"))  # Seconds; 0 skips opening the upstream connection at startup
+EMAIL_SHUTDOWN_TIMEOUT = float(os.getenv("EMAIL_SHUTDOWN_TIMEOUT", "10"))  # Seconds queued token emails may take to send at shutdown
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")  # Secret for the /admin endpoints (X-Admin-Token header); empty disables them
 
 # --- Global Variables (initialized at startup) ---
-client = None
+client = None  # Created on first use or by the warm-up, see get_client()
+_client_attempted = False
+_client_lock = asyncio.Lock()
 knowledge_base = None
 is_single_file_load = False
 IS_DRY_RUN = False  # Global flag for dry-run mode
+last_reload = None  # Stats of the most recent knowledge (re)load
+_reload_lock = asyncio.Lock()
+startup_phases = {}  # Startup phase name -> duration in ms, in the order the phases ran
+is_ready = False  # Set once the warm-up after startup has finished
+time_to_first_token = LatencyStats()  # Streamed queries: request received -> first answer text sent
+token_sweeper = TokenExpirySweeper(acl.cleanup_tokens, acl.next_token_expiry, acl.count_expired_tokens)  # Archives tokens as they expire
 
 # --- Server Setup & Initialization ---
 app = FastAPI(title="葡萄酒智能助手 API", description="使用LLM的葡萄酒知识检索API")
@@ -32,13 +53,23 @@ app = FastAPI(title="葡萄酒智能助手 API", description="使用LLM的葡萄
 # Create API router with prefix
 api_router = APIRouter(prefix="/api")
 
+# Admin endpoints require the X-Admin-Token header to match ADMIN_TOKEN; with no ADMIN_TOKEN set they are disabled
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin API disabled: set ADMIN_TOKEN to enable it")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
 # Create admin router with prefix
-admin_router = APIRouter(prefix="/admin")
+admin_router = APIRouter(prefix="/admin", dependencies=[Depends(require_admin)])
 
 # Define request models
 class QueryRequest(BaseModel):
     query: str
 
+class BatchQueryRequest(BaseModel):
+    queries: list[str]
+
 class TokenRequest(BaseModel):
     email: EmailStr
 
@@ -54,6 +85,7 @@ class TokenValidationMiddleware(BaseHTTPMiddleware):
         # Skip token validation for token request endpoints and static files
         if (request.url.path == "/request-token" or 
             request.url.path == "/api/tokens" or
+            request.url.path == "/api/ready" or
             request.url.path == "/submit-token-request"):
             return await call_next(request)
             
@@ -86,45 +118,241 @@ class TokenValidationMiddleware(BaseHTTPMiddleware):
 # Add middleware to app
 app.add_middleware(TokenValidationMiddleware)
 
+@contextmanager
+def _startup_phase(name):
+    """Times one startup phase and records it in startup_phases."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_phases[name] = round((time.perf_counter() - start) * 1000, 1)
+        logger.info(f"Startup phase '{name}' took {startup_phases[name]} ms.")
+
 def initialize_app(dry_run_mode=False):
-    global client, knowledge_base, is_single_file_load, IS_DRY_RUN
+    global knowledge_base, is_single_file_load, IS_DRY_RUN
     IS_DRY_RUN = dry_run_mode
     logger.info(f"Initializing Wine-AI RAG server... (Dry Run: {IS_DRY_RUN})")
     
-    # Initialize token storage
-    acl.init_token_storage()
-    logger.info("ACL token system initialized")
-    
-    # Clean up expired tokens
-    acl.cleanup_tokens()
+    with _startup_phase("acl"):
+        # Initialize token storage
+        acl.init_token_storage()
+        logger.info("ACL token system initialized")
+        
+        # Clean up expired tokens
+        acl.cleanup_tokens()
 
-    # Initialize OpenAI Client
-    if llm_api_key:
-        logger.info("Attempting to initialize OpenAI client...")
-        try:
-            client = openai.OpenAI(
-                api_key=llm_api_key,
-                base_url=api_base_url
-            )
-            logger.info("OpenAI client initialized successfully.")
-        except Exception as e:
-            logger.critical(f"Fatal: Error initializing OpenAI client: {e}")
-            client = None
-    else:
+    # The OpenAI client is created by the warm-up (or the first query), off the startup path
+    if not llm_api_key:
         logger.critical("Fatal: LLM_API_KEY not found.")
         # If no key, client remains None, crucial check later
 
     # Load Knowledge Base using the imported function
-    logger.info(f"Attempting to load wine knowledge base from: {KNOWLEDGE_DIR}")
-    kb, is_single = load_knowledge(KNOWLEDGE_DIR)
-    if kb is not None:
-        knowledge_base = kb
-        is_single_file_load = is_single
-        logger.info("Wine knowledge base loaded.")
-    else:
-        logger.warning("Warning: Failed to load wine knowledge base.")
-        knowledge_base = None
-        is_single_file_load = False
+    with _startup_phase("knowledge"):
+        logger.info(f"Attempting to load wine knowledge base from: {KNOWLEDGE_DIR}")
+        start = time.perf_counter()
+        kb, is_single = _build_knowledge(None)
+        if kb is not None:
+            knowledge_base = kb
+            is_single_file_load = is_single
+            _record_reload(None, kb, start)
+            logger.info("Wine knowledge base loaded.")
+        else:
+            logger.warning("Warning: Failed to load wine knowledge base.")
+            knowledge_base = None
+            is_single_file_load = False
+
+    # Restore answers cached before the last shutdown
+    if ANSWER_CACHE_FILE:
+        with _startup_phase("answer_cache"):
+            try:
+                restored = answer_cache.load(ANSWER_CACHE_FILE)
+                logger.info(f"Restored {restored} cached answers from {ANSWER_CACHE_FILE}.")
+            except Exception as e:
+                logger.warning(f"Could not restore answer cache from {ANSWER_CACHE_FILE}: {e}")
+
+def warm_up():
+    """
+    Pays the first-query costs up front: jieba's prefix dictionary and the lazily
+    built retrieval structures. Runs in a worker thread.
+    """
+    with _startup_phase("tokenizer"):
+        warm_up_tokenizer()
+    if knowledge_base is not None:
+        with _startup_phase("retrieval"):
+            retrieve_context("葡萄酒 wine", knowledge_base, use_cache=False)
+
+def _create_client():
+    """Creates the OpenAI client, or returns None if there is no API key or it fails. Runs in a worker thread."""
+    if not llm_api_key:
+        return None
+    logger.info("Attempting to initialize OpenAI client...")
+    try:
+        created = create_client(llm_api_key, api_base_url)
+        logger.info("OpenAI client initialized successfully.")
+        return created
+    except Exception as e:
+        logger.critical(f"Fatal: Error initializing OpenAI client: {e}")
+        return None
+
+async def get_client():
+    """
+    The OpenAI client, created on first use. Importing the SDK takes most of a
+    second, so it happens in a worker thread during the warm-up rather than at
+    startup; a query arriving first waits for the same creation.
+    """
+    global client, _client_attempted
+    if client is not None or _client_attempted:
+        return client
+    async with _client_lock:
+        if client is None and not _client_attempted:
+            with _startup_phase("llm_client"):
+                client = await asyncio.to_thread(_create_client)
+            _client_attempted = True
+    return client
+
+async def warm_up_upstream():
+    """Creates the LLM API client and opens its TCP/TLS connection so the first query does not pay for either."""
+    client = await get_client()
+    if client is not None and not IS_DRY_RUN and UPSTREAM_WARMUP_TIMEOUT > 0:
+        with _startup_phase("upstream"):
+            try:
+                await client.with_options(timeout=UPSTREAM_WARMUP_TIMEOUT, max_retries=0).models.list()
+            except Exception as e:
+                # An unreachable API does not make the server unready: queries report their own errors
+                logger.warning(f"Could not pre-open the LLM API connection: {e}")
+
+async def run_warm_up():
+    global is_ready
+    try:
+        await asyncio.gather(asyncio.to_thread(warm_up), warm_up_upstream())
+    except Exception as e:
+        logger.error(f"Warm-up failed: {e}")
+    is_ready = True
+    logger.info(f"Server ready; startup phases (ms): {startup_phases}, total {round(sum(startup_phases.values()), 1)} ms.")
+
+def _build_knowledge(previous):
+    """Loads the knowledge base off to the side. Returns (knowledge, is_single_file); knowledge is None on error."""
+    # Knowledge is indexed once here so queries never re-tokenize the corpus;
+    # unchanged files are taken from the previous index or the on-disk snapshot
+    return load_knowledge_index(KNOWLEDGE_DIR, previous=previous), os.path.isfile(KNOWLEDGE_DIR)
+
+def _diff_knowledge(previous, kb):
+    """Returns (added, changed, removed) source lists between two knowledge versions."""
+    old_docs = previous.documents if previous is not None else {}
+    new_docs = kb.documents
+    added = sorted(set(new_docs) - set(old_docs))
+    changed = sorted(source for source in set(new_docs) & set(old_docs) if new_docs[source].sha1 != old_docs[source].sha1)
+    removed = sorted(set(old_docs) - set(new_docs))
+    return added, changed, removed
+
+def _record_reload(previous, kb, start):
+    """Stamps the new knowledge version and stores the reload stats."""
+    global last_reload
+    added, changed, removed = _diff_knowledge(previous, kb)
+    kb.version = (previous.version + 1) if previous is not None else 1
+    last_reload = {
+        "version": kb.version,
+        "added": added,
+        "changed": changed,
+        "removed": removed,
+        "files": len(kb.documents),
+        "lines": len(kb),
+        "chunks": len(kb.chunks),
+        "duration_ms": round((time.perf_counter() - start) * 1000, 1),
+        "reloaded_at": int(time.time()),
+    }
+    return last_reload
+
+async def reload_knowledge():
+    """
+    Re-indexes added, changed and deleted knowledge files and swaps the new version in.
+
+    The new index is built in a worker thread from the current one, so unchanged files
+    are not re-read. The swap happens on the event loop in a single step; requests
+    already running keep the index object they started with.
+    """
+    global knowledge_base, is_single_file_load
+    async with _reload_lock:
+        start = time.perf_counter()
+        previous = knowledge_base
+        kb, is_single = await asyncio.to_thread(_build_knowledge, previous)
+        duration_ms = round((time.perf_counter() - start) * 1000, 1)
+        if kb is None:
+            logger.warning("Knowledge reload failed; keeping the current version.")
+            return {"status": "failed", "duration_ms": duration_ms}
+        if previous is not None and not any(_diff_knowledge(previous, kb)):
+            refreshed = sum(doc.mtime_ns != previous.documents[source].mtime_ns for source, doc in kb.documents.items())
+            if refreshed:
+                # Only mtimes changed: swap in the index carrying them, so later polls don't re-hash those files.
+                # The content is identical, so it keeps the version and stamp and cached results stay valid.
+                kb.version, kb.stamp = previous.version, previous.stamp
+                knowledge_base, is_single_file_load = kb, is_single
+            logger.info(f"Knowledge unchanged (checked in {duration_ms} ms, {refreshed} files with a new mtime); "
+                        f"keeping version {previous.version}.")
+            return {"status": "unchanged", "version": previous.version, "refreshed": refreshed, "duration_ms": duration_ms}
+        stats = _record_reload(previous, kb, start)
+        knowledge_base, is_single_file_load = kb, is_single
+        # Entries are keyed by index stamp so none can be served for the new version; free them now
+        retrieval_cache.clear()
+        logger.info(
+            f"Knowledge reloaded to version {stats['version']} in {stats['duration_ms']} ms "
+            f"({len(stats['added'])} added, {len(stats['changed'])} changed, {len(stats['removed'])} removed)."
+        )
+        return {"status": "reloaded", **stats}
+
+async def watch_knowledge(interval):
+    """Polls the knowledge source for changes and reloads when its stat fingerprint changes."""
+    fingerprint = await asyncio.to_thread(knowledge_fingerprint, KNOWLEDGE_DIR)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            current = await asyncio.to_thread(knowledge_fingerprint, KNOWLEDGE_DIR)
+            if current != fingerprint:
+                logger.info("Change detected in knowledge source, reloading...")
+                result = await reload_knowledge()
+                if result["status"] == "failed":
+                    # Keep the old fingerprint so the reload is retried at the next poll
+                    logger.warning(f"Knowledge reload failed; still serving the previous version, retrying in {interval:g}s.")
+                    continue
+                fingerprint = current
+        except Exception as e:
+            logger.error(f"Knowledge watcher error: {e}")
+
+@app.on_event("shutdown")
+async def persist_answer_cache():
+    if ANSWER_CACHE_FILE:
+        try:
+            saved = answer_cache.save(ANSWER_CACHE_FILE)
+            logger.info(f"Saved {saved} cached answers to {ANSWER_CACHE_FILE}.")
+        except Exception as e:
+            logger.warning(f"Could not save answer cache to {ANSWER_CACHE_FILE}: {e}")
+
+@app.on_event("shutdown")
+async def persist_tokens():
+    acl.flush_tokens()
+
+@app.on_event("shutdown")
+async def stop_email_queue():
+    await acl.email_queue.stop(EMAIL_SHUTDOWN_TIMEOUT)
+
+@app.on_event("startup")
+async def start_warm_up():
+    app.state.warm_up = asyncio.create_task(run_warm_up())
+
+@app.on_event("startup")
+async def start_knowledge_watcher():
+    if KNOWLEDGE_RELOAD_INTERVAL > 0:
+        logger.info(f"Watching '{KNOWLEDGE_DIR}' for changes every {KNOWLEDGE_RELOAD_INTERVAL:g}s.")
+        app.state.knowledge_watcher = asyncio.create_task(watch_knowledge(KNOWLEDGE_RELOAD_INTERVAL))
+
+@app.on_event("startup")
+async def start_token_sweeper():
+    app.state.token_sweeper = asyncio.create_task(token_sweeper.run())
+
+@app.on_event("startup")
+async def start_email_queue():
+    if acl.EMAIL_ENABLED:
+        acl.email_queue.start()
 
 # --- API Endpoints ---
 @api_router.get("/status")
@@ -132,10 +360,34 @@ async def get_status():
     """Endpoint to report server status, including dry-run mode."""
     return {"mode": "dry-run" if IS_DRY_RUN else "live"}
 
+@api_router.get("/ready")
+async def get_readiness(response: Response):
+    """Readiness probe: 200 once the startup warm-up has finished, 503 until then (no token required)."""
+    if not is_ready:
+        response.status_code = 503
+    return {"ready": is_ready, "phases_ms": startup_phases}
+
+def _bypass_cache(header_value):
+    """True when the X-Bypass-Cache request header asks for a fresh answer."""
+    return header_value is not None and header_value.strip().lower() in ("1", "true", "yes")
+
+def _answer_error_detail(answer):
+    """The client-facing error message when a RAG answer string reports an internal error, else None."""
+    if isinstance(answer, str) and ("error" in answer.lower() or "not loaded" in answer.lower() or "not initialized" in answer.lower()):
+        # Check specific known error messages
+        if "client is not initialized" in answer:
+            return "服务器上的OpenAI客户端未初始化。"
+        elif "knowledge base not loaded" in answer.lower():
+            return "服务器上的葡萄酒知识库未加载。"
+        else:
+            return "处理查询时出现内部错误。"
+    return None
+
 @api_router.get("/query")
-async def handle_query(query: str):
-    global client, knowledge_base, is_single_file_load, IS_DRY_RUN  # Access globals
+async def handle_query(query: str, x_bypass_cache: Optional[str] = Header(None)):
+    global knowledge_base, is_single_file_load, IS_DRY_RUN  # Access globals
 
+    client = await get_client()
     if not client:
         logger.error("OpenAI client not initialized, cannot handle query")
         raise HTTPException(status_code=500, detail="OpenAI客户端未初始化")
@@ -143,21 +395,116 @@ async def handle_query(query: str):
     logger.info(f"Received query: {query}")
 
     # Perform RAG using globally loaded knowledge and client
-    answer = rag_query(query, knowledge_base, is_single_file_load, client, IS_DRY_RUN)
+    try:
+        answer = await rag_query(query, knowledge_base, is_single_file_load, client, IS_DRY_RUN,
+                           use_cache=not _bypass_cache(x_bypass_cache))
+    except UpstreamUnavailable as e:
+        logger.error(f"Query rejected: {e}")
+        raise HTTPException(status_code=503, detail="语言模型服务暂时不可用，请稍后再试。",
+                            headers={"Retry-After": str(max(1, round(e.retry_after)))})
 
     # Check if the answer indicates an internal error occurred during RAG
-    if isinstance(answer, str) and ("error" in answer.lower() or "not loaded" in answer.lower() or "not initialized" in answer.lower()):
+    detail = _answer_error_detail(answer)
+    if detail:
         logger.error(f"Internal error processing query: {answer}")
-        # Check specific known error messages
-        if "client is not initialized" in answer:
-            raise HTTPException(status_code=500, detail="服务器上的OpenAI客户端未初始化。")
-        elif "knowledge base not loaded" in answer:
-            raise HTTPException(status_code=500, detail="服务器上的葡萄酒知识库未加载。")
-        else:
-            raise HTTPException(status_code=500, detail="处理查询时出现内部错误。")
+        raise HTTPException(status_code=500, detail=detail)
     else:
         return {"answer": answer}
 
+@api_router.post("/query")
+async def handle_query_post(query_request: QueryRequest, x_bypass_cache: Optional[str] = Header(None)):
+    """JSON-body variant of GET /api/query, as sent by the CLI and web clients"""
+    return await handle_query(query_request.query, x_bypass_cache)
+
+def _sse_event(event, data):
+    """Formats one server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@api_router.post("/query/stream")
+async def handle_query_stream(query_request: QueryRequest, x_bypass_cache: Optional[str] = Header(None)):
+    """
+    Streams the answer as server-sent events: `delta` events carry answer text as
+    the LLM generates it, followed by one `done` event with timings, or an `error` event.
+    """
+    client = await get_client()
+    if not client:
+        logger.error("OpenAI client not initialized, cannot handle query")
+        raise HTTPException(status_code=500, detail="OpenAI客户端未初始化")
+    if knowledge_base is None:
+        raise HTTPException(status_code=500, detail="服务器上的葡萄酒知识库未加载。")
+
+    query = query_request.query
+    logger.info(f"Received streaming query: {query}")
+    start = time.perf_counter()
+
+    async def events():
+        first_token_ms = None
+        try:
+            async for delta in rag_query_stream(query, knowledge_base, is_single_file_load, client, IS_DRY_RUN,
+                                                use_cache=not _bypass_cache(x_bypass_cache)):
+                if first_token_ms is None:
+                    first_token_ms = round((time.perf_counter() - start) * 1000, 1)
+                    time_to_first_token.record(first_token_ms)
+                yield _sse_event("delta", {"text": delta})
+        except UpstreamUnavailable as e:
+            logger.error(f"Streaming query rejected: {e}")
+            yield _sse_event("error", {"detail": "语言模型服务暂时不可用，请稍后再试。", "retry_after": round(e.retry_after)})
+            return
+        except Exception as e:
+            logger.error(f"Streaming query failed: {e}")
+            yield _sse_event("error", {"detail": "处理查询时出现内部错误。"})
+            return
+        total_ms = round((time.perf_counter() - start) * 1000, 1)
+        logger.info(f"Streamed answer: first token after {first_token_ms} ms, complete after {total_ms} ms.")
+        yield _sse_event("done", {"time_to_first_token_ms": first_token_ms, "total_ms": total_ms})
+
+    # X-Accel-Buffering stops reverse proxies (nginx) from holding the events back
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@api_router.post("/query/batch")
+async def handle_query_batch(batch_request: BatchQueryRequest, x_bypass_cache: Optional[str] = Header(None)):
+    """
+    Answers many queries in one request, streamed back as NDJSON in completion order:
+    one line per query, `{"index", "query", "answer"}` or `{"index", "query", "error"}`.
+    """
+    client = await get_client()
+    if not client:
+        logger.error("OpenAI client not initialized, cannot handle query")
+        raise HTTPException(status_code=500, detail="OpenAI客户端未初始化")
+    if knowledge_base is None:
+        raise HTTPException(status_code=500, detail="服务器上的葡萄酒知识库未加载。")
+    queries = batch_request.queries
+    if len(queries) > BATCH_MAX_QUERIES:
+        raise HTTPException(status_code=413, detail=f"每批最多{BATCH_MAX_QUERIES}个问题。")
+
+    logger.info(f"Received batch of {len(queries)} queries")
+    start = time.perf_counter()
+
+    async def lines():
+        errors = 0
+        async for position, answer in rag_query_batch(queries, knowledge_base, is_single_file_load, client, IS_DRY_RUN,
+                                                      use_cache=not _bypass_cache(x_bypass_cache)):
+            result = {"index": position, "query": queries[position]}
+            if isinstance(answer, UpstreamUnavailable):
+                result["error"] = "语言模型服务暂时不可用，请稍后再试。"
+            elif isinstance(answer, Exception):
+                result["error"] = "处理查询时出现内部错误。"
+            elif _answer_error_detail(answer):
+                result["error"] = _answer_error_detail(answer)
+            else:
+                result["answer"] = answer
+            if "error" in result:
+                errors += 1
+                logger.error(f"Batch query {position} failed: {answer}")
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+        elapsed = time.perf_counter() - start
+        logger.info(f"Answered batch of {len(queries)} queries ({errors} failed) in {elapsed:.2f}s: "
+                    f"{len(queries) / max(elapsed, 1e-9):.1f} queries/s.")
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @api_router.post("/tokens")
 async def request_token(token_request: TokenRequest):
     """Request a new access token"""
@@ -400,10 +747,6 @@ async def submit_token_request(email: str = Form(...)):
     
     return response
 
-# --- Include routers in the main application ---
-app.include_router(api_router)
-app.include_router(admin_router)
-
 # --- Add Admin API Endpoints ---
 @admin_router.get("/tokens")
 async def get_tokens(email: str = None, limit: int = 50):
@@ -443,6 +786,52 @@ async def get_email_for_token(token: str):
     else:
         raise HTTPException(status_code=404, detail="Token not found")
 
+@admin_router.get("/knowledge")
+async def get_knowledge_status():
+    """Report the loaded knowledge version and the stats of the last reload"""
+    return {
+        "version": knowledge_base.version if knowledge_base is not None else None,
+        "single_file": is_single_file_load,
+        "last_reload": last_reload,
+    }
+
+@admin_router.post("/knowledge/reload")
+async def trigger_knowledge_reload():
+    """Re-index changed knowledge files and swap the new version in without a restart"""
+    return await reload_knowledge()
+
+@admin_router.get("/cache")
+async def get_cache_stats():
+    """Report hit/miss/eviction counters and memory use of the server caches"""
+    return {"retrieval": retrieval_cache.stats(), "answers": answer_cache.stats()}
+
+@admin_router.get("/metrics")
+async def get_metrics():
+    """Report latency metrics (time to first token of streamed answers), query coalescing, upstream call counters, the token expiry sweeper and the email queue"""
+    return {"time_to_first_token": time_to_first_token.stats(), "query_coalescing": query_flights.stats(),
+            "upstream": upstream_metrics(), "token_sweeper": token_sweeper.stats(), "email": acl.email_queue.stats()}
+
+@admin_router.get("/emails")
+async def get_email_deliveries(email: str = None, limit: int = 50):
+    """Report the delivery status of the most recent token emails (optionally to one address)"""
+    return {"stats": acl.email_queue.stats(), "deliveries": acl.email_queue.deliveries(email, limit)}
+
+@admin_router.get("/context")
+async def get_context_stats():
+    """Report cumulative context packing counters: tokens used and saved, duplicates and near-duplicates removed"""
+    return {
+        "token_budget": CONTEXT_TOKEN_BUDGET,
+        "dedup_threshold": CONTEXT_DEDUP_THRESHOLD,
+        **{name: context_stats[name] for name in (
+            "packs", "tokens_used", "tokens_saved", "exact_duplicates", "near_duplicates", "near_duplicate_tokens",
+        )},
+    }
+
+# --- Include routers in the main application ---
+# (after all endpoints are declared: include_router copies the routes registered so far)
+app.include_router(api_router)
+app.include_router(admin_router)
+
 # --- Run Server ---
 if __name__ == '__main__':
     # Setup argument parser for server startup flags
@@ -452,10 +841,18 @@ if __name__ == '__main__':
         action="store_true",
         help="Run the server in dry-run mode (no actual API calls)."
     )
+    server_parser.add_argument(
+        "--api-base-url",
+        default=api_base_url,
+        help="Base URL of the OpenAI-compatible LLM API (default: LLM_API_BASE_URL or DeepSeek)."
+    )
     server_args = server_parser.parse_args()
+    api_base_url = server_args.api_base_url
+
+    import uvicorn  # only needed when run as a script, not when the app is imported
 
     # Initialize app with dry-run status
     initialize_app(dry_run_mode=server_args.dry_run)
 
-    logger.info(f"Starting Wine-AI FastAPI server on http://localhost:8080 (Mode: {'dry-run' if IS_DRY_RUN else 'live'})")
+    logger.info(f"Starting Wine-AI FastAPI server on http://localhost:8080 (Mode: {'dry-run' if IS_DRY_RUN else 'live'}, LLM API: {api_base_url})")
     uvicorn.run(app, host="127.0.0.1", port=8080) 
\ No newline at end of file
@@ -0,0 +1,64 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server"))
+
+from token_archive import SegmentedTokenArchive
+
+DAY = 24 * 3600
+BASE = 1_790_000_000 - 1_790_000_000 % DAY  # a UTC midnight
+
+
+def _record(number, expired_at, lifetime=3600):
+    return {"token": f"t{number}", "email": f"user{number % 3}@example.com",
+            "created": expired_at - lifetime, "expiry": expired_at, "expired_at": expired_at}
+
+
+class SegmentedTokenArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="wine-ai-archive-")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _newest_by_scan(self, records, limit):
+        return sorted(records, key=lambda record: record["created"], reverse=True)[:limit]
+
+    def test_newest_with_uneven_segments(self):
+        # Daily segments holding 1, 7, 0, 2 and 12 records
+        archive = SegmentedTokenArchive(self.directory, segment_hours=24)
+        records = []
+        for day, count in enumerate((1, 7, 0, 2, 12)):
+            records += [_record(len(records) + i, BASE + day * DAY + 60 * (i + 1)) for i in range(count)]
+        records.append(_record(len(records), BASE + 4 * DAY + 20 * 3600))  # the newest, late in the last day
+        archive.append(records)
+        # Then hourly segments inside the last daily one, as after a change of TOKEN_ARCHIVE_SEGMENT_HOURS:
+        # they start later than the daily segment but end before its newest record
+        hourly = SegmentedTokenArchive(self.directory, segment_hours=1)
+        late = [_record(len(records) + i, BASE + 4 * DAY + hours * 3600 + 1800, lifetime=600)
+                for i, hours in enumerate((2, 10))]
+        hourly.append(late)
+        records += late
+
+        for limit in range(len(records) + 2):
+            with self.subTest(limit=limit):
+                self.assertEqual([r["token"] for r in archive.newest(limit)],
+                                 [r["token"] for r in self._newest_by_scan(records, limit)])
+
+    def test_drop_before_clears_exactly_up_to_the_cutoff(self):
+        archive = SegmentedTokenArchive(self.directory, segment_hours=24)
+        records = [_record(i, BASE + i * 6 * 3600) for i in range(12)]  # four per day
+        archive.append(records)
+
+        cutoff = records[5]["expired_at"]  # in the middle of the second day
+        self.assertEqual(archive.drop_before(cutoff), 6)
+        self.assertEqual(sorted(r["token"] for r in archive.records()),
+                         sorted(r["token"] for r in records[6:]))
+        self.assertEqual(archive.drop_before(cutoff), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()